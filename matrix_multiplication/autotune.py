@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# matrix_multiplication/autotune.py -*- Python -*-
+#
+# This file is licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+#
+# (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
+
+# Offline tile-configuration autotuner for the whole_array design.
+#
+# For a given problem size M x K x N, data type and sub-array shape (n_rows x
+# n_cols cores), all (m, k, n, depth, mem_depth) configurations are
+# enumerated. Those that do not fit into the compute core (L1) and memory tile
+# (L2) memories or violate the shim DMA limits are pruned, and the rest are
+# ranked with an analytical cost model. No NPU is needed; only the
+# shortlisted configurations have to be built and run on the device. The
+# intrinsic r x s x t is not searched: the mm.cc kernels only implement the
+# default intrinsic of each data type.
+
+import argparse
+import itertools
+import json
+import os.path
+import sys
+
+# Data types of the whole_array design: input element type -> input and
+# output word sizes, the r x s x t intrinsic of its mm.cc kernel and its MACs
+# per core and cycle
+datapaths = {
+    "bf16": (2, 2, (4, 8, 4), 256),
+    "i8": (1, 4, (4, 8, 8), 512),
+    "i16": (2, 4, (4, 4, 4), 128),
+}
+
+# Memory capacities
+l1_bytes = 64 * 1024
+l1_stack_bytes = 1024
+l2_bytes = 512 * 1024
+
+# Shim DMA buffer descriptor limits
+dma_max_size = 1023  # per wrap dimension
+dma_max_repeat = 64  # outermost (repeat) dimension
+dma_max_stride = 1 << 20  # in 32-bit words
+
+# Cost model parameters, consistent with the roofline in plot_sweep.py
+clock_hz = 1e9
+shim_bandwidth = 2e9  # bytes/s per shim DMA channel
+stream_bytes_per_cycle = 4  # memtile -> core stream
+kernel_call_cycles = 150  # function call and loop setup per matmul invocation
+tile_overhead_cycles = 300  # zero() and FIFO handshakes per output tile
+sync_overhead_s = 2e-6  # npu_sync round trip per column and block of tile rows
+# Tile rows per block with the default shim BD pool: 16 BDs, 2 blocks in
+# flight, one C BD plus an A and a B BD per tile row.
+rows_per_block = 3
+
+micro_tile_sizes = [16, 32, 48, 64, 96, 128]
+fifo_depths = [1, 2, 3, 4]  # memory tile -> core FIFOs (--fifo-depth)
+mem_fifo_depths = [1, 2, 3, 4]  # shim -> memory tile FIFOs (--mem-fifo-depth)
+
+
+def l1_footprint(m, k, n, depth, dtype):
+    word_size_in, word_size_out, _, _ = datapaths[dtype]
+    return depth * (m * k + k * n) * word_size_in + 2 * m * n * word_size_out
+
+
+def l2_footprint(m, k, n, depth, mem_depth, n_rows, n_cols, dtype):
+    word_size_in, word_size_out, _, _ = datapaths[dtype]
+    # Linked FIFOs share their memory tile buffers, sized for the deeper of
+    # the two; a memory tile stacks the A tiles of a group of rows when there
+    # are more rows than columns.
+    A_group_size = -(-n_rows // min(n_rows, n_cols))
+    return (
+        max(depth, mem_depth) * (m * k * A_group_size + k * n) * word_size_in
+        + 2 * m * n * n_rows * word_size_out
+    )
+
+
+def padded_shape(M, K, N, m, k, n, n_rows, n_cols):
+    # Shapes that are not a multiple of the tiling are zero-padded by the host;
+    # the padded shape is what the design computes and moves.
+    return (
+        -(-M // (m * n_rows)) * m * n_rows,
+        -(-K // k) * k,
+        -(-N // (n * n_cols)) * n * n_cols,
+    )
+
+
+def is_legal(M, K, N, m, k, n, depth, mem_depth, n_rows, n_cols, dtype):
+    # See check_tiling and check_footprint in whole_array/aie2.py
+    word_size_in, word_size_out, (r, s, t), _ = datapaths[dtype]
+    if m % r != 0 or k % s != 0 or n % t != 0:
+        return False
+    M, K, N = padded_shape(M, K, N, m, k, n, n_rows, n_cols)
+    if (k * word_size_in) % 4 != 0 or (n * word_size_in) % 4 != 0:
+        return False
+    if (s * word_size_in) % 4 != 0 or (t * word_size_in) % 4 != 0:
+        return False
+    if (t * word_size_out) % 4 != 0:
+        return False
+    if l1_footprint(m, k, n, depth, dtype) > l1_bytes - l1_stack_bytes:
+        return False
+    if l2_footprint(m, k, n, depth, mem_depth, n_rows, n_cols, dtype) > l2_bytes:
+        return False
+    K_div_k = K // k
+    N_div_n_div_n_cols = N // (n * n_cols)
+    k_in_i32s = k * word_size_in // 4
+    n_in_i32s = n * word_size_in // 4
+    sizes = [K_div_k, m, k, k_in_i32s, n_in_i32s, m * n_rows]
+    if max(sizes) > dma_max_size or N_div_n_div_n_cols > dma_max_repeat:
+        return False
+    if k * N * word_size_in // 4 > dma_max_stride:
+        return False
+    return True
+
+
+def ddr_bytes(M, K, N, m, k, n, n_rows, n_cols, dtype):
+    """Bytes moved between DDR and the array by the whole_array sequence."""
+    word_size_in, word_size_out, _, _ = datapaths[dtype]
+    # A is re-fetched once per block of n_cols output tile columns, B once per
+    # block of n_rows output tile rows.
+    A = M * K * word_size_in * (N // (n * n_cols))
+    B = K * N * word_size_in * (M // (m * n_rows))
+    C = M * N * word_size_out
+    return A + B + C
+
+
+def cost(M, K, N, m, k, n, depth, mem_depth, n_rows, n_cols, dtype):
+    """Estimated runtime in seconds."""
+    word_size_in, _, _, core_macs_per_cycle = datapaths[dtype]
+    M, K, N = padded_shape(M, K, N, m, k, n, n_rows, n_cols)
+    tiles = (M // m) * (N // n) // (n_rows * n_cols)
+    K_div_k = K // k
+
+    # Per K step, a core computes m*k*n MACs and receives an m x k and a
+    # k x n tile over its input streams.
+    compute_cycles = m * k * n / core_macs_per_cycle + kernel_call_cycles
+    stream_cycles = max(m * k, k * n) * word_size_in / stream_bytes_per_cycle
+    step_cycles = max(compute_cycles, stream_cycles)
+    core_s = tiles * (K_div_k * step_cycles + tile_overhead_cycles) / clock_hz
+
+    # Each column uses two MM2S channels (A, B) and one S2MM channel (C).
+    n_channels = 2 * n_cols
+    dma_s = ddr_bytes(M, K, N, m, k, n, n_rows, n_cols, dtype) / (
+        shim_bandwidth * n_channels
+    )
+
+    n_blocks = -(-(M // (m * n_rows)) // rows_per_block)
+    sync_s = n_blocks * n_cols * sync_overhead_s
+
+    # Without double buffering on either FIFO, data movement and compute
+    # serialize.
+    if depth < 2 or mem_depth < 2:
+        return core_s + dma_s + sync_s
+    return max(core_s, dma_s) + sync_s
+
+
+def enumerate_configs(M, K, N, n_rows, n_cols, dtype):
+    for m, k, n, depth, mem_depth in itertools.product(
+        micro_tile_sizes,
+        micro_tile_sizes,
+        micro_tile_sizes,
+        fifo_depths,
+        mem_fifo_depths,
+    ):
+        if is_legal(M, K, N, m, k, n, depth, mem_depth, n_rows, n_cols, dtype):
+            yield (m, k, n, depth, mem_depth)
+
+
+def rank(M, K, N, n_rows, n_cols, dtype):
+    configs = [
+        (cost(M, K, N, *c, n_rows, n_cols, dtype), c)
+        for c in enumerate_configs(M, K, N, n_rows, n_cols, dtype)
+    ]
+    # On ties, prefer the larger tiles (fewer kernel calls) and the shallower
+    # FIFOs (less memory).
+    configs.sort(key=lambda x: (x[0], -x[1][0] * x[1][1] * x[1][2], x[1][3], x[1][4]))
+    return configs
+
+
+def make_args(M, K, N, config, n_rows, n_cols, dtype):
+    m, k, n, depth, mem_depth = config
+    args = (
+        "M={} K={} N={} m={} k={} n={} n_rows={} n_cols={} fifo_depth={} "
+        "mem_fifo_depth={}".format(M, K, N, m, k, n, n_rows, n_cols, depth, mem_depth)
+    )
+    if dtype != "bf16":
+        args += " dtype={}".format(dtype)
+    return args
+
+
+def aie2_args(M, K, N, config, n_rows, n_cols, dtype):
+    m, k, n, depth, mem_depth = config
+    return (
+        "-M {} -K {} -N {} -m {} -k {} -n {} --n-rows {} --n-cols {} "
+        "--fifo-depth {} --mem-fifo-depth {} --dtype {}".format(
+            M, K, N, m, k, n, n_rows, n_cols, depth, mem_depth, dtype
+        )
+    )
+
+
+def shape_key(M, K, N, dtype):
+    if dtype == "bf16":
+        return "{}x{}x{}".format(M, K, N)
+    return "{}x{}x{}_{}".format(M, K, N, dtype)
+
+
+def grid_key(n_rows, n_cols):
+    return "{}x{}".format(n_rows, n_cols)
+
+
+def load_table(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def store_table(path, table):
+    with open(path, "w") as f:
+        json.dump(table, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+        description="Rank whole_array tile configurations for a matrix size"
+    )
+    argparser.add_argument("-M", type=int, required=True)
+    argparser.add_argument("-K", type=int, required=True)
+    argparser.add_argument("-N", type=int, required=True)
+    argparser.add_argument(
+        "--dtype",
+        choices=datapaths.keys(),
+        default="bf16",
+        help="input element type; each type uses the one intrinsic of its "
+        "mm.cc kernel",
+    )
+    argparser.add_argument("--n-rows", type=int, default=4)
+    argparser.add_argument("--n-cols", type=int, default=4)
+    argparser.add_argument("--top", type=int, default=5)
+    argparser.add_argument(
+        "--table",
+        type=str,
+        default=os.path.join(os.path.dirname(__file__), "tile_configs.json"),
+        help="best-config table, keyed by MxKxN and sub-array shape",
+    )
+    argparser.add_argument(
+        "--lookup",
+        action="store_true",
+        default=False,
+        help="only print the make arguments of the best known configuration",
+    )
+    return argparser.parse_args()
+
+
+def main():
+    args = get_args()
+    M, K, N = args.M, args.K, args.N
+    n_rows, n_cols = args.n_rows, args.n_cols
+    dtype = args.dtype
+    table = load_table(args.table)
+    key = shape_key(M, K, N, dtype)
+    grid = grid_key(n_rows, n_cols)
+
+    # Entries written before the search covered both FIFO depths are
+    # re-ranked.
+    known = table.get(key, {}).get(grid, {}).get("config", [])
+    if args.lookup and len(known) == 5:
+        print(make_args(M, K, N, known, n_rows, n_cols, dtype))
+        return
+
+    ranked = rank(M, K, N, n_rows, n_cols, dtype)
+    if not ranked:
+        sys.stderr.write(
+            "No legal tile configuration for {} on {}.\n".format(key, grid)
+        )
+        sys.exit(1)
+
+    best_time, best = ranked[0]
+    table.setdefault(key, {})[grid] = {
+        "config": list(best),
+        "estimated_us": best_time * 1e6,
+    }
+    store_table(args.table, table)
+
+    if args.lookup:
+        print(make_args(M, K, N, best, n_rows, n_cols, dtype))
+        return
+
+    print("{} on {}: {} legal configurations".format(key, grid, len(ranked)))
+    print("  est. [us]  m   k   n  depths  L1 [B]  L2 [B]")
+    for est, c in ranked[: args.top]:
+        m, k, n, depth, mem_depth = c
+        print(
+            "  {:9.1f} {:3d} {:3d} {:3d}  {}x{:<4d} {:7d} {:7d}".format(
+                est * 1e6,
+                m,
+                k,
+                n,
+                depth,
+                mem_depth,
+                l1_footprint(m, k, n, depth, dtype),
+                l2_footprint(m, k, n, depth, mem_depth, n_rows, n_cols, dtype),
+            )
+        )
+    print()
+    for est, c in ranked[: args.top]:
+        print(
+            "python3 whole_array/aie2.py {}".format(
+                aie2_args(M, K, N, c, n_rows, n_cols, dtype)
+            )
+        )
+    for est, c in ranked[: args.top]:
+        print(
+            "make -C whole_array {}".format(
+                make_args(M, K, N, c, n_rows, n_cols, dtype)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# matrix_multiplication/check_autotune.py -*- Python -*-
+#
+# This file is licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+#
+# (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
+
+# Checks the configurations that autotune.py enumerates, without an NPU.
+#
+# Every candidate must use micro-tiles that are a multiple of the intrinsic of
+# its data type and a whole number of 32-bit words, and its buffers in the
+# default output-stationary dataflow must fit into the compute core (L1) and
+# memory tile (L2) memories (check_footprint in resources.py). The generator
+# cannot be imported, so the best ranked candidates of each data type are
+# also generated with whole_array/aie2.py, which must accept them. All
+# violations are printed; the exit status is 1 if there are any.
+
+import argparse
+import os.path
+import subprocess
+import sys
+
+import autotune
+from resources import check_footprint
+
+whole_array = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whole_array")
+
+
+def check_config(config, n_rows, n_cols, dtype):
+    m, k, n, depth, mem_depth = config
+    word_size_in, word_size_out, (r, s, t), _ = autotune.datapaths[dtype]
+    violations = []
+    if m % r != 0 or k % s != 0 or n % t != 0:
+        violations.append(
+            "micro-tile {}x{}x{} is not a multiple of the intrinsic {}x{}x{}".format(
+                m, k, n, r, s, t
+            )
+        )
+    if (k * word_size_in) % 4 != 0 or (n * word_size_in) % 4 != 0:
+        violations.append("k and n are not a whole number of 32-bit words")
+    # Each core holds depth A and B tiles and two C tiles; a memory tile holds
+    # the A tiles of its group of rows, the B tiles of its column and the C
+    # tiles of its column, sized for the deeper of the linked FIFOs.
+    A_group_size = -(-n_rows // min(n_rows, n_cols))
+    try:
+        check_footprint(
+            depth * (m * k + k * n) * word_size_in + 2 * m * n * word_size_out,
+            max(depth, mem_depth) * (m * k * A_group_size + k * n) * word_size_in
+            + 2 * m * n * n_rows * word_size_out,
+        )
+    except ValueError as e:
+        violations.append(str(e))
+    return ["{} {}: {}".format(dtype, config, v) for v in violations]
+
+
+def check_generated(M, K, N, config, n_rows, n_cols, dtype):
+    result = subprocess.run(
+        [sys.executable, os.path.join(whole_array, "aie2.py")]
+        + autotune.aie2_args(M, K, N, config, n_rows, n_cols, dtype).split(),
+        cwd=whole_array,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        return [
+            "{} {}: whole_array/aie2.py rejects it: {}".format(
+                dtype, config, error[-1] if error else result.returncode
+            )
+        ]
+    return []
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+        description="Check the tile configurations enumerated by autotune.py"
+    )
+    argparser.add_argument("-M", type=int, required=True)
+    argparser.add_argument("-K", type=int, required=True)
+    argparser.add_argument("-N", type=int, required=True)
+    argparser.add_argument(
+        "--dtype",
+        choices=autotune.datapaths.keys(),
+        action="append",
+        help="data type to check; may be repeated, defaults to all",
+    )
+    argparser.add_argument("--n-rows", type=int, default=4)
+    argparser.add_argument("--n-cols", type=int, default=4)
+    argparser.add_argument(
+        "--generate",
+        type=int,
+        default=1,
+        help="best ranked configurations per data type to generate",
+    )
+    return argparser.parse_args()
+
+
+def main():
+    args = get_args()
+    M, K, N = args.M, args.K, args.N
+    n_rows, n_cols = args.n_rows, args.n_cols
+    violations = []
+    counts = []
+    for dtype in args.dtype or autotune.datapaths.keys():
+        ranked = autotune.rank(M, K, N, n_rows, n_cols, dtype)
+        for _, config in ranked:
+            violations += check_config(config, n_rows, n_cols, dtype)
+        for _, config in ranked[: args.generate]:
+            violations += check_generated(M, K, N, config, n_rows, n_cols, dtype)
+        counts.append((dtype, len(ranked)))
+    if violations:
+        for violation in violations:
+            sys.stderr.write(violation + ".\n")
+        sys.exit(1)
+    for dtype, count in counts:
+        print(
+            "{}: {} legal configurations".format(
+                autotune.shape_key(M, K, N, dtype), count
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
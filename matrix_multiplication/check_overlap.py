@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# matrix_multiplication/check_overlap.py -*- Python -*-
+#
+# This file is licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+#
+# (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
+
+# Checks that designs generated with --col-offset (and --num-cols) can run on
+# the array at the same time.
+#
+# The tiles of a design are taken from its aie.tile declarations and its shim
+# DMA channels from the object FIFOs and flows that start or end at a shim
+# tile (or from the aie.shim_dma_allocation ops, once the FIFOs have been
+# lowered). Designs conflict if they target different devices, share a tile
+# or use DMA channels of the same shim, or if a shim needs more channels than
+# it has. The runtime sequence of a design may only synchronize on and write
+# to the tiles of the design itself. All conflicts are printed; the exit
+# status is 1 if there are any.
+
+import argparse
+import collections
+import itertools
+import re
+import sys
+
+from devices import devices
+
+# DMA channels per direction of a shim tile
+shim_channels = 2
+
+device_re = re.compile(r"aie\.device\((\w+)\)")
+tile_re = re.compile(r"(%[\w$.-]+) = aie\.tile\((\d+), (\d+)\)")
+objectfifo_re = re.compile(r"aie\.objectfifo @([\w$.-]+)\(([^!]*)")
+flow_re = re.compile(
+    r"aie\.flow\((%[\w$.-]+), (\w+) : (\d+), (%[\w$.-]+), (\w+) : (\d+)\)"
+)
+shim_dma_allocation_re = re.compile(
+    r"aie\.shim_dma_allocation @[\w$.-]+\((MM2S|S2MM), (\d+), (\d+)\)"
+)
+runtime_op_re = re.compile(r"aiex\.npu\.(sync|write32) \{([^}]*)\}")
+ssa_re = re.compile(r"%[\w$.-]+")
+
+
+class Design:
+    """The tiles, shim DMA channels and runtime accesses of a generated
+    design"""
+
+    def __init__(self, path):
+        self.path = path
+        self.device = None
+        self.tiles = set()
+        # (column, direction) -> channels used on the shim of the column. The
+        # channels of an object FIFO are only assigned when it is lowered, so
+        # until then the FIFO stands for the channel it will take.
+        self.shim_channels = collections.defaultdict(set)
+        # (op, (column, row)) for each sync and write32 of the sequence
+        self.runtime_ops = []
+
+        names = {}
+        dma_ends = []  # (tile name, direction, channel)
+        with open(path) as f:
+            for line in f:
+                m = device_re.search(line)
+                if m and self.device is None:
+                    self.device = m.group(1)
+                m = tile_re.search(line)
+                if m:
+                    names[m.group(1)] = (int(m.group(2)), int(m.group(3)))
+                m = objectfifo_re.search(line)
+                if m:
+                    ends = ssa_re.findall(m.group(2))
+                    dma_ends.append((ends[0], "MM2S", m.group(1)))
+                    dma_ends += [(end, "S2MM", m.group(1)) for end in ends[1:]]
+                m = flow_re.search(line)
+                if m:
+                    if m.group(2) == "DMA":
+                        dma_ends.append((m.group(1), "MM2S", int(m.group(3))))
+                    if m.group(5) == "DMA":
+                        dma_ends.append((m.group(4), "S2MM", int(m.group(6))))
+                m = shim_dma_allocation_re.search(line)
+                if m:
+                    direction, channel, column = m.groups()
+                    self.shim_channels[(int(column), direction)].add(int(channel))
+                m = runtime_op_re.search(line)
+                if m:
+                    attrs = dict(re.findall(r"(\w+) = (\d+)", m.group(2)))
+                    tile = (int(attrs["column"]), int(attrs["row"]))
+                    self.runtime_ops.append((m.group(1), tile))
+
+        self.tiles = set(names.values())
+        shim_row = devices[self.device].shim_row if self.device in devices else 0
+        for name, direction, channel in dma_ends:
+            column, row = names[name]
+            if row == shim_row:
+                self.shim_channels[(column, direction)].add(channel)
+
+
+def check_design(design):
+    conflicts = []
+    if design.device is None or not design.tiles:
+        conflicts.append("{} does not contain a design".format(design.path))
+    for (column, direction), channels in sorted(design.shim_channels.items()):
+        if len(channels) > shim_channels:
+            conflicts.append(
+                "{} needs {} {} channels of the shim in column {}, which only "
+                "has {}".format(
+                    design.path, len(channels), direction, column, shim_channels
+                )
+            )
+    for op, tile in design.runtime_ops:
+        if tile not in design.tiles:
+            conflicts.append(
+                "{} issues {} on tile {}, which is not part of the design".format(
+                    design.path, op, tile
+                )
+            )
+    return conflicts
+
+
+def check_pair(a, b):
+    if a.device != b.device:
+        return [
+            "{} targets {}, but {} targets {}".format(
+                a.path, a.device, b.path, b.device
+            )
+        ]
+    conflicts = []
+    for tile in sorted(a.tiles & b.tiles):
+        conflicts.append("{} and {} both use tile {}".format(a.path, b.path, tile))
+    for column, direction in sorted(set(a.shim_channels) & set(b.shim_channels)):
+        conflicts.append(
+            "{} and {} both use {} channels of the shim in column {}".format(
+                a.path, b.path, direction, column
+            )
+        )
+    for x, y in [(a, b), (b, a)]:
+        for op, tile in x.runtime_ops:
+            if tile in y.tiles:
+                conflicts.append(
+                    "{} issues {} on tile {} of {}".format(x.path, op, tile, y.path)
+                )
+    return conflicts
+
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+        description="Check that generated designs can share the array"
+    )
+    argparser.add_argument(
+        "designs", nargs="+", help="MLIR files emitted by the aie2.py generators"
+    )
+    return argparser.parse_args()
+
+
+def main():
+    args = get_args()
+    designs = [Design(path) for path in args.designs]
+    conflicts = []
+    for design in designs:
+        conflicts += check_design(design)
+    for a, b in itertools.combinations(designs, 2):
+        conflicts += check_pair(a, b)
+    if conflicts:
+        for conflict in conflicts:
+            sys.stderr.write(conflict + ".\n")
+        sys.exit(1)
+    for design in designs:
+        columns = sorted({column for column, _ in design.tiles})
+        print(
+            "{}: columns {} to {} of {}".format(
+                design.path, columns[0], columns[-1], design.device
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -56,7 +56,43 @@ void add_default_options(po::options_description &desc) {
       "M,M", po::value<int>()->default_value(512), "Matrix size M")(
       "K,K", po::value<int>()->default_value(512), "Matrix size K")(
       "N,N", po::value<int>()->default_value(512),
-      "Matrix size N")("iters", po::value<int>()->default_value(1))(
+      "Matrix size N")("pad_M", po::value<int>()->default_value(1),
+                       "pad M up to a multiple of this")(
+      "pad_K", po::value<int>()->default_value(1),
+      "pad K up to a multiple of this")(
+      "pad_N", po::value<int>()->default_value(1),
+      "pad N up to a multiple of this")(
+      "accumulate", po::value<bool>()->default_value(false),
+      "whether the design computes C += A * B on the initial C")(
+      "batch", po::value<int>()->default_value(1),
+      "number of packed matrix products computed per launch")(
+      "bias", po::value<bool>()->default_value(false),
+      "whether the design adds a bias vector, stored after B, to C")(
+      "activation", po::value<std::string>()->default_value("none"),
+      "activation function the design applies to C (none, relu, gelu)")(
+      "transpose_A", po::value<bool>()->default_value(false),
+      "whether the design reads A stored transposed")(
+      "transpose_B", po::value<bool>()->default_value(false),
+      "whether the design reads B stored transposed")(
+      "transpose_C", po::value<bool>()->default_value(false),
+      "whether the design writes C transposed")(
+      "block_mask", po::value<std::string>()->default_value(""),
+      "mask of the nonzero blocks of B, which the design reads compressed")(
+      "block_group", po::value<int>()->default_value(1),
+      "tile columns of B whose blocks the design skips together")(
+      "block_runs", po::value<int>()->default_value(14),
+      "runs of K tiles the design fetches per group of tile columns at most "
+      "(its shim BDs less those of B and C)")(
+      "repeat", po::value<int>()->default_value(1),
+      "times the design computes the product per launch; the reported times "
+      "are per product")(
+      "perf_rows", po::value<int>()->default_value(0),
+      "rows of cores whose performance counters the design stores after C")(
+      "perf_cols", po::value<int>()->default_value(0),
+      "columns of cores whose performance counters the design stores")(
+      "perf_tile", po::value<int>()->default_value(0),
+      "elements of C the design stores per core for its counters")(
+      "iters", po::value<int>()->default_value(1))(
       "warmup", po::value<int>()->default_value(0))(
       "trace_sz,t", po::value<int>()->default_value(0))(
       "trace_file", po::value<std::string>()->default_value("trace.txt"),
@@ -110,12 +146,211 @@ static inline std::int16_t random_int16_t() {
   return (std::int16_t)rand() % 0x10000;
 }
 
+// Quantized inputs for the integer datapaths are drawn from the int8 range,
+// so that the int32 accumulators cannot overflow for any K the designs
+// support, and the results can be compared exactly.
+template <typename T> static inline T random_quantized() {
+  return T(rand() % 256 - 128);
+}
+
 static inline std::bfloat16_t random_bfloat16_t() {
   // Random numbers should NOT be uniformly between 0 and 1, because that
   // would make the matrix product AB always close to 1.
   return std::bfloat16_t(4.0 * (float)rand() / (float)(RAND_MAX));
 }
 
+static inline int round_up(int x, int multiple) {
+  return (x + multiple - 1) / multiple * multiple;
+}
+
+// Copy a rows x cols row-major matrix into a zero-padded
+// padded_rows x padded_cols one. Each row is a contiguous copy, so this
+// compiles down to memcpy/memset.
+template <typename T>
+void pack_padded(const T *src, int rows, int cols, T *dst, int padded_rows,
+                 int padded_cols) {
+  if (rows == padded_rows && cols == padded_cols) {
+    std::copy(src, src + rows * cols, dst);
+    return;
+  }
+  for (int row = 0; row < rows; row++) {
+    std::copy(src + row * cols, src + (row + 1) * cols, dst + row * padded_cols);
+    std::fill(dst + row * padded_cols + cols, dst + (row + 1) * padded_cols,
+              T(0));
+  }
+  std::fill(dst + rows * padded_cols, dst + padded_rows * padded_cols, T(0));
+}
+
+// Inverse of pack_padded: extract the leading rows x cols of a padded
+// matrix with padded_cols columns.
+template <typename T>
+void unpack_padded(const T *src, int padded_cols, T *dst, int rows,
+                   int cols) {
+  if (cols == padded_cols) {
+    std::copy(src, src + rows * cols, dst);
+    return;
+  }
+  for (int row = 0; row < rows; row++) {
+    std::copy(src + row * padded_cols, src + row * padded_cols + cols,
+              dst + row * cols);
+  }
+}
+
+// Like pack_padded, but store the padded matrix transposed, i.e. as a
+// padded_cols x padded_rows row-major matrix.
+template <typename T>
+void pack_padded_transposed(const T *src, int rows, int cols, T *dst,
+                            int padded_rows, int padded_cols) {
+  std::fill(dst, dst + padded_rows * padded_cols, T(0));
+  for (int row = 0; row < rows; row++) {
+    for (int col = 0; col < cols; col++) {
+      dst[col * padded_rows + row] = src[row * cols + col];
+    }
+  }
+}
+
+// Inverse of pack_padded_transposed: extract the leading rows x cols of a
+// padded matrix stored transposed, with padded_rows columns.
+template <typename T>
+void unpack_padded_transposed(const T *src, int padded_rows, T *dst, int rows,
+                              int cols) {
+  for (int row = 0; row < rows; row++) {
+    for (int col = 0; col < cols; col++) {
+      dst[row * cols + col] = src[col * padded_rows + row];
+    }
+  }
+}
+
+// --------------------------------------------------------------------------
+// Block-Sparse B
+// --------------------------------------------------------------------------
+
+// A block mask has one line per row of blocks of B, with a '1' for every
+// block that is stored and a '0' for every block that is all zeros.
+// Whitespace and '#' comments are ignored, as in read_block_mask in
+// whole_array/aie2.py.
+std::vector<std::vector<bool>> load_block_mask(std::string path) {
+  std::ifstream mask_file(path);
+  if (!mask_file) {
+    throw std::runtime_error("Unable to open block mask " + path + "\n");
+  }
+  std::vector<std::vector<bool>> mask;
+  std::string line;
+  while (std::getline(mask_file, line)) {
+    std::vector<bool> row;
+    for (char c : line.substr(0, line.find('#'))) {
+      if (c == '0' || c == '1') {
+        row.push_back(c == '1');
+      } else if (!std::isspace(c)) {
+        throw std::runtime_error("Unable to parse block mask " + path + "\n");
+      }
+    }
+    if (!row.empty()) {
+      mask.push_back(row);
+    }
+  }
+  if (mask.empty()) {
+    throw std::runtime_error("Empty block mask " + path + "\n");
+  }
+  return mask;
+}
+
+// The design skips a K tile for a group of `group` tile columns only if all
+// of their blocks in that row are zero, so it also stores the zero blocks of
+// such a row that lie next to nonzero ones. It fetches the A tiles of a group
+// with one BD per run of consecutive K tiles, so a group with more than
+// `max_runs` runs gets its shortest gaps (the topmost of equal ones) filled
+// in, as in block_sparse_K_tiles in whole_array/aie2.py.
+std::vector<std::vector<bool>>
+widen_block_mask(const std::vector<std::vector<bool>> &mask, int group,
+                 int max_runs) {
+  std::vector<std::vector<bool>> widened = mask;
+  for (size_t first = 0; first < mask[0].size(); first += group) {
+    size_t last = std::min(mask[0].size(), first + group);
+    std::vector<bool> K_tiles(mask.size());
+    for (size_t row = 0; row < mask.size(); row++) {
+      K_tiles[row] = std::find(mask[row].begin() + first,
+                               mask[row].begin() + last,
+                               true) != mask[row].begin() + last;
+    }
+    while (true) {
+      // The gaps between runs, as (first K tile, K tiles)
+      std::vector<std::pair<size_t, size_t>> gaps;
+      size_t row = std::find(K_tiles.begin(), K_tiles.end(), true) -
+                   K_tiles.begin();
+      while (row < K_tiles.size()) {
+        size_t gap = std::find(K_tiles.begin() + row, K_tiles.end(), false) -
+                     K_tiles.begin();
+        row = std::find(K_tiles.begin() + gap, K_tiles.end(), true) -
+              K_tiles.begin();
+        if (row < K_tiles.size()) {
+          gaps.push_back({gap, row - gap});
+        }
+      }
+      if (int(gaps.size()) + 1 <= max_runs) {
+        break;
+      }
+      auto shortest = std::min_element(
+          gaps.begin(), gaps.end(),
+          [](auto &a, auto &b) { return a.second < b.second; });
+      std::fill(K_tiles.begin() + shortest->first,
+                K_tiles.begin() + shortest->first + shortest->second, true);
+    }
+    for (size_t row = 0; row < mask.size(); row++) {
+      std::fill(widened[row].begin() + first, widened[row].begin() + last,
+                bool(K_tiles[row]));
+    }
+  }
+  return widened;
+}
+
+int count_blocks(const std::vector<std::vector<bool>> &mask) {
+  int count = 0;
+  for (const auto &row : mask) {
+    count += std::count(row.begin(), row.end(), true);
+  }
+  return count;
+}
+
+// Zero the block_rows x block_cols blocks of a rows x cols row-major matrix
+// that the mask marks as zero. The mask covers the padded matrix, so the
+// blocks at the bottom and right edge may be cut off.
+template <typename T>
+void prune_blocks(T *matrix, int rows, int cols,
+                  const std::vector<std::vector<bool>> &mask, int block_rows,
+                  int block_cols) {
+  for (int row = 0; row < rows; row++) {
+    for (int col = 0; col < cols; col++) {
+      if (!mask[row / block_rows][col / block_cols]) {
+        matrix[row * cols + col] = T(0);
+      }
+    }
+  }
+}
+
+// Store the blocks of a rows x cols row-major matrix that the mask marks as
+// nonzero compressed, by columns of blocks: the stored blocks of each column
+// of blocks top to bottom, each block row-major, and the columns of blocks
+// one after the other.
+template <typename T>
+void pack_block_sparse(const T *src, int rows, int cols, T *dst,
+                       const std::vector<std::vector<bool>> &mask) {
+  int block_rows = rows / mask.size();
+  int block_cols = cols / mask[0].size();
+  for (size_t block_col = 0; block_col < mask[0].size(); block_col++) {
+    for (size_t block_row = 0; block_row < mask.size(); block_row++) {
+      if (!mask[block_row][block_col]) {
+        continue;
+      }
+      for (int row = 0; row < block_rows; row++) {
+        const T *src_row =
+            src + (block_row * block_rows + row) * cols + block_col * block_cols;
+        dst = std::copy(src_row, src_row + block_cols, dst);
+      }
+    }
+  }
+}
+
 template <typename Tin, typename Tout>
 void matmul_naive(int M, int N, int K, const std::vector<Tin> A,
                   const std::vector<Tin> B, std::vector<Tout> &C) {
@@ -139,6 +374,7 @@ void matmul(int M, int N, int K, const std::vector<Tin> A,
 
   constexpr int K_block_size = 64;
   const int n_K_blocks = K / K_block_size;
+  const int K_remainder = K % K_block_size;
 
   const Tin *B_origin = B.data(); /* Avoid a calls to B.data() within the loop
                                      with this const variable. B does not get
@@ -167,6 +403,11 @@ void matmul(int M, int N, int K, const std::vector<Tin> A,
           B_ptr += N; // Advance to bottom neighbor; next value in this column
         }
       }
+      for (int i = 0; i < K_remainder; i++) {
+        running_sum += Tout(*A_ptr) * Tout(*B_ptr);
+        A_ptr += 1;
+        B_ptr += N;
+      }
       *C_ptr = Tout(running_sum);
       C_ptr += 1;
       B_base += 1; /* Next iteration: same row of A (A_base unchanged),
@@ -188,6 +429,45 @@ Tout mul_acc(int M, int N, int K, int row, int col, const std::vector<Tin> A,
   return running_sum;
 }
 
+// Slope of the hard sigmoid with which the GELU epilogue approximates the
+// standard normal CDF, see gelu in mm_ext.cc
+constexpr float gelu_slope = 0.3404f;
+
+// The epilogue of designs that add a bias vector to every row of C and/or
+// apply an activation function to it.
+template <typename Tout>
+void apply_epilogue(int M, int N, std::vector<Tout> &C,
+                    const std::vector<Tout> &bias,
+                    const std::string &activation) {
+  for (int row = 0; row < M; row++) {
+    for (int col = 0; col < N; col++) {
+      Tout &c = C[row * N + col];
+      if constexpr (std::is_integral_v<Tout>) {
+        if (!bias.empty()) {
+          c += bias[col];
+        }
+        if (activation == "relu") {
+          c = std::max(c, Tout(0));
+        }
+      } else {
+        // The cores round to Tout after each step, see mm_ext.cc.
+        float x = float(c);
+        if (!bias.empty()) {
+          x = float(Tout(x + float(bias[col])));
+        }
+        if (activation == "relu") {
+          x = std::max(x, 0.0f);
+        } else if (activation == "gelu") {
+          // The hard-sigmoid GELU of gelu in mm_ext.cc, not the exact one
+          float phi = float(Tout(0.5f + float(Tout(gelu_slope)) * x));
+          x = x * std::clamp(phi, 0.0f, 1.0f);
+        }
+        c = Tout(x);
+      }
+    }
+  }
+}
+
 // nearly_equal function adapted from Stack Overflow, License CC BY-SA 4.0
 // Original author: P-Gn
 // Source: https://stackoverflow.com/a/32334103
@@ -283,7 +563,11 @@ std::optional<struct error<Tout>>
 verify_single(std::ostream &os, int row, int col, Tout expected, Tout actual) {
   const float absTol = 0.5;
   const float relTol = 0.15;
-  if (!nearly_equal(expected, actual, relTol, absTol)) {
+  if constexpr (std::is_integral_v<Tout>) {
+    if (expected != actual) {
+      return (struct error<Tout>){row, col, expected, actual};
+    }
+  } else if (!nearly_equal(expected, actual, relTol, absTol)) {
     return (struct error<Tout>){row, col, expected, actual};
   }
   return std::nullopt;
@@ -313,12 +597,28 @@ void print_progress_bar(std::ostream &os, double progress, int len = 75) {
 
 template <typename Tin, typename Tout>
 int verify(int M, int N, int K, std::vector<Tin> A, std::vector<Tin> B,
-           std::vector<Tout> C, int verbosity = 0) {
+           std::vector<Tout> C, int verbosity = 0,
+           const std::vector<Tout> &C_init = {},
+           const std::vector<Tout> &bias = {},
+           const std::string &activation = "none") {
   int n_errors = 0;
   std::vector<struct error<Tout>> errors;
 
   std::vector<Tout> CRef(M * N);
   matmul(M, N, K, A, B, CRef);
+  // For designs computing C += A * B, C_init holds the initial C.
+  if (!C_init.empty()) {
+    for (int i = 0; i < M * N; i++) {
+      if constexpr (std::is_integral_v<Tout>) {
+        CRef[i] += C_init[i];
+      } else {
+        CRef[i] = Tout(float(CRef[i]) + float(C_init[i]));
+      }
+    }
+  }
+  if (!bias.empty() || activation != "none") {
+    apply_epilogue(M, N, CRef, bias, activation);
+  }
 
   for (int row = 0; row < M; row++) {
     for (int col = 0; col < N; col++) {
@@ -387,6 +687,61 @@ int verify_stochastic(int M, int N, int K, std::vector<Tin> A,
   return n_errors;
 }
 
+// --------------------------------------------------------------------------
+// Performance Counters
+// --------------------------------------------------------------------------
+
+// The counters each core of a design generated with --perf-counters stores
+// at the end of a launch, see perf_store in mm_ext.cc. The timestamps count
+// cycles from the start of the launch.
+struct perf_counters {
+  uint32_t kernel_cycles; // spent in the matmul kernel
+  uint32_t calls;         // of the matmul kernel
+  uint32_t first_start;   // of the first call
+  uint32_t last_end;      // of the last call
+};
+
+// The counters of the core in row i and column j take the first words of
+// C tile i * cols + j after C, each tile_bytes long.
+std::vector<perf_counters> read_perf_counters(char *perfOutPtr, int rows,
+                                              int cols, size_t tile_bytes) {
+  std::vector<perf_counters> counters(rows * cols);
+  for (int core = 0; core < rows * cols; core++) {
+    uint32_t *words = (uint32_t *)(perfOutPtr + core * tile_bytes);
+    counters[core] = {words[0], words[1], words[2], words[3]};
+  }
+  return counters;
+}
+
+// Print the counters of each core, averaged over the launches in runs (one
+// vector of counters per launch). A core is busy for the fraction of the
+// time between the start of its first and the end of its last kernel call
+// that it spends in the kernel; the rest it waits for data.
+void print_perf_counters(std::ostream &os,
+                         const std::vector<std::vector<perf_counters>> &runs,
+                         int cols) {
+  if (runs.empty()) {
+    return;
+  }
+  os << std::endl
+     << "Core (row, col): kernel cycles, calls, cycles per call, busy"
+     << std::endl;
+  for (int core = 0; core < runs[0].size(); core++) {
+    double cycles = 0, calls = 0, span = 0;
+    for (const std::vector<perf_counters> &run : runs) {
+      cycles += run[core].kernel_cycles;
+      calls += run[core].calls;
+      span += run[core].last_end - run[core].first_start;
+    }
+    os << "(" << core / cols << ", " << core % cols << "): " << std::fixed
+       << std::setprecision(0) << cycles / runs.size() << ", "
+       << calls / runs.size() << ", " << (calls ? cycles / calls : 0) << ", "
+       << std::setprecision(1) << (span ? 100.0 * cycles / span : 0) << "%"
+       << std::endl;
+  }
+  os << std::defaultfloat;
+}
+
 // --------------------------------------------------------------------------
 // Tracing
 // --------------------------------------------------------------------------
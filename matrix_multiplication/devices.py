@@ -0,0 +1,59 @@
+# matrix_multiplication/devices.py -*- Python -*-
+#
+# This file is licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+#
+# (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
+
+# Geometry of the devices the designs can be generated for.
+#
+# Every column of an NPU array has a shim tile, which connects to DDR, a
+# memory tile above it and compute tiles above that. The npu1_Ncol devices
+# are partitions of N columns of the Phoenix/Hawk Point array; npu2 is the
+# 8-column Strix array. The generators take the name of one of these with
+# --device and derive the columns they may use and the tile coordinates from
+# it, instead of assuming the 4-column npu1 array.
+#
+# A device has n_cols columns, each with its shim tile in row shim_row, its
+# memory tile in row mem_row and n_core_rows compute tiles from row core_row
+# upwards. A shim tile has n_shim_bds buffer descriptors (BDs), shared by its
+# DMA channels.
+
+import collections
+
+Device = collections.namedtuple(
+    "Device",
+    ["name", "n_cols", "n_core_rows", "shim_row", "mem_row", "core_row", "n_shim_bds"],
+)
+
+devices = {
+    "npu1_1col": Device("npu1_1col", 1, 4, 0, 1, 2, 16),
+    "npu1_2col": Device("npu1_2col", 2, 4, 0, 1, 2, 16),
+    "npu1_3col": Device("npu1_3col", 3, 4, 0, 1, 2, 16),
+    "npu1_4col": Device("npu1_4col", 4, 4, 0, 1, 2, 16),
+    "npu2": Device("npu2", 8, 4, 0, 1, 2, 16),
+}
+
+
+def npu1_partition(n_cols):
+    """The smallest npu1 partition with n_cols columns"""
+    return devices["npu1_{}col".format(n_cols)]
+
+
+def placement(dev, col_offset, num_cols):
+    """The num_cols columns of dev from col_offset on, to which a design is
+    confined so that other designs can use the remaining columns"""
+    if not 0 <= col_offset < dev.n_cols:
+        raise ValueError(
+            "column {} is not on {}, which has columns 0 to {}".format(
+                col_offset, dev.name, dev.n_cols - 1
+            )
+        )
+    if not 1 <= num_cols <= dev.n_cols - col_offset:
+        raise ValueError(
+            "{} columns from column {} on do not fit on {}, which has columns 0 to {}".format(
+                num_cols, col_offset, dev.name, dev.n_cols - 1
+            )
+        )
+    return list(range(col_offset, col_offset + num_cols))
@@ -5,22 +5,86 @@
 #
 # (c) Copyright 2023 AMD Inc.
 
+import argparse
+import os
+import sys
+
 from aie.extras.context import mlir_mod_ctx
 
 from aie.dialects.aie import *
 from aie.dialects.aiex import *
 from aie.dialects.scf import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from devices import devices, placement
+
+# Data memory of a compute tile (which also holds the core's stack) and of a
+# memory tile.
+l1_bytes = 64 * 1024
+l1_stack_bytes = 1024
+l2_bytes = 512 * 1024
+
+# DMA channels per direction of a memory tile
+mem_tile_channels = 6
 
-def my_matmul():
-    M = 288
-    K = 288
+
+def my_matmul(
+    M=288,
+    K=288,
+    fifo_depth=2,
+    mem_fifo_depth=2,
+    acquire_size=1,
+    device_name="npu1_4col",
+    col_offset=0,
+    stripes=1,
+    num_cols=1,
+):
     m = 32
     k = 32
     word_size_in = 2
     word_size_out = 4
 
-    n_cores = 1
+    # One core per column, each taking its own slice of the rows of A
+    n_cores = num_cols
+    # Core i is in column cols[i]; the shims of the following columns, up to
+    # `stripes` in total, help with reading its A tiles.
+    dev = devices[device_name]
+    cols = placement(dev, col_offset, max(n_cores, stripes))
+
+    if not 1 <= acquire_size <= fifo_depth or mem_fifo_depth < 1:
+        raise ValueError("FIFO depths must be at least 1 and at least the acquire size")
+    if K % (k * acquire_size) != 0:
+        raise ValueError("K must be a multiple of k * acquire_size")
+    if stripes > mem_tile_channels:
+        raise ValueError(
+            "{} stripes of A need {} channels into the memory tile, which only "
+            "has {}".format(stripes, stripes, mem_tile_channels)
+        )
+    if m % stripes != 0:
+        raise ValueError("m must be a multiple of the number of stripes")
+    if stripes > 1 and n_cores > 1:
+        raise ValueError(
+            "striped A needs the shim channels of the neighbouring columns, so "
+            "it only supports a single column of cores"
+        )
+    if M % (m * n_cores) != 0:
+        raise ValueError("M must be a multiple of m * the number of columns")
+    # The core holds fifo_depth A tiles and B slices and two C tiles; the
+    # linked A FIFOs share their buffers in the memory tile.
+    l1_footprint = fifo_depth * (m * k + k) * word_size_in + 2 * m * word_size_out
+    l2_footprint = max(fifo_depth, mem_fifo_depth) * m * k * word_size_in
+    if l1_footprint > l1_bytes - l1_stack_bytes:
+        raise ValueError(
+            "the core buffers need {} bytes, but a compute tile only has {}".format(
+                l1_footprint, l1_bytes - l1_stack_bytes
+            )
+        )
+    if l2_footprint > l2_bytes:
+        raise ValueError(
+            "the memory tile buffers need {} bytes, but a memory tile only has {}".format(
+                l2_footprint, l2_bytes
+            )
+        )
 
     A_sz_in_i32s = M * K * word_size_in // 4
     B_sz_in_i32s = K * word_size_in // 4
@@ -42,9 +106,9 @@ def my_matmul():
 
     with mlir_mod_ctx() as ctx:
 
-        @device(AIEDevice.npu1_4col)
+        @device(getattr(AIEDevice, dev.name))
         def device_body():
-            memRef_inA_ty = T.memref(m * k, T.bf16())
+            memRef_inA_ty = T.memref(m * k // stripes, T.bf16())
             memRef_inB_ty = T.memref(k, T.bf16())
             memRef_outC_ty = T.memref(m, T.f32())
             memRef_A_ty = T.memref(m, k, T.bf16())
@@ -62,45 +126,44 @@ def my_matmul():
             )
 
             # Tile declarations
-            ShimTile0 = tile(0, 0)
-            ShimTile1 = tile(1, 0)
-            ShimTile2 = tile(2, 0)
-            ShimTile3 = tile(3, 0)
-            ShimTiles = [ShimTile0, ShimTile1, ShimTile2, ShimTile3]
-            MemTile0 = tile(0, 1)
-            MemTile1 = tile(1, 1)
-            MemTile2 = tile(2, 1)
-            MemTile3 = tile(3, 1)
-            MemTiles = [MemTile0, MemTile1, MemTile2, MemTile3]
-            ComputeTile0 = tile(0, 2)
-            ComputeTile1 = tile(1, 2)
-            ComputeTile2 = tile(2, 2)
-            ComputeTile3 = tile(3, 2)
-            cores = [ComputeTile0, ComputeTile1, ComputeTile2, ComputeTile3]
-            memA_fifo_names = ["memA0", "memA1", "memA2", "memA3"]
+            ShimTiles = [tile(col, dev.shim_row) for col in cols]
+            MemTiles = [tile(col, dev.mem_row) for col in cols[:n_cores]]
+            cores = [tile(col, dev.core_row) for col in cols[:n_cores]]
+            # Stripe j of the A tiles of core i, their j-th share of rows, is
+            # read through the shim j columns further on, so that every
+            # stripe has an MM2S channel of its own. The memory tile joins
+            # the stripes into whole tiles.
+            if stripes == 1:
+                memA_fifo_names = [["memA{}".format(i)] for i in range(n_cores)]
+            else:
+                memA_fifo_names = [
+                    ["memA{}_{}".format(i, j) for j in range(stripes)]
+                    for i in range(n_cores)
+                ]
             memA_fifos = {}
-            inA_fifo_names = ["inA0", "inA1", "inA2", "inA3"]
+            inA_fifo_names = ["inA{}".format(i) for i in range(n_cores)]
             inA_fifos = {}
             inB_fifo_names = ["inB"]
             inB_fifos = {}
-            outC_fifo_names = ["outC0", "outC1", "outC2", "outC3"]
+            outC_fifo_names = ["outC{}".format(i) for i in range(n_cores)]
             outC_fifos = {}
 
             # AIE-array data movement with object fifos
             # Input A
             for i in range(n_cores):
-                memA_fifos[memA_fifo_names[i]] = object_fifo(
-                    memA_fifo_names[i],
-                    ShimTiles[i],
-                    MemTiles[i],
-                    2,
-                    memRef_inA_ty,
-                )
+                for j, name in enumerate(memA_fifo_names[i]):
+                    memA_fifos[name] = object_fifo(
+                        name,
+                        ShimTiles[(i + j) % len(cols)],
+                        MemTiles[i],
+                        mem_fifo_depth,
+                        memRef_inA_ty,
+                    )
                 inA_fifos[inA_fifo_names[i]] = object_fifo(
                     inA_fifo_names[i],
                     MemTiles[i],
                     cores[i],
-                    2,
+                    fifo_depth,
                     memRef_A_ty,
                     [
                         (k // 2 // 2, 2),
@@ -108,8 +171,10 @@ def my_matmul():
                         (2, 1),
                     ],  # transpose at 4-byte (2xbf16) granularity
                 )
+                stripe_fifos = [memA_fifos[name] for name in memA_fifo_names[i]]
                 object_fifo_link(
-                    memA_fifos[memA_fifo_names[i]], inA_fifos[inA_fifo_names[i]]
+                    stripe_fifos if stripes > 1 else stripe_fifos[0],
+                    inA_fifos[inA_fifo_names[i]],
                 )
 
             # Input B
@@ -117,7 +182,7 @@ def my_matmul():
                 inB_fifo_names[0],
                 ShimTiles[1 % n_cores],
                 cores[0:n_cores],
-                2,
+                fifo_depth,
                 memRef_inB_ty,
             )
 
@@ -143,23 +208,27 @@ def my_matmul():
                         )
                         call(zero, [elem_out])
 
-                        for _ in for_(K_div_k):
-                            elem_in_a = inA_fifos[inA_fifo_names[i]].acquire(
+                        for _ in for_(K_div_k // acquire_size):
+                            elems_in_a = inA_fifos[inA_fifo_names[i]].acquire(
                                 ObjectFifoPort.Consume,
-                                1,
+                                acquire_size,
                             )
-                            elem_in_b = inB_fifos[inB_fifo_names[0]].acquire(
+                            elems_in_b = inB_fifos[inB_fifo_names[0]].acquire(
                                 ObjectFifoPort.Consume,
-                                1,
+                                acquire_size,
                             )
-                            call(matvec, [elem_in_a, elem_in_b, elem_out])
+                            if acquire_size == 1:
+                                elems_in_a = [elems_in_a]
+                                elems_in_b = [elems_in_b]
+                            for elem_in_a, elem_in_b in zip(elems_in_a, elems_in_b):
+                                call(matvec, [elem_in_a, elem_in_b, elem_out])
                             inA_fifos[inA_fifo_names[i]].release(
                                 ObjectFifoPort.Consume,
-                                1,
+                                acquire_size,
                             )
                             inB_fifos[inB_fifo_names[0]].release(
                                 ObjectFifoPort.Consume,
-                                1,
+                                acquire_size,
                             )
                             yield_([])
 
@@ -187,14 +256,20 @@ def my_matmul():
                 for i in range(n_cores):
                     A_offset = i * M_div_m_div_n_cores * m * K * word_size_in // 4
                     C_offset = i * M_div_m_div_n_cores * m * word_size_out // 4
-                    npu_dma_memcpy_nd(
-                        metadata=memA_fifo_names[i],
-                        bd_id=1,
-                        mem=A,
-                        offsets=[0, 0, 0, A_offset],
-                        sizes=[M_div_m_div_n_cores, K_div_k, m, k_in_i32s],
-                        strides=[m_x_K_in_i32s, k_in_i32s, K_in_i32s],
-                    )
+                    for j, name in enumerate(memA_fifo_names[i]):
+                        npu_dma_memcpy_nd(
+                            metadata=name,
+                            bd_id=1,
+                            mem=A,
+                            offsets=[0, 0, 0, A_offset + j * m // stripes * K_in_i32s],
+                            sizes=[
+                                M_div_m_div_n_cores,
+                                K_div_k,
+                                m // stripes,
+                                k_in_i32s,
+                            ],
+                            strides=[m_x_K_in_i32s, k_in_i32s, K_in_i32s],
+                        )
                     npu_dma_memcpy_nd(
                         metadata=outC_fifo_names[i],
                         bd_id=0,
@@ -204,10 +279,75 @@ def my_matmul():
                         strides=[0, 0, 0],
                     )
 
-                for i in range(n_cores):
-                    npu_sync(column=i, row=0, direction=0, channel=0)
+                for col in cols[:n_cores]:
+                    npu_sync(column=col, row=dev.shim_row, direction=0, channel=0)
 
     print(ctx.module)
 
 
-my_matmul()
+argparser = argparse.ArgumentParser(
+    prog="AIE Matrix Vector Multiplication MLIR Design",
+    description="Emits MLIR code for a matrix vector multiplication design of the given input size",
+)
+argparser.add_argument("-M", type=int, default=288)
+argparser.add_argument("-K", type=int, default=288)
+argparser.add_argument("-N", type=int, default=1)
+argparser.add_argument(
+    "--fifo-depth",
+    type=int,
+    default=2,
+    help="depth of the A and B FIFOs into the cores",
+)
+argparser.add_argument(
+    "--mem-fifo-depth",
+    type=int,
+    default=2,
+    help="depth of the A FIFOs from the shims to the memory tiles",
+)
+argparser.add_argument(
+    "--acquire-size",
+    type=int,
+    default=1,
+    help="A tiles and B slices acquired per iteration of the K loop",
+)
+argparser.add_argument(
+    "--device",
+    choices=devices,
+    default="npu1_4col",
+    help="device to generate the design for",
+)
+argparser.add_argument(
+    "--col-offset",
+    type=int,
+    default=0,
+    help="first column of the device to use, leaving the others to designs "
+    "running concurrently",
+)
+argparser.add_argument(
+    "--stripes",
+    type=int,
+    default=1,
+    help="read A through the shims of this many neighbouring columns, to "
+    "spread it over more shim DMA channels",
+)
+argparser.add_argument(
+    "--num-cols",
+    type=int,
+    default=1,
+    help="columns to use, one core each, among which the rows of A are split",
+)
+args = argparser.parse_args()
+try:
+    my_matmul(
+        args.M,
+        args.K,
+        args.fifo_depth,
+        args.mem_fifo_depth,
+        args.acquire_size,
+        args.device,
+        args.col_offset,
+        args.stripes,
+        args.num_cols,
+    )
+except ValueError as e:
+    argparser.error(str(e))
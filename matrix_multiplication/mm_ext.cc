@@ -0,0 +1,295 @@
+//===- mm_ext.cc -------------------------------------------------*- C++ -*-===//
+//
+// This file is licensed under the Apache License v2.0 with LLVM Exceptions.
+// See https://llvm.org/LICENSE.txt for license information.
+// SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+//
+// Copyright (C) 2024, Advanced Micro Devices, Inc.
+//
+//===----------------------------------------------------------------------===//
+
+// Kernels used by the whole-array design in addition to those in mm.cc,
+// which is included so that a core still links a single object.
+//
+// Split-K mode: each core of a column computes a partial C tile over its
+// share of K with the regular matmul kernels. The partial tiles are then
+// summed up over the cascade interface: the top core of the column puts its
+// tile, the cores in between add the incoming tile to their own and pass the
+// sum on, and the bottom core adds the incoming tile to its own, which then
+// holds the result.
+//
+// Accumulate mode: instead of zeroing it, a core initializes its C tile with
+// the existing C tile streamed in from DDR, computing C += A * B.
+//
+// Epilogue: before releasing a finished C tile, a core can add the bias
+// values of the tile's columns to every row and apply an activation
+// function, so that C leaves the array only once.
+//
+// Transposed operands: the DMAs can only rearrange whole 32-bit words, so
+// for a transposed A, B or C they deliver (or expect) the tile's r x s,
+// s x t or r x t blocks transposed. The cores transpose each block in place.
+//
+// Performance counters: a core reads the tile timer, which the runtime
+// sequence resets at the start of every launch, before and after each
+// matmul kernel call. At the end of the launch, it stores its counters in a
+// C tile that the design writes after C.
+
+#include "mm.cc"
+
+// One 512-bit cascade word
+constexpr unsigned cascade_lanes = 32;
+
+template <unsigned M, unsigned N>
+static inline void cascade_put(bfloat16 *__restrict c) {
+  static_assert((M * N) % cascade_lanes == 0);
+  event0();
+  for (unsigned i = 0; i < M * N; i += cascade_lanes)
+    chess_prepare_for_pipelining {
+      aie::vector<bfloat16, cascade_lanes> v =
+          aie::load_v<cascade_lanes>(c + i);
+      put_mcd(v.cast_to<int32>());
+    }
+  event1();
+}
+
+template <unsigned M, unsigned N, bool put>
+static inline void cascade_get_add(bfloat16 *__restrict c) {
+  static_assert((M * N) % cascade_lanes == 0);
+  event0();
+  for (unsigned i = 0; i < M * N; i += cascade_lanes)
+    chess_prepare_for_pipelining {
+      aie::vector<bfloat16, cascade_lanes> in =
+          aie::vector<int32, cascade_lanes / 2>(get_scd_v16int32())
+              .cast_to<bfloat16>();
+      aie::accum<accfloat, cascade_lanes> acc;
+      acc.from_vector(aie::load_v<cascade_lanes>(c + i));
+      acc = aie::add(acc, in);
+      aie::vector<bfloat16, cascade_lanes> sum = acc.to_vector<bfloat16>();
+      aie::store_v(c + i, sum);
+      if constexpr (put) {
+        put_mcd(sum.cast_to<int32>());
+      }
+    }
+  event1();
+}
+
+template <typename T, unsigned M, unsigned N>
+static inline void copy(T *__restrict in, T *__restrict out) {
+  constexpr unsigned lanes = 32;
+  static_assert((M * N) % lanes == 0);
+  event0();
+  for (unsigned i = 0; i < M * N; i += lanes)
+    chess_prepare_for_pipelining {
+      aie::store_v(out + i, aie::load_v<lanes>(in + i));
+    }
+  event1();
+}
+
+// The C tile is stored in r x t blocks (see matmul_vectorized in mm.cc), so
+// the bias values of a block column repeat every t elements of its blocks.
+template <typename T, unsigned M, unsigned N, unsigned r, unsigned t>
+static inline void add_bias(T *__restrict bias, T *__restrict c) {
+  constexpr unsigned lanes = r * t;
+  static_assert(M % r == 0 && N % t == 0);
+  event0();
+  for (unsigned col = 0; col < N; col += t) {
+    aie::vector<T, lanes> b;
+    for (unsigned i = 0; i < lanes; i++) {
+      b.set(bias[col + i % t], i);
+    }
+    T *__restrict c_ptr = c + col * r;
+    for (unsigned row = 0; row < M; row += r)
+      chess_prepare_for_pipelining {
+        aie::vector<T, lanes> v = aie::load_v<lanes>(c_ptr);
+        if constexpr (std::is_same<T, bfloat16>::value) {
+          aie::accum<accfloat, lanes> acc;
+          acc.from_vector(v);
+          v = aie::add(acc, b).template to_vector<T>();
+        } else {
+          v = aie::add(v, b);
+        }
+        aie::store_v(c_ptr, v);
+        c_ptr += N * r; // next row of blocks
+      }
+  }
+  event1();
+}
+
+template <typename T, unsigned M, unsigned N>
+static inline void relu(T *__restrict c) {
+  constexpr unsigned lanes = 512 / 8 / sizeof(T);
+  static_assert((M * N) % lanes == 0);
+  event0();
+  for (unsigned i = 0; i < M * N; i += lanes)
+    chess_prepare_for_pipelining {
+      aie::store_v(c + i, aie::max(aie::load_v<lanes>(c + i),
+                                   aie::zeros<T, lanes>()));
+    }
+  event1();
+}
+
+// GELU(x) = x * Phi(x), with the standard normal CDF Phi approximated by
+// the hard sigmoid clamp(0.5 + 0.3404 x, 0, 1). This avoids transcendental
+// functions and stays within 0.11 of the exact GELU. apply_epilogue in
+// common.h computes the same approximation (gelu_slope), with the same bf16
+// roundings, so that the host reference matches it exactly.
+template <unsigned M, unsigned N>
+static inline void gelu(bfloat16 *__restrict c) {
+  constexpr unsigned lanes = 32;
+  static_assert((M * N) % lanes == 0);
+  const aie::vector<bfloat16, lanes> half =
+      aie::broadcast<bfloat16, lanes>(0.5f);
+  event0();
+  for (unsigned i = 0; i < M * N; i += lanes)
+    chess_prepare_for_pipelining {
+      aie::vector<bfloat16, lanes> x = aie::load_v<lanes>(c + i);
+      aie::accum<accfloat, lanes> acc = aie::mul(x, bfloat16(0.3404f));
+      aie::vector<bfloat16, lanes> phi =
+          aie::add(acc, half).template to_vector<bfloat16>();
+      phi = aie::min(aie::max(phi, aie::zeros<bfloat16, lanes>()),
+                     aie::broadcast<bfloat16, lanes>(1.0f));
+      aie::store_v(c + i, aie::mul(x, phi).template to_vector<bfloat16>());
+    }
+  event1();
+}
+
+// Transpose each row-major rows x cols block of a tile of the given size
+template <typename T, unsigned size, unsigned rows, unsigned cols>
+static inline void transpose_blocks(T *__restrict x) {
+  constexpr unsigned lanes = rows * cols;
+  static_assert(size % lanes == 0);
+  event0();
+  for (unsigned i = 0; i < size; i += lanes)
+    chess_prepare_for_pipelining {
+      aie::store_v(x + i,
+                   aie::transpose(aie::load_v<lanes>(x + i), rows, cols));
+    }
+  event1();
+}
+
+// Counters of a launch: cycles spent in the matmul kernel, kernel calls,
+// and the timer at the start of the first and the end of the last call
+constexpr unsigned n_perf_counters = 4;
+
+// Store the counters as 32-bit words at the start of the first row of a C
+// tile, which is stored in r x t blocks; the memory tile turns the blocks
+// into rows on the way out. Then reset them for the next launch.
+template <typename T, unsigned N, unsigned r, unsigned t>
+static inline void perf_store(uint32_t *counters, T *__restrict c) {
+  constexpr unsigned per_word = sizeof(uint32_t) / sizeof(T);
+  static_assert(n_perf_counters * per_word <= N);
+  const T *words = reinterpret_cast<const T *>(counters);
+  for (unsigned col = 0; col < n_perf_counters * per_word; col++) {
+    c[col / t * r * t + col % t] = words[col];
+  }
+  for (unsigned i = 0; i < n_perf_counters; i++) {
+    counters[i] = 0;
+  }
+}
+
+extern "C" {
+
+void copy_bf16(bfloat16 *c_in, bfloat16 *c_out) {
+  copy<bfloat16, DIM_M, DIM_N>(c_in, c_out);
+}
+
+void cascade_put_bf16(bfloat16 *c_in) { cascade_put<DIM_M, DIM_N>(c_in); }
+
+void cascade_get_add_put_bf16(bfloat16 *c_in_out) {
+  cascade_get_add<DIM_M, DIM_N, true>(c_in_out);
+}
+
+void cascade_get_add_bf16(bfloat16 *c_in_out) {
+  cascade_get_add<DIM_M, DIM_N, false>(c_in_out);
+}
+
+// The bias kernels follow the C layout of the default intrinsic of each
+// input type.
+void add_bias_bf16_bf16(bfloat16 *bias, bfloat16 *c_in_out) {
+  add_bias<bfloat16, DIM_M, DIM_N, 4, 4>(bias, c_in_out);
+}
+
+void add_bias_i8_i32(int32 *bias, int32 *c_in_out) {
+  add_bias<int32, DIM_M, DIM_N, 4, 8>(bias, c_in_out);
+}
+
+void add_bias_i16_i32(int32 *bias, int32 *c_in_out) {
+  add_bias<int32, DIM_M, DIM_N, 4, 4>(bias, c_in_out);
+}
+
+void relu_bf16(bfloat16 *c_in_out) { relu<bfloat16, DIM_M, DIM_N>(c_in_out); }
+
+void relu_i32(int32 *c_in_out) { relu<int32, DIM_M, DIM_N>(c_in_out); }
+
+void gelu_bf16(bfloat16 *c_in_out) { gelu<DIM_M, DIM_N>(c_in_out); }
+
+// The transpose kernels turn the s x r blocks of a transposed A tile into
+// r x s blocks, the t x s blocks of a transposed B tile into s x t blocks,
+// and the r x t blocks of a C tile into t x r blocks, for the default
+// intrinsic of each input type.
+void transpose_a_bf16(bfloat16 *a) {
+  transpose_blocks<bfloat16, DIM_M * DIM_K, 8, 4>(a);
+}
+
+void transpose_b_bf16(bfloat16 *b) {
+  transpose_blocks<bfloat16, DIM_K * DIM_N, 4, 8>(b);
+}
+
+void transpose_c_bf16_bf16(bfloat16 *c) {
+  transpose_blocks<bfloat16, DIM_M * DIM_N, 4, 4>(c);
+}
+
+void transpose_a_i8(int8 *a) { transpose_blocks<int8, DIM_M * DIM_K, 8, 4>(a); }
+
+void transpose_b_i8(int8 *b) { transpose_blocks<int8, DIM_K * DIM_N, 8, 8>(b); }
+
+void transpose_c_i8_i32(int32 *c) {
+  transpose_blocks<int32, DIM_M * DIM_N, 4, 8>(c);
+}
+
+void transpose_a_i16(int16 *a) {
+  transpose_blocks<int16, DIM_M * DIM_K, 4, 4>(a);
+}
+
+void transpose_b_i16(int16 *b) {
+  transpose_blocks<int16, DIM_K * DIM_N, 4, 4>(b);
+}
+
+void transpose_c_i16_i32(int32 *c) {
+  transpose_blocks<int32, DIM_M * DIM_N, 4, 4>(c);
+}
+
+void perf_reset(uint32_t *counters) {
+  for (unsigned i = 0; i < n_perf_counters; i++) {
+    counters[i] = 0;
+  }
+}
+
+// Called before and after every matmul kernel call. Between the calls,
+// counters[3] holds the start of the current one.
+void perf_start(uint32_t *counters) {
+  uint32_t now = get_cycles();
+  if (counters[1] == 0) {
+    counters[2] = now;
+  }
+  counters[3] = now;
+}
+
+void perf_stop(uint32_t *counters) {
+  uint32_t now = get_cycles();
+  counters[0] += now - counters[3];
+  counters[1]++;
+  counters[3] = now;
+}
+
+// Only the first r x t block of an int32 C tile is used, which has the same
+// layout for the default intrinsics of i8 and i16.
+void perf_store_bf16(uint32_t *counters, bfloat16 *c) {
+  perf_store<bfloat16, DIM_N, 4, 4>(counters, c);
+}
+
+void perf_store_i32(uint32_t *counters, int32 *c) {
+  perf_store<int32, DIM_N, 4, 4>(counters, c);
+}
+
+} // extern "C"
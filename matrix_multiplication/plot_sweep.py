@@ -62,10 +62,28 @@ def throughput(ys):
     return float(n_bytes) / (np.mean(ts) / 1e6)
 
 
+def channel_throughput(ys):
+    # Bytes of A and B read per second and shim MM2S channel, with A and B
+    # each striped across the channels of `stripes` shims (see --stripes of
+    # single_core). Compare with the bandwidth assumed by the roofline.
+    M, K, N, stripes, *ts = ys
+    dtype_size = 2
+    n_bytes = (M * K + K * N) * dtype_size
+    return float(n_bytes) / (np.mean(ts) / 1e6) / (2 * stripes)
+
+
 def efficiency(ys):
     return tflops_per_s(ys) / 4.096 * 100
 
 
+def grid_efficiency(ys):
+    # Efficiency relative to the peak of the sub-array actually used, so
+    # different grid shapes can be compared for scaling.
+    M, K, N, n_rows, n_cols, *ts = ys
+    peak_per_core = 4.096 / 16
+    return tflops_per_s([M, K, N, *ts]) / (peak_per_core * n_rows * n_cols) * 100
+
+
 transforms = {
     "prod": np.prod,
     "sum": sum,
@@ -76,7 +94,9 @@ transforms = {
     "gflops": gflops_per_s,
     "tflops": tflops_per_s,
     "thru": throughput,
+    "chanthru": channel_throughput,
     "eff": efficiency,
+    "grideff": grid_efficiency,
 }
 
 
@@ -97,6 +117,16 @@ def get_args():
     argparser.add_argument("--filter", type=str, action="append", default=[])
     argparser.add_argument("--xlog", action="store_true", default=False)
     argparser.add_argument("--ylog", action="store_true", default=False)
+    argparser.add_argument(
+        "--channel-bandwidth",
+        type=float,
+        default=2.0,
+        help="roofline bandwidth of a shim DMA channel [GB/s], e.g. as measured "
+        "with --ytrans chanthru",
+    )
+    argparser.add_argument(
+        "--n-channels", type=int, default=8, help="shim DMA channels of the roofline"
+    )
     args = argparser.parse_args()
     if not args.xnames:
         args.xnames = ["M", "K", "N"]
@@ -118,8 +148,12 @@ def get_args():
             args.ylabel = "TFLOP/s"
         elif args.ytrans == "thru":
             args.ylabel = "Throughput [bytes/s]"
+        elif args.ytrans == "chanthru":
+            args.ylabel = "Input Throughput per Shim Channel [bytes/s]"
         elif args.ytrans == "eff":
             args.ylabel = "Percent Throughput Efficiency [achieved/peak]"
+        elif args.ytrans == "grideff":
+            args.ylabel = "Percent Sub-Array Efficiency [achieved/peak]"
     if args.output is None:
         args.output = "{0}.{1}".format(
             os.path.basename(args.input.name), args.outputfmt
@@ -134,6 +168,10 @@ def get_args():
             args.ynames = iteration_ys
         elif args.ytrans in {"macs", "gflops", "tflops", "thru", "eff"}:
             args.ynames = ["M", "K", "N"] + iteration_ys
+        elif args.ytrans == "grideff":
+            args.ynames = ["M", "K", "N", "Rows", "Cols"] + iteration_ys
+        elif args.ytrans == "chanthru":
+            args.ynames = ["M", "K", "N", "Stripes"] + iteration_ys
     args.xtrans = transforms[args.xtrans]
     args.ytrans = transforms[args.ytrans]
     return args
@@ -182,12 +220,11 @@ def plot(ax, xs, ys, title, xlabel, ylabel, xlog=False, ylog=False):
         ax.set_yscale("log")
 
 
-def plot_max(ax, xs, ys, xtrans, ytrans):
+def plot_max(ax, xs, ys, xtrans, ytrans, channel_bandwidth=2.0, n_channels=8):
     """Draw the roofline"""
 
-    bandwidth = 2e9  # 2 GB/s peak memory bandwidth per channel
+    bandwidth = channel_bandwidth * 1e9  # peak memory bandwidth per channel
     max_flops = 1e12  # 1 TFLOP/s / core for bf16
-    n_channels = 8
     n_cores = 4
 
     max_flops *= n_cores
@@ -239,7 +276,15 @@ def main():
     )
     fig, ax = plt.subplots()
     plot(ax, xs, ys, args.title, args.xlabel, args.ylabel, args.xlog, args.ylog)
-    plot_max(ax, xs, ys, args.xtrans, args.ytrans)
+    plot_max(
+        ax,
+        xs,
+        ys,
+        args.xtrans,
+        args.ytrans,
+        args.channel_bandwidth,
+        args.n_channels,
+    )
     plt.savefig(args.output, format=args.outputfmt)
 
 
@@ -0,0 +1,87 @@
+# matrix_multiplication/resources.py -*- Python -*-
+#
+# This file is licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+#
+# (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
+
+# Memories, DMA channels, buffer descriptors and locks of the array tiles, as
+# shared by the single-core and whole-array matmul generators.
+
+from aie.dialects.aiex import npu_sync
+
+# Data memory of a compute tile (which also holds the core's stack) and of a
+# memory tile.
+l1_bytes = 64 * 1024
+l1_stack_bytes = 1024
+l2_bytes = 512 * 1024
+
+# DMA channels per direction of a memory tile
+mem_tile_channels = 6
+
+# Iterations of the outermost (repeat) dimension of a shim BD
+dma_max_repeat = 64
+
+# In the runtime-shape mode, the sequence writes the loop trip counts of a
+# core into a runtime parameter buffer on the core and then sets a lock, which
+# the core acquires before reading them at the start of every launch. The lock
+# has a fixed ID, so that the sequence can address its value register.
+rtp_lock_id = 15
+lock_value_address = 0x1F000  # of lock 0; one register every 0x10 bytes
+
+
+def check_footprint(l1_footprint, l2_footprint):
+    if l1_footprint > l1_bytes - l1_stack_bytes:
+        raise ValueError(
+            "the core buffers need {} bytes, but a compute tile only has {}".format(
+                l1_footprint, l1_bytes - l1_stack_bytes
+            )
+        )
+    if l2_footprint > l2_bytes:
+        raise ValueError(
+            "the memory tile buffers need {} bytes, but a memory tile only has {}".format(
+                l2_footprint, l2_bytes
+            )
+        )
+
+
+class BDPool:
+    """Hands out the buffer descriptors (BDs) of one shim tile.
+
+    A BD may only be reused once the transfer using it has completed. The
+    input BDs of a block of tile rows are grouped with the output transfer of
+    the same block: once that output has been synchronized on, all of the
+    block's inputs have been consumed as well, and the whole group returns to
+    the pool. Syncs are only emitted when the pool runs dry, so the inputs of
+    the next block are issued while the output of the current one drains.
+    """
+
+    def __init__(self, column, n_bds=16, reserved=()):
+        self.column = column
+        self.n_bds = n_bds
+        self.n_reserved = len(set(reserved) & set(range(n_bds)))
+        self.free = [bd for bd in range(n_bds) if bd not in reserved]
+        self.in_flight = []
+
+    def acquire(self, count):
+        if count > self.n_bds - self.n_reserved:
+            raise ValueError(
+                "a block needs {} BDs, but shim {} only has {}, of which {} are "
+                "in use by other transfers".format(
+                    count, self.column, self.n_bds, self.n_reserved
+                )
+            )
+        while len(self.free) < count:
+            self.sync_oldest()
+        bds, self.free = self.free[:count], self.free[count:]
+        self.in_flight.append(bds)
+        return bds
+
+    def sync_oldest(self):
+        npu_sync(column=self.column, row=0, direction=0, channel=0)
+        self.free += self.in_flight.pop(0)
+
+    def drain(self):
+        while self.in_flight:
+            self.sync_oldest()
@@ -5,25 +5,104 @@
 #
 # (c) Copyright 2023 AMD Inc.
 
+import argparse
+import os
+import sys
+
 from aie.dialects.aie import *
 from aie.dialects.aiex import *
 from aie.dialects.scf import *
 from aie.extras.context import mlir_mod_ctx
+from aie.extras.dialects.ext import arith, memref
 import aie.utils.trace as trace_utils
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from devices import devices, npu1_partition, placement
+from resources import (
+    BDPool,
+    check_footprint,
+    dma_max_repeat,
+    lock_value_address,
+    mem_tile_channels,
+    rtp_lock_id,
+)
+
 
-def my_matmul():
-    M = 256
-    K = 256
-    N = 256
-    m = 64
-    k = 64
-    n = 64
+def my_matmul(
+    M=256,
+    K=256,
+    N=256,
+    *,
+    m=64,
+    k=64,
+    n=64,
+    n_bds=16,
+    blocks_in_flight=2,
+    fifo_depth=2,
+    mem_fifo_depth=2,
+    acquire_size=1,
+    compact_sequence=False,
+    runtime_shape=False,
+    device_name=None,
+    col_offset=0,
+    stripes=1,
+    repeat=1,
+):
+    # A and B are read through the shims of the first `stripes` columns from
+    # col_offset on; the core and memory tile are in the first of them. By
+    # default, the design is generated for the smallest npu1 partition that
+    # has these columns.
+    if device_name is None:
+        dev = npu1_partition(min(max(col_offset + stripes, 1), 4))
+    else:
+        dev = devices[device_name]
+    shim_cols = placement(dev, col_offset, stripes)
+    col = shim_cols[0]
+    word_size_in = 2
+    word_size_out = 2
+
+    # mm.cc only exports the bf16 matmul kernel for the 4x8x4 intrinsic
     r = 4
     s = 8
     t = 4
-    word_size_in = 2
-    word_size_out = 2
+    if m % r != 0 or k % s != 0 or n % t != 0:
+        raise ValueError("m, k, n must be multiples of r, s, t")
+    if not 1 <= acquire_size <= fifo_depth or mem_fifo_depth < 1:
+        raise ValueError("FIFO depths must be at least 1 and at least the acquire size")
+    # The memory tile receives the stripes of A and B and the C tiles
+    if 2 * stripes + 1 > mem_tile_channels:
+        raise ValueError(
+            "{} stripes of A and B need {} channels into the memory tile, which "
+            "only has {}".format(stripes, 2 * stripes + 1, mem_tile_channels)
+        )
+    if m % stripes != 0 or k % stripes != 0:
+        raise ValueError("m and k must be multiples of the number of stripes")
+    # The sequence can compute the whole product `repeat` times back to back,
+    # so that the host can divide the time of a launch by `repeat`.
+    if repeat < 1:
+        raise ValueError("the repeat count must be at least 1")
+    # Shapes that are not a multiple of the tiling are zero-padded by the host
+    # (see pack_padded in common.h); the design works on the padded shape.
+    # The K loop consumes acquire_size tiles per iteration.
+    M_pad = -(-M // m) * m
+    K_pad = -(-K // (k * acquire_size)) * k * acquire_size
+    N_pad = -(-N // n) * n
+    if (M_pad, K_pad, N_pad) != (M, K, N):
+        overhead = (M_pad * K_pad * N_pad) / (M * K * N) - 1
+        sys.stderr.write(
+            "Padding {}x{}x{} to {}x{}x{} ({:.1f}% extra MACs)\n".format(
+                M, K, N, M_pad, K_pad, N_pad, overhead * 100
+            )
+        )
+    M, K, N = M_pad, K_pad, N_pad
+
+    # The core holds fifo_depth A and B tiles and two C tiles; linked FIFOs
+    # share their buffers in the memory tile, sized for the deeper of the two.
+    check_footprint(
+        fifo_depth * (m * k + k * n) * word_size_in + 2 * m * n * word_size_out,
+        max(fifo_depth, mem_fifo_depth) * (m * k + k * n) * word_size_in
+        + 2 * m * n * word_size_out,
+    )
 
     vectorized = True
     enable_tracing = False
@@ -42,6 +121,7 @@ def my_matmul():
     # Matrix A: MxK, submatrices a: mxk
     k_in_i32s = k * word_size_in // 4
     K_in_i32s = K * word_size_in // 4
+    m_x_K_in_i32s = m * K * word_size_in // 4
 
     # Matrix B: KxN, submatrices b: kxn
     n_in_i32s = n * word_size_in // 4
@@ -55,7 +135,7 @@ def my_matmul():
 
     with mlir_mod_ctx() as ctx:
 
-        @device(AIEDevice.npu1_1col)
+        @device(getattr(AIEDevice, dev.name))
         def device_body():
             memref_a_ty = T.memref(m, k, T.bf16())
             memref_b_ty = T.memref(k, n, T.bf16())
@@ -73,23 +153,50 @@ def my_matmul():
                 inputs=[memref_a_ty, memref_b_ty, memref_c_ty],
             )
             matmul = external_func(
-                "matmul_bf16_bf16", inputs=[memref_a_ty, memref_b_ty, memref_c_ty]
+                "matmul_bf16_bf16",
+                inputs=[memref_a_ty, memref_b_ty, memref_c_ty],
             )
 
             # Tile declarations
-            shim_tile = tile(0, 0)
-            mem_tile = tile(0, 1)
-            compute_tile2_col, compute_tile2_row = 0, 2
+            shim_tiles = [tile(c, dev.shim_row) for c in shim_cols]
+            shim_tile = shim_tiles[0]
+            mem_tile = tile(col, dev.mem_row)
+            compute_tile2_col, compute_tile2_row = col, dev.core_row
             compute_tile2 = tile(compute_tile2_col, compute_tile2_row)
 
             # AIE-array data movement with object fifos
+            # Stripe i of A and B, the i-th share of the rows of each tile, is
+            # read through the shim of column shim_cols[i], so that every
+            # stripe has MM2S channels of its own. The memory tile joins the
+            # stripes into whole tiles.
+            def stripe_names(name):
+                if stripes == 1:
+                    return [name]
+                return ["{}{}".format(name, i) for i in range(stripes)]
+
+            def stripe_fifos(names, rows, cols):
+                return [
+                    object_fifo(
+                        name,
+                        shim,
+                        mem_tile,
+                        mem_fifo_depth,
+                        T.memref(rows // stripes, cols, T.bf16()),
+                    )
+                    for name, shim in zip(names, shim_tiles)
+                ]
+
+            def link_stripes(fifos, fifo):
+                object_fifo_link(fifos if stripes > 1 else fifos[0], fifo)
+
             # Input A
-            inA = object_fifo("inA", shim_tile, mem_tile, 2, memref_a_ty)
+            inA_names = stripe_names("inA")
+            inA = stripe_fifos(inA_names, m, k)
             memA = object_fifo(
                 "memA",
                 mem_tile,
                 compute_tile2,
-                2,
+                fifo_depth,
                 memref_a_ty,
                 [
                     (m // r, r * k),
@@ -98,15 +205,16 @@ def my_matmul():
                     (s, 1),
                 ],
             )
-            object_fifo_link(inA, memA)
+            link_stripes(inA, memA)
 
             # Input B
-            inB = object_fifo("inB", shim_tile, mem_tile, 2, memref_b_ty)
+            inB_names = stripe_names("inB")
+            inB = stripe_fifos(inB_names, k, n)
             memB = object_fifo(
                 "memB",
                 mem_tile,
                 compute_tile2,
-                2,
+                fifo_depth,
                 memref_b_ty,
                 [
                     (k // s, s * n),
@@ -115,7 +223,7 @@ def my_matmul():
                     (t, 1),
                 ],
             )
-            object_fifo_link(inB, memB)
+            link_stripes(inB, memB)
 
             # Output C
             memC = object_fifo("memC", compute_tile2, mem_tile, 2, memref_c_ty)
@@ -134,6 +242,14 @@ def my_matmul():
             )
             object_fifo_link(memC, outC)
 
+            # Runtime parameters: the number of output tiles of a launch and of
+            # K loop iterations per output tile
+            if runtime_shape:
+                rtp = buffer(compute_tile2, [2], T.i32(), name="rtp")
+                rtp_lock = lock(
+                    compute_tile2, lock_id=rtp_lock_id, init=0, sym_name="rtp_lock"
+                )
+
             # Set up a circuit-switched flow from core to shim for tracing information
             if enable_tracing:
                 flow(compute_tile2, WireBundle.Trace, 0, shim_tile, WireBundle.DMA, 1)
@@ -141,25 +257,44 @@ def my_matmul():
             # Set up compute tiles
 
             # Compute tile 2
-            @core(compute_tile2, "mm.o")
+            @core(compute_tile2, "mm_{}x{}x{}.o".format(m, k, n))
             def core_body():
                 for _ in for_(0xFFFFFFFF):
-                    for _ in for_(tiles):
+                    if runtime_shape:
+                        use_lock(rtp_lock, LockAction.AcquireGreaterEqual, value=1)
+                        tile_iters = arith.index_cast(
+                            memref.load(rtp, [0]), to=T.index()
+                        )
+                        K_iters = arith.index_cast(memref.load(rtp, [1]), to=T.index())
+                    else:
+                        tile_iters = tiles
+                        K_iters = K_div_k // acquire_size
+                    for _ in for_(tile_iters):
                         elem_out = memC.acquire(ObjectFifoPort.Produce, 1)
                         if vectorized:
                             call(zero, [elem_out])
                         else:
                             call(zero_scalar, [elem_out])
 
-                        for _ in for_(K_div_k):
-                            elem_in_a = memA.acquire(ObjectFifoPort.Consume, 1)
-                            elem_in_b = memB.acquire(ObjectFifoPort.Consume, 1)
-                            if vectorized:
-                                call(matmul, [elem_in_a, elem_in_b, elem_out])
-                            else:
-                                call(matmul_scalar, [elem_in_a, elem_in_b, elem_out])
-                            memA.release(ObjectFifoPort.Consume, 1)
-                            memB.release(ObjectFifoPort.Consume, 1)
+                        for _ in for_(K_iters):
+                            elems_in_a = memA.acquire(
+                                ObjectFifoPort.Consume, acquire_size
+                            )
+                            elems_in_b = memB.acquire(
+                                ObjectFifoPort.Consume, acquire_size
+                            )
+                            if acquire_size == 1:
+                                elems_in_a = [elems_in_a]
+                                elems_in_b = [elems_in_b]
+                            for elem_in_a, elem_in_b in zip(elems_in_a, elems_in_b):
+                                if vectorized:
+                                    call(matmul, [elem_in_a, elem_in_b, elem_out])
+                                else:
+                                    call(
+                                        matmul_scalar, [elem_in_a, elem_in_b, elem_out]
+                                    )
+                            memA.release(ObjectFifoPort.Consume, acquire_size)
+                            memB.release(ObjectFifoPort.Consume, acquire_size)
                             yield_([])
 
                         memC.release(ObjectFifoPort.Produce, 1)
@@ -174,6 +309,15 @@ def my_matmul():
                 T.memref(C_sz_in_i32s, T.i32()),
             )
             def sequence(A, B, C):
+                if runtime_shape:
+                    npu_rtp_write("rtp", 0, repeat * tiles)
+                    npu_rtp_write("rtp", 1, K_div_k // acquire_size)
+                    npu_write32(
+                        column=compute_tile2_col,
+                        row=compute_tile2_row,
+                        address=lock_value_address + 0x10 * rtp_lock_id,
+                        value=1,
+                    )
 
                 if enable_tracing:
                     trace_utils.configure_simple_tracing_aie2(
@@ -184,10 +328,101 @@ def my_matmul():
                         offset=C_sz_in_bytes,
                     )
 
-                # only do 5 tile rows at a time before synchronizing, so we can reuse BDs
-                rows_per_block = 5
-                for tile_row_block in range(
-                    (M_div_m + rows_per_block - 1) // rows_per_block
+                def load_striped(names, bd_id, mem, offset, sizes, strides):
+                    # Stripe i covers rows i * rows_per_stripe up to
+                    # (i + 1) * rows_per_stripe of every tile. Its shim uses
+                    # the same BD as the first shim, whose C transfer tells
+                    # when all stripes have been consumed.
+                    rows_per_stripe = sizes[2] // stripes
+                    for i, name in enumerate(names):
+                        npu_dma_memcpy_nd(
+                            metadata=name,
+                            bd_id=bd_id,
+                            mem=mem,
+                            offsets=[
+                                0,
+                                0,
+                                0,
+                                offset + i * rows_per_stripe * strides[2],
+                            ],
+                            sizes=[sizes[0], sizes[1], rows_per_stripe, sizes[3]],
+                            strides=strides,
+                        )
+
+                # Each block of tile rows needs one BD for C and two per tile
+                # row for A and B. Size the blocks so that blocks_in_flight of
+                # them fit into the shim's BDs at once; the BD used by the
+                # tracing configuration (bd_id 13 by default) is kept free.
+                reserved_bds = [13] if enable_tracing else []
+                bd_pool = BDPool(col, n_bds, reserved_bds)
+                rows_per_block = max(
+                    1, ((n_bds - len(reserved_bds)) // blocks_in_flight - 1) // 2
+                )
+                if compact_sequence:
+                    # Walk the output tiles column by column instead, in
+                    # blocks of tile columns sized the same way. Then the A
+                    # and B BDs of a tile column cover all tile rows (up to
+                    # the repeat limit of a BD), so the sequence and its syncs
+                    # grow with N, but no longer with M. The core does not
+                    # depend on the order of the output tiles.
+                    cols_per_block = rows_per_block
+                    rows_per_chunk = min(M_div_m, dma_max_repeat)
+                    for row_chunk in (
+                        list(range((M_div_m + rows_per_chunk - 1) // rows_per_chunk))
+                        * repeat
+                    ):
+                        num_tile_rows = min(
+                            rows_per_chunk, M_div_m - row_chunk * rows_per_chunk
+                        )
+                        first_row = row_chunk * rows_per_chunk
+                        for tile_col_block in range(
+                            (N_div_n + cols_per_block - 1) // cols_per_block
+                        ):
+                            first_col = tile_col_block * cols_per_block
+                            num_tile_cols = min(cols_per_block, N_div_n - first_col)
+                            bds = bd_pool.acquire(1 + 2 * num_tile_cols)
+                            npu_dma_memcpy_nd(
+                                metadata="outC",
+                                bd_id=bds[0],
+                                mem=C,
+                                offsets=[
+                                    0,
+                                    0,
+                                    0,
+                                    first_row * m_x_N_in_i32s_out
+                                    + first_col * n_in_i32s_out,
+                                ],
+                                sizes=[num_tile_cols, num_tile_rows, m, n_in_i32s_out],
+                                strides=[
+                                    n_in_i32s_out,
+                                    m_x_N_in_i32s_out,
+                                    N_in_i32s_out,
+                                ],
+                            )
+                            for tile_col in range(num_tile_cols):
+                                load_striped(
+                                    inA_names,
+                                    bds[2 * tile_col + 1],
+                                    A,
+                                    first_row * m_x_K_in_i32s,
+                                    [num_tile_rows, K_div_k, m, k_in_i32s],
+                                    [m_x_K_in_i32s, k_in_i32s, K_in_i32s],
+                                )
+                                load_striped(
+                                    inB_names,
+                                    bds[2 * tile_col + 2],
+                                    B,
+                                    (first_col + tile_col) * n_in_i32s,
+                                    [num_tile_rows, K_div_k, k, n_in_i32s],
+                                    [0, k_x_N_in_i32s, N_in_i32s],
+                                )
+                    bd_pool.drain()
+                    return
+
+                # The whole product is computed `repeat` times over.
+                for tile_row_block in (
+                    list(range((M_div_m + rows_per_block - 1) // rows_per_block))
+                    * repeat
                 ):
                     C_row_offset_in_i32s = (
                         tile_row_block * rows_per_block * m * N * word_size_out // 4
@@ -195,9 +430,10 @@ def my_matmul():
                     num_tile_rows = min(
                         [rows_per_block, M_div_m - tile_row_block * rows_per_block]
                     )
+                    bds = bd_pool.acquire(1 + 2 * num_tile_rows)
                     npu_dma_memcpy_nd(
                         metadata="outC",
-                        bd_id=0,
+                        bd_id=bds[0],
                         mem=C,
                         offsets=[0, 0, 0, C_row_offset_in_i32s],
                         sizes=[num_tile_rows, N_div_n, m, n_in_i32s_out],
@@ -211,25 +447,134 @@ def my_matmul():
                             * word_size_in
                             // 4
                         )
-                        npu_dma_memcpy_nd(
-                            metadata="inA",
-                            bd_id=2 * tile_row + 1,
-                            mem=A,
-                            offsets=[0, 0, 0, A_row_offset_in_i32s],
-                            sizes=[N_div_n, K_div_k, m, k_in_i32s],
-                            strides=[0, k_in_i32s, K_in_i32s],
+                        load_striped(
+                            inA_names,
+                            bds[2 * tile_row + 1],
+                            A,
+                            A_row_offset_in_i32s,
+                            [N_div_n, K_div_k, m, k_in_i32s],
+                            [0, k_in_i32s, K_in_i32s],
                         )
-                        npu_dma_memcpy_nd(
-                            metadata="inB",
-                            bd_id=2 * tile_row + 2,
-                            mem=B,
-                            sizes=[N_div_n, K_div_k, k, n_in_i32s],
-                            strides=[n_in_i32s, k_x_N_in_i32s, N_in_i32s],
+                        load_striped(
+                            inB_names,
+                            bds[2 * tile_row + 2],
+                            B,
+                            0,
+                            [N_div_n, K_div_k, k, n_in_i32s],
+                            [n_in_i32s, k_x_N_in_i32s, N_in_i32s],
                         )
 
-                    npu_sync(column=0, row=0, direction=0, channel=0)
+                bd_pool.drain()
 
     print(ctx.module)
 
 
-my_matmul()
+argparser = argparse.ArgumentParser(
+    prog="AIE Matrix Multiplication MLIR Design (Single Core)",
+    description="Emits MLIR code for a matrix multiplication design of the given input size",
+)
+argparser.add_argument("-M", type=int, default=256)
+argparser.add_argument("-K", type=int, default=256)
+argparser.add_argument("-N", type=int, default=256)
+argparser.add_argument(
+    "-m", type=int, default=64, help="multiple of 4, the r of the 4x8x4 intrinsic"
+)
+argparser.add_argument(
+    "-k", type=int, default=64, help="multiple of 8, the s of the 4x8x4 intrinsic"
+)
+argparser.add_argument(
+    "-n", type=int, default=64, help="multiple of 4, the t of the 4x8x4 intrinsic"
+)
+argparser.add_argument(
+    "--n-bds", type=int, default=16, help="shim BDs available to the sequence"
+)
+argparser.add_argument(
+    "--blocks-in-flight",
+    type=int,
+    default=2,
+    help="blocks of tile rows issued before waiting for the oldest one",
+)
+argparser.add_argument(
+    "--fifo-depth",
+    type=int,
+    default=2,
+    help="depth of the A and B FIFOs from the memory tile to the core",
+)
+argparser.add_argument(
+    "--mem-fifo-depth",
+    type=int,
+    default=2,
+    help="depth of the A and B FIFOs from the shim to the memory tile",
+)
+argparser.add_argument(
+    "--acquire-size",
+    type=int,
+    default=1,
+    help="A and B tiles acquired per iteration of the K loop",
+)
+argparser.add_argument(
+    "--compact-sequence",
+    action="store_true",
+    default=False,
+    help="walk the output tiles column by column, so that the runtime "
+    "sequence does not grow with M",
+)
+argparser.add_argument(
+    "--runtime-shape",
+    action="store_true",
+    default=False,
+    help="take the loop trip counts of the core from runtime parameters "
+    "written by the sequence, so that the array configuration does not "
+    "depend on M, K and N",
+)
+argparser.add_argument(
+    "--device",
+    choices=devices,
+    default=None,
+    help="device to generate the design for; defaults to the npu1 partition "
+    "with the columns the design uses",
+)
+argparser.add_argument(
+    "--col-offset",
+    type=int,
+    default=0,
+    help="column of the device to use, leaving the others to designs running "
+    "concurrently",
+)
+argparser.add_argument(
+    "--stripes",
+    type=int,
+    default=1,
+    help="read A and B through the shims of this many neighbouring columns, "
+    "to spread them over more shim DMA channels",
+)
+argparser.add_argument(
+    "--repeat",
+    type=int,
+    default=1,
+    help="times the sequence computes the whole product per launch, to "
+    "measure the device time without the launch overhead",
+)
+args = argparser.parse_args()
+try:
+    my_matmul(
+        M=args.M,
+        K=args.K,
+        N=args.N,
+        m=args.m,
+        k=args.k,
+        n=args.n,
+        n_bds=args.n_bds,
+        blocks_in_flight=args.blocks_in_flight,
+        fifo_depth=args.fifo_depth,
+        mem_fifo_depth=args.mem_fifo_depth,
+        acquire_size=args.acquire_size,
+        compact_sequence=args.compact_sequence,
+        runtime_shape=args.runtime_shape,
+        device_name=args.device,
+        col_offset=args.col_offset,
+        stripes=args.stripes,
+        repeat=args.repeat,
+    )
+except ValueError as e:
+    argparser.error(str(e))
@@ -2,11 +2,34 @@
 
 # run this script from one of the subdirectories to perform a sweep,
 # e.g. from within whole_array, run ../sweep.sh.
+# Set tune=1 to build each size with the best tile configuration found by
+# ../autotune.py (this runs offline, no NPU needed) instead of the default one.
+# Set runtime_shape=1 to build one xclbin per tile configuration, which then
+# serves all sizes; only the instructions are generated per size.
 
 csv_out=sweep_2.csv
 log_out=sweep_2.log
 runargs="--iters 20 --warmup 10"
 iterations=1
+tune=${tune:-0}
+runtime_shape=${runtime_shape:-0}
+# Sub-array shapes (rows x columns of cores) to sweep; only used by whole_array.
+grids=${grids:-"4x4"}
+# Devices to sweep, e.g. "npu1_4col" to build every grid for the full array,
+# or "npu2". Grids wider than a device are skipped for it. By default, each
+# point is built for the device its design picks by itself: whole_array takes
+# the npu1 partition with as many columns as the grid, and single_core the one
+# with as many columns as stripes, so that sub-array points run on their own
+# partition.
+devices=${devices:-"default"}
+# Numbers of neighbouring shims to stripe the operands across, e.g. "1 2" to
+# measure the bandwidth of a shim DMA channel; only used by single_core and
+# matrix_vector. Stripes beyond the columns of a device are skipped for it.
+stripes=${stripes:-"1"}
+# Products computed per launch (whole_array and single_core). The reported
+# times are per product, so comparing a sweep with repeat=1 to one with e.g.
+# repeat=8 separates the device time from the launch overhead.
+repeat=${repeat:-1}
 
 M_lo=256
 M_step=256
@@ -24,7 +47,7 @@ Ns=$(seq $N_lo $N_step $N_hi)
 here=$(realpath $(dirname $BASH_SOURCE[0]))
 cd $here
 
-printf "M,K,N" >>$csv_out
+printf "M,K,N,Tiling,Device,Rows,Cols,Stripes,Repeat" >>$csv_out
 for i in $(seq 1 $iterations); do
     printf ",It"$i >>$csv_out
 done
@@ -33,17 +56,43 @@ printf "\n" >>$csv_out
 for M in $Ms; do
     for K in $Ks; do
         for N in $Ns; do
-            echo ${M}x${K}x${N} 1>&2
-            rm -r /lib/firmware/amdnpu/1502/*_unsigned.xclbin  # Signing step may hang otherwise
-            M=${M} K=${K} N=${N} make all 1>>$log_out 2>&1
-            printf "${M},${K},${N}" >>$csv_out
-            for i in $(seq 1 $iterations); do
-                M=${M} K=${K} N=${N} runargs=${runargs} make run >.tmp_run.log
-                cat .tmp_run.log $run_output >>$log_out
-                t=$(cat .tmp_run.log | sed -rn 's/^Avg NPU matmul time: ([0-9.]+)us.$/\1/p')
-                printf ",${t}" >>$csv_out
+            for device in $devices; do
+                if [ "$device" = "default" ]; then
+                    device_cols=4
+                    device_arg=""
+                else
+                    device_cols=$(python3 -c "import sys; sys.path.insert(0, '$here'); from devices import devices; print(devices['$device'].n_cols)")
+                    device_arg="device=$device"
+                fi
+                for grid in $grids; do
+                    n_rows=${grid%x*}
+                    n_cols=${grid#*x}
+                    if [ $n_cols -gt $device_cols ]; then
+                        continue
+                    fi
+                    for n_stripes in $stripes; do
+                        if [ $n_stripes -gt $device_cols ]; then
+                            continue
+                        fi
+                        echo ${M}x${K}x${N} on ${n_rows}x${n_cols} of ${device}, ${n_stripes} stripes 1>&2
+                        tile_args="m=64 k=64 n=64"
+                        if [ "$tune" = "1" ]; then
+                            tile_args=$(python3 $here/autotune.py -M $M -K $K -N $N --n-rows $n_rows --n-cols $n_cols --lookup)
+                        fi
+                        tile_args="$tile_args n_rows=$n_rows n_cols=$n_cols $device_arg runtime_shape=$runtime_shape stripes=$n_stripes repeat=$repeat"
+                        rm -r /lib/firmware/amdnpu/1502/*_unsigned.xclbin  # Signing step may hang otherwise
+                        M=${M} K=${K} N=${N} make all $tile_args 1>>$log_out 2>&1
+                        printf "${M},${K},${N},$(echo $tile_args | sed -rn 's/.*m=([0-9]+) k=([0-9]+) n=([0-9]+).*/\1x\2x\3/p'),${device},${n_rows},${n_cols},${n_stripes},${repeat}" >>$csv_out
+                        for i in $(seq 1 $iterations); do
+                            M=${M} K=${K} N=${N} runargs=${runargs} make run $tile_args >.tmp_run.log
+                            cat .tmp_run.log $run_output >>$log_out
+                            t=$(cat .tmp_run.log | sed -rn 's/^Avg NPU matmul time: ([0-9.]+)us.$/\1/p')
+                            printf ",${t}" >>$csv_out
+                        done
+                        printf "\n" >>$csv_out
+                    done
+                done
             done
-            printf "\n" >>$csv_out
         done
     done
 done
@@ -28,10 +28,20 @@
 
 #ifndef DATATYPES_USING_DEFINED
 #define DATATYPES_USING_DEFINED
+#if defined(DTYPE_I8)
+using A_DATATYPE = std::int8_t;
+using B_DATATYPE = std::int8_t;
+using C_DATATYPE = std::int32_t;
+#elif defined(DTYPE_I16)
+using A_DATATYPE = std::int16_t;
+using B_DATATYPE = std::int16_t;
+using C_DATATYPE = std::int32_t;
+#else
 using A_DATATYPE = std::bfloat16_t;
 using B_DATATYPE = std::bfloat16_t;
 using C_DATATYPE = std::bfloat16_t;
 #endif
+#endif
 
 namespace po = boost::program_options;
 
@@ -48,6 +58,25 @@ int main(int argc, const char *argv[]) {
   int n_iterations = vm["iters"].as<int>();
   int n_warmup_iterations = vm["warmup"].as<int>();
   int trace_size = vm["trace_sz"].as<int>();
+  bool accumulate = vm["accumulate"].as<bool>();
+  int batch = vm["batch"].as<int>();
+  bool bias = vm["bias"].as<bool>();
+  std::string activation = vm["activation"].as<std::string>();
+  bool transpose_A = vm["transpose_A"].as<bool>();
+  bool transpose_B = vm["transpose_B"].as<bool>();
+  bool transpose_C = vm["transpose_C"].as<bool>();
+  std::string block_mask_path = vm["block_mask"].as<std::string>();
+  bool block_sparse = !block_mask_path.empty();
+  int repeat = vm["repeat"].as<int>();
+  int perf_rows = vm["perf_rows"].as<int>();
+  int perf_cols = vm["perf_cols"].as<int>();
+  int perf_tile = vm["perf_tile"].as<int>();
+  if (perf_rows > 0 && trace_size > 0) {
+    std::cerr << "The performance counters and the trace cannot both be "
+                 "stored after C."
+              << std::endl;
+    return 1;
+  }
 
   srand(time(NULL));
 
@@ -55,19 +84,40 @@ int main(int argc, const char *argv[]) {
   int K = vm["K"].as<int>();
   int N = vm["N"].as<int>();
 
+  // The design operates on matrices padded up to multiples of its tile sizes.
+  int M_pad = matmul_common::round_up(M, vm["pad_M"].as<int>());
+  int K_pad = matmul_common::round_up(K, vm["pad_K"].as<int>());
+  int N_pad = matmul_common::round_up(N, vm["pad_N"].as<int>());
+  bool padded = (M_pad != M || K_pad != K || N_pad != N);
+
   if (verbosity >= 1) {
-    std::cout << "Matrix size " << M << "x" << K << "x" << N << std::endl;
+    std::cout << "Matrix size " << M << "x" << K << "x" << N;
+    if (batch > 1) {
+      std::cout << ", batch of " << batch;
+    }
+    std::cout << std::endl;
   }
 
+  // The matrices of a batch are stored back to back, each in its padded
+  // layout.
   int A_VOLUME = M * K;
   int B_VOLUME = N * K;
   int C_VOLUME = M * N;
+  int A_PADDED_VOLUME = M_pad * K_pad;
+  int B_PADDED_VOLUME = K_pad * N_pad;
+  int C_PADDED_VOLUME = M_pad * N_pad;
 
-  size_t A_SIZE = (A_VOLUME * sizeof(A_DATATYPE));
-  size_t B_SIZE = (B_VOLUME * sizeof(B_DATATYPE));
-  size_t C_SIZE = (C_VOLUME * sizeof(C_DATATYPE));
+  size_t A_SIZE = (batch * A_PADDED_VOLUME * sizeof(A_DATATYPE));
+  size_t B_SIZE = (batch * B_PADDED_VOLUME * sizeof(B_DATATYPE));
+  size_t C_SIZE = (batch * C_PADDED_VOLUME * sizeof(C_DATATYPE));
+  // The bias vector, if any, is stored in the B buffer after the B matrices.
+  size_t BIAS_SIZE = bias ? N_pad * sizeof(C_DATATYPE) : 0;
 
-  size_t OUT_SIZE = C_SIZE + trace_size;
+  // The performance counters of the cores, if any, are stored after C.
+  size_t PERF_TILE_SIZE = perf_tile * sizeof(C_DATATYPE);
+  size_t PERF_SIZE = perf_rows * perf_cols * PERF_TILE_SIZE;
+
+  size_t OUT_SIZE = C_SIZE + PERF_SIZE + trace_size;
 
   std::vector<uint32_t> instr_v =
       matmul_common::load_instr_sequence(vm["instr"].as<std::string>());
@@ -122,7 +172,8 @@ int main(int argc, const char *argv[]) {
   auto bo_a =
       xrt::bo(device, A_SIZE, XRT_BO_FLAGS_HOST_ONLY, kernel.group_id(2));
   auto bo_b =
-      xrt::bo(device, B_SIZE, XRT_BO_FLAGS_HOST_ONLY, kernel.group_id(3));
+      xrt::bo(device, B_SIZE + BIAS_SIZE, XRT_BO_FLAGS_HOST_ONLY,
+              kernel.group_id(3));
   auto bo_out =
       xrt::bo(device, OUT_SIZE, XRT_BO_FLAGS_HOST_ONLY, kernel.group_id(4));
 
@@ -131,25 +182,113 @@ int main(int argc, const char *argv[]) {
   }
 
   A_DATATYPE *bufA = bo_a.map<A_DATATYPE *>();
-  std::vector<A_DATATYPE> AVec(A_VOLUME);
-  for (int i = 0; i < A_VOLUME; i++) {
+  std::vector<A_DATATYPE> AVec(batch * A_VOLUME);
+  for (int i = 0; i < batch * A_VOLUME; i++) {
     //AVec[i] = matmul_common::random_bfloat16_t();
-    AVec[i] = (std::bfloat16_t)(i/4096+1);
+    if constexpr (std::is_integral_v<A_DATATYPE>) {
+      AVec[i] = matmul_common::random_quantized<A_DATATYPE>();
+    } else {
+      AVec[i] = (std::bfloat16_t)(i/4096+1);
+    }
   }
-  memcpy(bufA, AVec.data(), (AVec.size() * sizeof(A_DATATYPE)));
   B_DATATYPE *bufB = bo_b.map<B_DATATYPE *>();
-  std::vector<B_DATATYPE> BVec(B_VOLUME);
-  for (int i = 0; i < B_VOLUME; i++) {
+  std::vector<B_DATATYPE> BVec(batch * B_VOLUME);
+  for (int i = 0; i < batch * B_VOLUME; i++) {
     //BVec[i] = matmul_common::random_bfloat16_t();
-    BVec[i] = (std::bfloat16_t)1; 
+    if constexpr (std::is_integral_v<B_DATATYPE>) {
+      BVec[i] = matmul_common::random_quantized<B_DATATYPE>();
+    } else {
+      BVec[i] = (std::bfloat16_t)1; 
+    }
+  }
+  // A block-sparse B has zeros in the blocks its mask leaves out, and the
+  // design reads the blocks of the mask widened to its groups of tile columns
+  // from the compressed layout of pack_block_sparse.
+  std::vector<std::vector<bool>> block_mask;
+  std::vector<std::vector<bool>> stored_block_mask;
+  std::vector<B_DATATYPE> BPadded;
+  if (block_sparse) {
+    if (transpose_B) {
+      throw std::runtime_error("A block-sparse B cannot be transposed\n");
+    }
+    block_mask = matmul_common::load_block_mask(block_mask_path);
+    if (K_pad % block_mask.size() != 0 || N_pad % block_mask[0].size() != 0) {
+      throw std::runtime_error("The block mask does not tile B\n");
+    }
+    stored_block_mask = matmul_common::widen_block_mask(
+        block_mask, vm["block_group"].as<int>(), vm["block_runs"].as<int>());
+    for (int b = 0; b < batch; b++) {
+      matmul_common::prune_blocks(BVec.data() + b * B_VOLUME, K, N, block_mask,
+                                  K_pad / block_mask.size(),
+                                  N_pad / block_mask[0].size());
+    }
+    BPadded.resize(B_PADDED_VOLUME);
+  }
+  auto pack_start = std::chrono::high_resolution_clock::now();
+  for (int b = 0; b < batch; b++) {
+    if (transpose_A) {
+      matmul_common::pack_padded_transposed(AVec.data() + b * A_VOLUME, M, K,
+                                            bufA + b * A_PADDED_VOLUME, M_pad,
+                                            K_pad);
+    } else {
+      matmul_common::pack_padded(AVec.data() + b * A_VOLUME, M, K,
+                                 bufA + b * A_PADDED_VOLUME, M_pad, K_pad);
+    }
+    if (block_sparse) {
+      matmul_common::pack_padded(BVec.data() + b * B_VOLUME, K, N,
+                                 BPadded.data(), K_pad, N_pad);
+      matmul_common::pack_block_sparse(BPadded.data(), K_pad, N_pad,
+                                       bufB + b * B_PADDED_VOLUME,
+                                       stored_block_mask);
+    } else if (transpose_B) {
+      matmul_common::pack_padded_transposed(BVec.data() + b * B_VOLUME, K, N,
+                                            bufB + b * B_PADDED_VOLUME, K_pad,
+                                            N_pad);
+    } else {
+      matmul_common::pack_padded(BVec.data() + b * B_VOLUME, K, N,
+                                 bufB + b * B_PADDED_VOLUME, K_pad, N_pad);
+    }
   }
-  memcpy(bufB, BVec.data(), (BVec.size() * sizeof(B_DATATYPE)));
+  std::vector<C_DATATYPE> BiasVec;
+  if (bias) {
+    BiasVec.resize(N);
+    for (int i = 0; i < N; i++) {
+      if constexpr (std::is_integral_v<C_DATATYPE>) {
+        BiasVec[i] = matmul_common::random_quantized<C_DATATYPE>();
+      } else {
+        BiasVec[i] = matmul_common::random_bfloat16_t();
+      }
+    }
+    C_DATATYPE *bufBias = (C_DATATYPE *)((char *)bufB + B_SIZE);
+    matmul_common::pack_padded(BiasVec.data(), 1, N, bufBias, 1, N_pad);
+  }
+  auto pack_stop = std::chrono::high_resolution_clock::now();
+  float pack_time =
+      std::chrono::duration_cast<std::chrono::microseconds>(pack_stop -
+                                                            pack_start)
+          .count();
 
   // Initialize outputs; bufOut is results matrix plus tracing info
   char *bufOut = bo_out.map<char *>();
-  std::vector<C_DATATYPE> CVec(C_VOLUME);
+  std::vector<C_DATATYPE> CVec(batch * C_VOLUME);
   // memcpy(bufOut, CVec.data(), (CVec.size() * sizeof(C_DATATYPE)));
   memset(bufOut, 0, OUT_SIZE);
+  // In accumulate mode, the design adds to the C it finds in bufOut, which
+  // is therefore reset to the initial C before every run.
+  std::vector<C_DATATYPE> CInitVec;
+  std::vector<C_DATATYPE> CInitPadded;
+  if (accumulate) {
+    CInitVec.resize(batch * C_VOLUME);
+    for (int i = 0; i < batch * C_VOLUME; i++) {
+      CInitVec[i] = matmul_common::random_bfloat16_t();
+    }
+    CInitPadded.resize(batch * C_PADDED_VOLUME);
+    for (int b = 0; b < batch; b++) {
+      matmul_common::pack_padded(CInitVec.data() + b * C_VOLUME, M, N,
+                                 CInitPadded.data() + b * C_PADDED_VOLUME,
+                                 M_pad, N_pad);
+    }
+  }
   // if(trace_size > 0) {
   //   memset(bufOut + C_SIZE, 0, trace_size);
   // }
@@ -167,12 +306,19 @@ int main(int argc, const char *argv[]) {
   float npu_time_total = 0;
   float npu_time_min = 9999999;
   float npu_time_max = 0;
+  float unpack_time_total = 0;
+  std::vector<std::vector<matmul_common::perf_counters>> perf_runs;
 
   int errors = 0;
-  float macs = 2.0 * float(M) * float(K) * float(N);
+  float macs = 2.0 * float(batch) * float(M) * float(K) * float(N);
 
   for (unsigned iter = 0; iter < num_iter; iter++) {
 
+    if (accumulate) {
+      memcpy(bufOut, CInitPadded.data(), C_SIZE);
+      bo_out.sync(XCL_BO_SYNC_BO_TO_DEVICE);
+    }
+
     if (verbosity >= 1) {
       std::cout << "Running Kernel.\n";
     }
@@ -187,7 +333,23 @@ int main(int argc, const char *argv[]) {
       continue;
     }
 
-    memcpy(CVec.data(), bufOut, (CVec.size() * sizeof(C_DATATYPE)));
+    auto unpack_start = std::chrono::high_resolution_clock::now();
+    for (int b = 0; b < batch; b++) {
+      if (transpose_C) {
+        matmul_common::unpack_padded_transposed(
+            (C_DATATYPE *)bufOut + b * C_PADDED_VOLUME, M_pad,
+            CVec.data() + b * C_VOLUME, M, N);
+      } else {
+        matmul_common::unpack_padded(
+            (C_DATATYPE *)bufOut + b * C_PADDED_VOLUME, N_pad,
+            CVec.data() + b * C_VOLUME, M, N);
+      }
+    }
+    auto unpack_stop = std::chrono::high_resolution_clock::now();
+    unpack_time_total +=
+        std::chrono::duration_cast<std::chrono::microseconds>(unpack_stop -
+                                                              unpack_start)
+            .count();
     for(int i =0;i<5;i++){
         std::cout<<CVec[i]<<" ";
     }
@@ -197,7 +359,22 @@ int main(int argc, const char *argv[]) {
         std::cout << "Verifying against reference matmul ..." << std::endl;
       }
       auto vstart = std::chrono::system_clock::now();
-      errors = matmul_common::verify(M, N, K, AVec, BVec, CVec);
+      errors = 0;
+      for (int b = 0; b < batch; b++) {
+        // The b-th matrix of a batch (empty if vec is)
+        auto slice = [b](const auto &vec, int volume) {
+          using T = typename std::decay_t<decltype(vec)>::value_type;
+          if (vec.empty()) {
+            return std::vector<T>();
+          }
+          return std::vector<T>(vec.begin() + b * volume,
+                                vec.begin() + (b + 1) * volume);
+        };
+        errors += matmul_common::verify(
+            M, N, K, slice(AVec, A_VOLUME), slice(BVec, B_VOLUME),
+            slice(CVec, C_VOLUME), verbosity, slice(CInitVec, C_VOLUME),
+            BiasVec, activation);
+      }
       auto vstop = std::chrono::system_clock::now();
       float vtime =
           std::chrono::duration_cast<std::chrono::seconds>(vstop - vstart)
@@ -214,21 +391,39 @@ int main(int argc, const char *argv[]) {
       matmul_common::write_out_trace(((char *)bufOut) + C_SIZE, trace_size,
                                      vm["trace_file"].as<std::string>());
     }
+    if (PERF_SIZE > 0) {
+      perf_runs.push_back(matmul_common::read_perf_counters(
+          bufOut + C_SIZE, perf_rows, perf_cols, PERF_TILE_SIZE));
+    }
 
+    // A design generated with --repeat computes the product several times
+    // per launch, which spreads the launch overhead over the repeats.
     float npu_time =
         std::chrono::duration_cast<std::chrono::microseconds>(stop - start)
-            .count();
+            .count() /
+        float(repeat);
 
     npu_time_total += npu_time;
     npu_time_min = (npu_time < npu_time_min) ? npu_time : npu_time_min;
     npu_time_max = (npu_time > npu_time_max) ? npu_time : npu_time_max;
   }
 
+  if (repeat > 1) {
+    std::cout << std::endl
+              << "Times per product, " << repeat << " products per launch"
+              << std::endl;
+  }
   std::cout << std::endl
             << "Avg NPU matmul time: " << npu_time_total / n_iterations << "us."
             << std::endl;
   std::cout << "Avg NPU gflops: "
             << macs / (1000 * npu_time_total / n_iterations) << std::endl;
+  // Matrix-vector products are bound by the bandwidth at which the operands
+  // move rather than by the MACs.
+  std::cout << "Avg NPU bandwidth: "
+            << (A_SIZE + B_SIZE + C_SIZE) /
+                   (1000 * npu_time_total / n_iterations)
+            << " GB/s." << std::endl;
 
   std::cout << std::endl
             << "Min NPU matmul time: " << npu_time_min << "us." << std::endl;
@@ -238,6 +433,42 @@ int main(int argc, const char *argv[]) {
             << "Max NPU matmul time: " << npu_time_max << "us." << std::endl;
   std::cout << "Min NPU gflops: " << macs / (1000 * npu_time_max) << std::endl;
 
+  matmul_common::print_perf_counters(std::cout, perf_runs, perf_cols);
+
+  if (block_sparse) {
+    // The dense figures above count the MACs of the zero blocks as well; the
+    // effective ones only those of the nonzero blocks.
+    int blocks = block_mask.size() * block_mask[0].size();
+    float density = float(matmul_common::count_blocks(block_mask)) / blocks;
+    float stored_density =
+        float(matmul_common::count_blocks(stored_block_mask)) / blocks;
+    std::cout << std::endl
+              << "Nonzero blocks of B: " << 100.0 * density << "%, "
+              << 100.0 * stored_density << "% computed" << std::endl;
+    std::cout << "Avg NPU gflops (effective): "
+              << density * macs / (1000 * npu_time_total / n_iterations)
+              << std::endl;
+  }
+
+  if (padded) {
+    // Padding costs the extra (zero) MACs computed on the device plus the
+    // host-side pack and unpack passes.
+    float padded_macs =
+        2.0 * float(batch) * float(M_pad) * float(K_pad) * float(N_pad);
+    std::cout << std::endl
+              << "Padded matrix size: " << M_pad << "x" << K_pad << "x"
+              << N_pad << std::endl;
+    std::cout << "Padding MAC overhead: "
+              << 100.0 * (padded_macs - macs) / macs << "%" << std::endl;
+    std::cout << "Pack time: " << pack_time << "us." << std::endl;
+    std::cout << "Avg unpack time: " << unpack_time_total / n_iterations
+              << "us." << std::endl;
+    std::cout << "Avg gflops incl. padding: "
+              << macs / (1000 * (npu_time_total + unpack_time_total) /
+                             n_iterations)
+              << std::endl;
+  }
+
   if (!errors) {
     std::cout << "\nPASS!\n\n";
     return 0;
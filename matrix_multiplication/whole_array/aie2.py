@@ -5,6 +5,8 @@
 #
 # (c) Copyright 2023 AMD Inc.
 
+import itertools
+import os
 import sys
 import argparse
 
@@ -13,6 +15,18 @@ from aie.extras.context import mlir_mod_ctx
 from aie.dialects.aie import *
 from aie.dialects.aiex import *
 from aie.dialects.scf import *
+from aie.extras.dialects.ext import arith, memref
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from devices import devices, npu1_partition, placement
+from resources import (
+    BDPool,
+    check_footprint,
+    dma_max_repeat,
+    lock_value_address,
+    mem_tile_channels,
+    rtp_lock_id,
+)
 
 
 def main():
@@ -23,187 +37,1037 @@ def main():
     argparser.add_argument("-M", type=int, default=512)
     argparser.add_argument("-K", type=int, default=512)
     argparser.add_argument("-N", type=int, default=512)
+    argparser.add_argument("-m", type=int, default=64)
+    argparser.add_argument("-k", type=int, default=64)
+    argparser.add_argument("-n", type=int, default=64)
+    argparser.add_argument(
+        "--dtype",
+        choices=datapaths.keys(),
+        default="bf16",
+        help="input element type; the integer types accumulate into i32. The "
+        "kernels use a fixed r x s x t intrinsic per type ({}), and m, k and n "
+        "must be multiples of r, s and t".format(
+            ", ".join(
+                "{} {}x{}x{}".format(dtype, *intrinsic)
+                for dtype, (_, intrinsic) in datapaths.items()
+            )
+        ),
+    )
+    argparser.add_argument("--n-rows", type=int, default=4)
+    argparser.add_argument("--n-cols", "--num-cols", type=int, default=4)
+    argparser.add_argument(
+        "--col-offset",
+        type=int,
+        default=0,
+        help="first column of the device to use, leaving the others to "
+        "designs running concurrently",
+    )
+    argparser.add_argument(
+        "--device",
+        choices=devices,
+        default=None,
+        help="device to generate the design for; defaults to the npu1 "
+        "partition with --n-cols columns",
+    )
+    argparser.add_argument(
+        "--n-bds", type=int, default=16, help="shim BDs available to the sequence"
+    )
+    argparser.add_argument(
+        "--blocks-in-flight",
+        type=int,
+        default=2,
+        help="blocks of tile rows issued before waiting for the oldest one",
+    )
+    argparser.add_argument(
+        "--fifo-depth",
+        type=int,
+        default=2,
+        help="depth of the A and B FIFOs from the memory tiles to the cores",
+    )
+    argparser.add_argument(
+        "--mem-fifo-depth",
+        type=int,
+        default=2,
+        help="depth of the A and B FIFOs from the shims to the memory tiles",
+    )
+    argparser.add_argument(
+        "--acquire-size",
+        type=int,
+        default=1,
+        help="A and B tiles acquired per iteration of the K loop",
+    )
+    argparser.add_argument(
+        "--split-k",
+        action="store_true",
+        default=False,
+        help="split K across the cores of a column and reduce over the cascade",
+    )
+    argparser.add_argument(
+        "--accumulate",
+        action="store_true",
+        default=False,
+        help="compute C += A * B, reading the initial C from DDR",
+    )
+    argparser.add_argument(
+        "--bias",
+        action="store_true",
+        default=False,
+        help="add a bias vector, stored after B, to every row of C",
+    )
+    argparser.add_argument(
+        "--activation",
+        choices=activations,
+        default="none",
+        help="activation function applied to C on the cores",
+    )
+    argparser.add_argument(
+        "--batch",
+        type=int,
+        default=1,
+        help="number of same-shape multiplications per launch",
+    )
+    argparser.add_argument(
+        "--stride-A",
+        type=int,
+        default=None,
+        help="elements between the A matrices of a batch, in the padded "
+        "layout; defaults to packed matrices, 0 shares one A",
+    )
+    argparser.add_argument("--stride-B", type=int, default=None)
+    argparser.add_argument("--stride-C", type=int, default=None)
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="times the sequence computes the whole product per launch, to "
+        "measure the device time without the launch overhead",
+    )
+    argparser.add_argument(
+        "--dataflow",
+        choices=dataflows,
+        default="output",
+        help="operand kept stationary on the cores across output tiles",
+    )
+    argparser.add_argument(
+        "--reuse",
+        type=int,
+        default=2,
+        help="output tiles computed per stationary A or B tile",
+    )
+    argparser.add_argument(
+        "--transpose-A",
+        action="store_true",
+        default=False,
+        help="A is stored transposed, as a KxM matrix",
+    )
+    argparser.add_argument(
+        "--transpose-B",
+        action="store_true",
+        default=False,
+        help="B is stored transposed, as an NxK matrix",
+    )
+    argparser.add_argument(
+        "--transpose-C",
+        action="store_true",
+        default=False,
+        help="C is stored transposed, as an NxM matrix",
+    )
+    argparser.add_argument(
+        "--compact-sequence",
+        action="store_true",
+        default=False,
+        help="walk the output tiles column by column, so that the runtime "
+        "sequence does not grow with M",
+    )
+    argparser.add_argument(
+        "--runtime-shape",
+        action="store_true",
+        default=False,
+        help="take the loop trip counts of the cores from runtime parameters "
+        "written by the sequence, so that the array configuration does not "
+        "depend on M, K and N",
+    )
+    argparser.add_argument(
+        "--block-mask",
+        default=None,
+        help="file with the (K / k) x (N / n) mask of the nonzero k x n blocks "
+        "of B, which is then stored compressed and whose zero blocks are "
+        "skipped",
+    )
+    argparser.add_argument(
+        "--perf-counters",
+        action="store_true",
+        default=False,
+        help="time the matmul kernel calls of every core and store the "
+        "cycle counts after C",
+    )
     args = argparser.parse_args()
-    my_matmul(args.M, args.K, args.N)
+    try:
+        my_matmul(
+            M=args.M,
+            K=args.K,
+            N=args.N,
+            m=args.m,
+            k=args.k,
+            n=args.n,
+            n_rows=args.n_rows,
+            n_cols=args.n_cols,
+            n_bds=args.n_bds,
+            blocks_in_flight=args.blocks_in_flight,
+            fifo_depth=args.fifo_depth,
+            mem_fifo_depth=args.mem_fifo_depth,
+            acquire_size=args.acquire_size,
+            split_k=args.split_k,
+            accumulate=args.accumulate,
+            dtype=args.dtype,
+            batch=args.batch,
+            stride_A=args.stride_A,
+            stride_B=args.stride_B,
+            stride_C=args.stride_C,
+            bias=args.bias,
+            activation=args.activation,
+            dataflow=args.dataflow,
+            reuse=args.reuse,
+            transpose_A=args.transpose_A,
+            transpose_B=args.transpose_B,
+            transpose_C=args.transpose_C,
+            compact_sequence=args.compact_sequence,
+            runtime_shape=args.runtime_shape,
+            device_name=args.device,
+            col_offset=args.col_offset,
+            block_mask=(
+                None if args.block_mask is None else read_block_mask(args.block_mask)
+            ),
+            repeat=args.repeat,
+            perf_counters=args.perf_counters,
+        )
+    except ValueError as e:
+        argparser.error(str(e))
+
+
+# Supported datapaths: input element type -> output element type and the
+# r x s x t intrinsic of the mm.cc kernels for that type. The integer
+# datapaths accumulate into i32, so quantized results are exact.
+datapaths = {
+    "bf16": ("bf16", (4, 8, 4)),
+    "i8": ("i32", (4, 8, 8)),
+    "i16": ("i32", (4, 4, 4)),
+}
+word_sizes = {"bf16": 2, "i8": 1, "i16": 2, "i32": 4}
 
+# Activation functions of the epilogue, see mm_ext.cc
+activations = ["none", "relu", "gelu"]
+
+# Dataflows: in the default output-stationary one, a core finishes one output
+# tile before starting the next. In the A- (B-)stationary ones, it works on
+# several output tiles of a row (column) of tiles at once and applies each A
+# (B) tile to all of them.
+dataflows = ["output", "A", "B"]
+
+
+def element_type(dtype):
+    return {"bf16": T.bf16, "i8": T.i8, "i16": T.i16, "i32": T.i32}[dtype]()
+
+
+def kernel_object(m, k, n, extended=False):
+    # mm.cc is compiled once per micro-tile size, see DIM_M/DIM_K/DIM_N in
+    # makefile-common. The split-K, accumulate and epilogue modes additionally
+    # need the kernels of mm_ext.cc, which includes mm.cc.
+    if extended:
+        return "mm_ext_{}x{}x{}.o".format(m, k, n)
+    return "mm_{}x{}x{}.o".format(m, k, n)
+
+
+def check_tiling(m, k, n, r, s, t, word_size_in, word_size_out):
+    if m % r != 0 or k % s != 0 or n % t != 0:
+        raise ValueError(
+            "micro-tile {}x{}x{} is not a multiple of the intrinsic size {}x{}x{}".format(
+                m, k, n, r, s, t
+            )
+        )
+    if (k * word_size_in) % 4 != 0 or (n * word_size_in) % 4 != 0:
+        raise ValueError("k and n must be a whole number of 32-bit words")
+    # The memory tile DMAs move whole 32-bit words, so the innermost dimension
+    # of the tiling transformations must be too.
+    if (s * word_size_in) % 4 != 0 or (t * word_size_in) % 4 != 0:
+        raise ValueError("s and t must be a whole number of 32-bit words")
+    if (t * word_size_out) % 4 != 0:
+        raise ValueError("t must be a whole number of 32-bit output words")
+
+
+def padded_shape(M, K, N, M_multiple, K_multiple, N_multiple):
+    # Shapes that are not a multiple of the tiling are zero-padded by the host
+    # (see pack_padded in common.h); the design itself works on the padded
+    # shape. The padding overhead is reported on stderr.
+    M_pad = -(-M // M_multiple) * M_multiple
+    K_pad = -(-K // K_multiple) * K_multiple
+    N_pad = -(-N // N_multiple) * N_multiple
+    if (M_pad, K_pad, N_pad) != (M, K, N):
+        overhead = (M_pad * K_pad * N_pad) / (M * K * N) - 1
+        sys.stderr.write(
+            "Padding {}x{}x{} to {}x{}x{} ({:.1f}% extra MACs)\n".format(
+                M, K, N, M_pad, K_pad, N_pad, overhead * 100
+            )
+        )
+    return M_pad, K_pad, N_pad
+
+
+def ddr_bytes(
+    M,
+    K,
+    N,
+    m,
+    n,
+    C_tile_rows,
+    n_cols,
+    word_size_in,
+    word_size_out,
+    accumulate=False,
+    bias=False,
+    reuse_A=1,
+    reuse_B=1,
+):
+    """Bytes of A, B and C moved between DDR and the array per product."""
+    # A is fetched once per reuse_A blocks of n_cols output tile columns, B
+    # (and the bias stored after it) once per reuse_B rows of output tiles.
+    A_fetches = -(-N // (n * n_cols * reuse_A))
+    B_fetches = -(-M // (m * C_tile_rows * reuse_B))
+    A = M * K * word_size_in * A_fetches
+    B = (K * N * word_size_in + (N * word_size_out if bias else 0)) * B_fetches
+    C = M * N * word_size_out * (2 if accumulate else 1)
+    return A, B, C
+
+
+def report_ddr_bytes(selected, reuse, batch, *args, **kwargs):
+    # Compare the DDR traffic of all dataflows for the (padded) shape on
+    # stderr; the selected one is marked with a '*'.
+    sys.stderr.write(
+        "DDR traffic per launch [bytes]:{:>12}{:>12}{:>12}{:>12}\n".format(
+            "A", "B", "C", "total"
+        )
+    )
+    for dataflow in dataflows:
+        if dataflow == "output":
+            label = "output-stationary"
+        else:
+            label = "{}-stationary, reuse {}".format(dataflow, reuse)
+        traffic = ddr_bytes(
+            *args,
+            **kwargs,
+            reuse_A=reuse if dataflow == "A" else 1,
+            reuse_B=reuse if dataflow == "B" else 1,
+        )
+        traffic = [batch * x for x in traffic]
+        sys.stderr.write(
+            "{} {:<28}{:>12}{:>12}{:>12}{:>12}\n".format(
+                "*" if dataflow == selected else " ", label, *traffic, sum(traffic)
+            )
+        )
+
+
+def contiguous_groups(n_items, max_groups):
+    # Split range(n_items) into at most max_groups contiguous groups of
+    # (nearly) equal size.
+    n_groups = min(n_items, max_groups)
+    groups = []
+    start = 0
+    for j in range(n_groups):
+        size = n_items // n_groups + (1 if j < n_items % n_groups else 0)
+        groups.append(list(range(start, start + size)))
+        start += size
+    return groups
+
+
+def A_row_groups_for(n_rows, n_cols):
+    # Distribute the rows of cores over the available columns as contiguous
+    # groups; the A tiles of one group are stacked in a single transfer.
+    return contiguous_groups(n_rows, n_cols)
+
+
+def read_block_mask(path):
+    # A block mask has one line per row of k x n blocks of B, with a 1 for
+    # every block that is stored and a 0 for every block that is all zeros.
+    # Whitespace and '#' comments are ignored.
+    block_mask = []
+    with open(path) as f:
+        for line in f:
+            line = "".join(line.split("#")[0].split())
+            if not line:
+                continue
+            if set(line) - {"0", "1"}:
+                raise ValueError("{}: block masks consist of 0s and 1s".format(path))
+            block_mask.append([c == "1" for c in line])
+    if not block_mask or any(len(row) != len(block_mask[0]) for row in block_mask):
+        raise ValueError("{}: the rows of the block mask differ in length".format(path))
+    return block_mask
+
+
+def K_tile_runs(K_tiles):
+    # The runs of consecutive K tiles, as (first K tile, K tiles)
+    runs = []
+    for K_tile in K_tiles:
+        if runs and sum(runs[-1]) == K_tile:
+            runs[-1][1] += 1
+        else:
+            runs.append([K_tile, 1])
+    return runs
+
+
+def block_sparse_K_tiles(block_mask, n_cols, max_runs):
+    # The cores compute n_cols tile columns of C at a time, one per column of
+    # the grid, and all of them receive the same A tiles. So they have to skip
+    # the same K tiles: the K tiles of a group of n_cols tile columns are
+    # those in which any of the group's blocks of B is nonzero.
+    group_K_tiles = [
+        [
+            K_tile
+            for K_tile, row in enumerate(block_mask)
+            if any(row[group * n_cols : (group + 1) * n_cols])
+        ]
+        for group in range(len(block_mask[0]) // n_cols)
+    ]
+    # The A tiles of a group take one BD per run, and all of them are in
+    # flight until the group's C tiles are out. So a group with more than
+    # max_runs runs gets its shortest gaps (the topmost of equal ones) filled
+    # in, and the cores compute on the zero blocks of B in them, which are
+    # stored as well (see widen_block_mask in common.h).
+    for K_tiles in group_K_tiles:
+        runs = K_tile_runs(K_tiles)
+        while len(runs) > max_runs:
+            gap = min(
+                range(len(runs) - 1),
+                key=lambda run: runs[run + 1][0] - sum(runs[run]),
+            )
+            K_tiles += range(sum(runs[gap]), runs[gap + 1][0])
+            K_tiles.sort()
+            runs = K_tile_runs(K_tiles)
+    return group_K_tiles
 
-def my_matmul(M=512, K=512, N=512):
-    m = 64
-    k = 64
-    n = 64
-    r = 4
-    s = 8
-    t = 4
-    word_size_in = 2
-    word_size_out = 2
 
-    n_rows = 4
-    n_cols = 4
+def block_sparse_transfers(group_K_tiles, first_group=0):
+    # The transfers that fetch the A tiles of a tile row, as (first K tile, K
+    # tiles, repeats): one per run of consecutive K tiles of a group. A group
+    # with a single run repeats the transfer of the group before it if that
+    # fetched the same run.
+    A_transfers = []
+    previous_runs = None
+    for K_tiles in group_K_tiles:
+        runs = K_tile_runs(K_tiles)
+        if (
+            len(runs) == 1
+            and runs == previous_runs
+            and A_transfers[-1][2] < dma_max_repeat
+        ):
+            A_transfers[-1][2] += 1
+        else:
+            A_transfers += [[first, count, 1] for first, count in runs]
+        previous_runs = runs
+    # The transfers that fetch the compressed B tiles of a tile column of the
+    # grid, as (first group, groups, K tiles per group): consecutive groups
+    # with the same number of K tiles share one.
+    B_transfers = []
+    for group, K_tiles in enumerate(group_K_tiles, first_group):
+        if not K_tiles:
+            continue
+        if (
+            B_transfers
+            and sum(B_transfers[-1][:2]) == group
+            and B_transfers[-1][2] == len(K_tiles)
+            and B_transfers[-1][1] < dma_max_repeat
+        ):
+            B_transfers[-1][1] += 1
+        else:
+            B_transfers.append([group, 1, len(K_tiles)])
+    return A_transfers, B_transfers
+
+
+def block_sparse_rounds(group_K_tiles, max_bds):
+    # The groups of a tile row, split into rounds of consecutive groups that
+    # take at most max_bds BDs each, including the one for their C tiles, as
+    # (first group, groups, A transfers, B transfers). Once the C tiles of a
+    # round are out, its BDs can be reused by a later one. A single group
+    # takes a round of its own however many BDs it needs.
+    rounds = []
+    for group in range(len(group_K_tiles)):
+        if rounds:
+            first_group = rounds[-1][0]
+            A_transfers, B_transfers = block_sparse_transfers(
+                group_K_tiles[first_group : group + 1], first_group
+            )
+            if 1 + max(1, len(A_transfers)) + len(B_transfers) <= max_bds:
+                rounds[-1] = (
+                    first_group,
+                    group + 1 - first_group,
+                    A_transfers,
+                    B_transfers,
+                )
+                continue
+        rounds.append(
+            (group, 1) + block_sparse_transfers(group_K_tiles[group : group + 1], group)
+        )
+    return rounds
+
+
+# In the performance-counter mode, every core times its matmul kernel calls
+# on the tile timer and stores n_perf_counters 32-bit counters (see
+# perf_store in mm_ext.cc) at the end of each launch. The sequence resets the
+# timers through the Timer_Control register of the core modules at the start
+# of a launch, so that the timestamps of all cores count from there.
+n_perf_counters = 4
+timer_control_address = 0x34000
+timer_reset = 1 << 31
+
+
+def my_matmul(
+    M=512,
+    K=512,
+    N=512,
+    *,
+    m=64,
+    k=64,
+    n=64,
+    n_rows=4,
+    n_cols=4,
+    n_bds=16,
+    blocks_in_flight=2,
+    fifo_depth=2,
+    mem_fifo_depth=2,
+    acquire_size=1,
+    split_k=False,
+    accumulate=False,
+    dtype="bf16",
+    batch=1,
+    stride_A=None,
+    stride_B=None,
+    stride_C=None,
+    bias=False,
+    activation="none",
+    dataflow="output",
+    reuse=2,
+    transpose_A=False,
+    transpose_B=False,
+    transpose_C=False,
+    compact_sequence=False,
+    runtime_shape=False,
+    device_name=None,
+    col_offset=0,
+    block_mask=None,
+    repeat=1,
+    perf_counters=False,
+):
+    # mm.cc only exports the matmul kernels for one intrinsic per data type
+    dtype_out, (r, s, t) = datapaths[dtype]
+    word_size_in = word_sizes[dtype]
+    word_size_out = word_sizes[dtype_out]
+
     n_cores = n_rows * n_cols
 
-    A_sz_in_i32s = M * K * word_size_in // 4
-    B_sz_in_i32s = K * N * word_size_in // 4
-    C_sz_in_bytes = M * N * word_size_out
+    if device_name is None:
+        dev = npu1_partition(min(max(col_offset + n_cols, 1), 4))
+    else:
+        dev = devices[device_name]
+    if not 1 <= n_rows <= dev.n_core_rows:
+        raise ValueError(
+            "the grid must have 1 to {} rows on {}".format(dev.n_core_rows, dev.name)
+        )
+    # Column j of the grid is column cols[j] of the device.
+    cols = placement(dev, col_offset, n_cols)
+    check_tiling(m, k, n, r, s, t, word_size_in, word_size_out)
+    # The cascade and copy kernels of mm_ext.cc are bf16 only.
+    if (split_k or accumulate) and dtype != "bf16":
+        raise ValueError("split-K and accumulate modes are only implemented for bf16")
+    if not 1 <= acquire_size <= fifo_depth or mem_fifo_depth < 1:
+        raise ValueError("FIFO depths must be at least 1 and at least the acquire size")
+    # GELU is bf16 only.
+    epilogue = bias or activation != "none"
+    if activation == "gelu" and dtype != "bf16":
+        raise ValueError("the GELU epilogue is only implemented for bf16")
+    # The DMAs only move whole 32-bit words, so they transpose a tile at the
+    # granularity of the intrinsic's blocks: they deliver the blocks of A, B
+    # and C transposed, and the cores transpose each block in place with the
+    # kernels of mm_ext.cc.
+    transpose = transpose_A or transpose_B or transpose_C
+    if transpose_A and ((r * word_size_in) % 4 != 0 or (m * word_size_in) % 4 != 0):
+        raise ValueError("a transposed A needs r and m to be whole 32-bit words")
+    if transpose_C and ((r * word_size_out) % 4 != 0 or (m * word_size_out) % 4 != 0):
+        raise ValueError("a transposed C needs r and m to be whole 32-bit words")
+
+    A_row_groups = A_row_groups_for(n_rows, n_cols)
+    # A memory tile splits its A tiles to a group of rows in contiguous
+    # chunks, which the tiles of a transposed A would not be.
+    if transpose_A and max(len(group) for group in A_row_groups) > 1:
+        raise ValueError("a transposed A needs at least as many columns as rows")
+
+    # In split-K mode, all cores of a column work on the same output tile.
+    # Core row i takes the K tiles i, i + n_rows, i + 2 * n_rows, ..., so that
+    # the B tiles of all rows for one K step are contiguous in memory. The
+    # partial C tiles are summed up the column over the cascade interface,
+    # from the top row down to row 0, which writes the result.
+    if split_k:
+        if n_rows < 2:
+            raise ValueError("split-K needs at least two rows of cores")
+        if n_rows > n_cols:
+            raise ValueError("split-K needs at least as many columns as rows")
+    # In accumulate mode, the cores that write C start from the existing C
+    # tile instead of zero. The initial C tiles need shim input channels of
+    # their own: each shim sends B, and the first shims also send A, so the
+    # columns are split into groups that each receive their initial C tiles
+    # through one of the remaining shims and its memory tile.
+    if accumulate:
+        C_in_shims = list(range(len(A_row_groups), n_cols))
+        if not C_in_shims:
+            raise ValueError(
+                "accumulate mode needs a shim that does not send A; "
+                "use fewer rows than columns"
+            )
+        C_in_col_groups = contiguous_groups(n_cols, len(C_in_shims))
+    else:
+        C_in_shims = []
+        C_in_col_groups = []
+    # The bias vector takes the same route as the initial C tiles: each core
+    # that writes C receives the n bias values of every output tile, and the
+    # cores of a column all get the same ones.
+    if bias:
+        if accumulate:
+            raise ValueError(
+                "the bias epilogue and accumulate mode both need the shims "
+                "that do not send A"
+            )
+        bias_shims = list(range(len(A_row_groups), n_cols))
+        if not bias_shims:
+            raise ValueError(
+                "the bias epilogue needs a shim that does not send A; "
+                "use fewer rows than columns"
+            )
+        bias_col_groups = contiguous_groups(n_cols, len(bias_shims))
+    else:
+        bias_shims = []
+        bias_col_groups = []
+
+    # In the stationary dataflows, a core holds `reuse` output tiles at once:
+    # consecutive tiles of its row of tiles for A-stationary, of its column of
+    # tiles for B-stationary. It acquires each A (B) tile once for all of
+    # them and streams the B (A) tiles past it, so A (B) is fetched from DDR
+    # `reuse` times less often.
+    if reuse < 1:
+        raise ValueError("the reuse factor must be at least 1")
+    R = 1 if dataflow == "output" else reuse
+    R_A = R if dataflow == "A" else 1
+    R_B = R if dataflow == "B" else 1
+    if dataflow != "output" and split_k:
+        raise ValueError("the stationary dataflows do not support split-K")
+    # The initial C tiles would have to be sent in column-major order within
+    # a group of tile rows, which takes one more dimension than a shim BD has.
+    if dataflow == "B" and accumulate:
+        raise ValueError("the B-stationary dataflow does not support accumulate mode")
+    # The stacked B tiles of split-K and the initial C tiles of accumulate
+    # mode are not transposed.
+    if transpose_B and split_k:
+        raise ValueError("split-K does not support a transposed B")
+    if transpose_C and accumulate:
+        raise ValueError("accumulate mode does not support a transposed C")
+    if compact_sequence and dataflow != "output":
+        raise ValueError(
+            "the compact sequence only supports the output-stationary dataflow"
+        )
+    # In the block-sparse mode, B is stored compressed: the nonzero k x n
+    # blocks of each tile column, top to bottom, each block row-major, and
+    # the tile columns one after the other. The cores of a tile column run
+    # their K loop over its nonzero blocks only, and the sequence fetches
+    # just the A tiles these blocks are multiplied with.
+    if block_mask is not None:
+        if dataflow != "output" or split_k:
+            raise ValueError(
+                "the block-sparse mode only supports the output-stationary "
+                "dataflow without split-K"
+            )
+        if compact_sequence or runtime_shape:
+            raise ValueError(
+                "the block-sparse mode does not support the compact sequence "
+                "or a runtime shape"
+            )
+        if transpose_B or batch > 1:
+            raise ValueError(
+                "the block-sparse mode does not support a transposed B or batches"
+            )
+
+    # Rows of m-sized tiles of C computed per step of the runtime sequence,
+    # and K tiles per step of the cores' K loops.
+    C_tile_rows = 1 if split_k else n_rows
+    K_tiles_per_step = n_rows if split_k else 1
+
+    # The K loop consumes acquire_size tiles per iteration, so K is padded to
+    # a multiple of k * acquire_size. M and N are padded to whole groups of
+    # output tiles of the stationary dataflows.
+    M, K, N = padded_shape(
+        M,
+        K,
+        N,
+        m * C_tile_rows * R_B,
+        k * K_tiles_per_step * acquire_size,
+        n * n_cols * R_A,
+    )
+
+    # The matrices of a batch lie stride_A/B/C elements apart in their
+    # buffers, measured in the padded layout. By default they are packed back
+    # to back; a stride of 0 shares a single A or B across the batch.
+    if batch < 1:
+        raise ValueError("the batch count must be at least 1")
+    stride_A = M * K if stride_A is None else stride_A
+    stride_B = K * N if stride_B is None else stride_B
+    stride_C = M * N if stride_C is None else stride_C
+    for stride, word_size in (
+        (stride_A, word_size_in),
+        (stride_B, word_size_in),
+        (stride_C, word_size_out),
+    ):
+        if stride < 0 or (stride * word_size) % 4 != 0:
+            raise ValueError(
+                "batch strides must be a non-negative whole number of 32-bit words"
+            )
+    if batch > 1 and stride_C < M * N:
+        raise ValueError("the C matrices of a batch must not overlap")
+    # In the repeat mode, the sequence computes the whole product (batch)
+    # `repeat` times back to back, overwriting C each time, so that the host
+    # can divide the time of a launch by `repeat`. In accumulate mode, each
+    # repeat would add to the C of the previous one.
+    if repeat < 1:
+        raise ValueError("the repeat count must be at least 1")
+    if repeat > 1 and accumulate:
+        raise ValueError("the repeat mode does not support accumulate mode")
+    # The counters leave the array as one more C tile per core, which the
+    # memory tiles turn into rows like any other; they take the first words
+    # of its first row.
+    if perf_counters:
+        if split_k or transpose_C:
+            raise ValueError(
+                "the performance counters do not support split-K or a transposed C"
+            )
+        if n * word_size_out < 4 * n_perf_counters:
+            raise ValueError(
+                "the performance counters need C tile rows of at least {} "
+                "bytes".format(4 * n_perf_counters)
+            )
+
+    # Each core holds fifo_depth A and B tiles and two C tiles (two groups of
+    # R in the stationary dataflows). A memory tile
+    # holds the A tiles of its row group, the B tiles of its column and the C
+    # tiles of its column; linked FIFOs share their buffers in the memory
+    # tile, sized for the deeper of the two.
+    # In accumulate mode, a core also holds one initial C tile, and a memory
+    # tile the initial C tiles of its group of columns. With a bias, a core
+    # holds two bias slices, and a memory tile those of its group of columns.
+    A_group_size = max(len(group) for group in A_row_groups)
+    C_in_group_size = max([len(group) for group in C_in_col_groups], default=0)
+    bias_group_size = max([len(group) for group in bias_col_groups], default=0)
+    check_footprint(
+        fifo_depth * (m * k + k * n) * word_size_in
+        + (2 * R + (1 if accumulate else 0)) * m * n * word_size_out
+        + (2 * n * word_size_out if bias else 0)
+        + (4 * n_perf_counters if perf_counters else 0),
+        max(fifo_depth, mem_fifo_depth)
+        * (m * k * A_group_size + k * n * K_tiles_per_step)
+        * word_size_in
+        + 2 * m * n * C_tile_rows * (R + C_in_group_size) * word_size_out
+        + 2 * n * bias_group_size * word_size_out,
+    )
+
+    # Every FIFO from a memory tile to the cores takes one of its MM2S
+    # channels.
+    mem_mm2s = [0] * n_cols
+    for j, group in enumerate(A_row_groups):
+        mem_mm2s[j] += len(group)
+    for j in range(n_cols):
+        mem_mm2s[j] += K_tiles_per_step
+    for shim, group in zip(C_in_shims, C_in_col_groups):
+        mem_mm2s[shim] += len(group) * C_tile_rows
+    for shim, group in zip(bias_shims, bias_col_groups):
+        mem_mm2s[shim] += len(group)
+    for j in range(n_cols):
+        if mem_mm2s[j] > mem_tile_channels:
+            raise ValueError(
+                "memory tile {} would need {} MM2S channels, but only has {}".format(
+                    j, mem_mm2s[j], mem_tile_channels
+                )
+            )
+
+    A_sz_in_i32s = ((batch - 1) * stride_A + M * K) * word_size_in // 4
+    B_sz_in_i32s = ((batch - 1) * stride_B + K * N) * word_size_in // 4
+    # The bias vector is stored in the B buffer, after the B matrices.
+    bias_offset_in_i32s = B_sz_in_i32s
+    if bias:
+        B_sz_in_i32s += N * word_size_out // 4
+    C_sz_in_bytes = ((batch - 1) * stride_C + M * N) * word_size_out
     C_sz_in_i32s = C_sz_in_bytes // 4
+    # The counter tiles are stored after the C matrices, one m x n tile per
+    # core: row i of the cores, then column j.
+    perf_offset_in_i32s = C_sz_in_i32s
+    if perf_counters:
+        C_sz_in_i32s += n_rows * n_cols * m * n * word_size_out // 4
+    launch_iters = repeat * batch if perf_counters else 1
 
     M_div_m = M // m
-    M_div_m_div_n_rows = M // (m * n_rows)
+    M_div_m_div_n_rows = M // (m * C_tile_rows)
     K_div_k = K // k
+    K_div_k_per_core = K_div_k // K_tiles_per_step
     N_div_n = N // n
-    tiles = M_div_m * N_div_n // n_cores
+    tiles = M_div_m * N_div_n // (n_cols * C_tile_rows)
     N_div_n_div_n_cols = N_div_n // n_cols
 
+    if block_mask is not None:
+        if (len(block_mask), len(block_mask[0])) != (K_div_k, N_div_n):
+            raise ValueError(
+                "the block mask must have K / k = {} rows of N / n = {} blocks "
+                "for the (padded) shape".format(K_div_k, N_div_n)
+            )
+        # A round of a single group takes a BD for C and one for B besides
+        # those of the A runs.
+        group_K_tiles = block_sparse_K_tiles(block_mask, n_cols, max(1, n_bds - 2))
+        if any(len(K_tiles) % acquire_size != 0 for K_tiles in group_K_tiles):
+            raise ValueError(
+                "every group of {} tile columns must have a multiple of the "
+                "acquire size of nonzero K tiles".format(n_cols)
+            )
+        block_rounds = block_sparse_rounds(group_K_tiles, n_bds // blocks_in_flight)
+        stored = sum(row.count(True) for row in block_mask)
+        computed = n_cols * sum(len(K_tiles) for K_tiles in group_K_tiles)
+        sys.stderr.write(
+            "Block mask: {} of {} blocks of B nonzero, {} computed in groups of "
+            "{} tile columns ({:.1f}% of the dense MACs)\n".format(
+                stored,
+                K_div_k * N_div_n,
+                computed,
+                n_cols,
+                100 * computed / (K_div_k * N_div_n),
+            )
+        )
+
     # Matrix A: MxK, submatrices a: mxk
     k_in_i32s = k * word_size_in // 4
-    K_in_i32s = K * word_size_in // 4
-    m_x_n_rows = m * n_rows
+    m_in_i32s = m * word_size_in // 4
+    m_x_n_rows = m * C_tile_rows
 
     # Matrix B: KxN, submatrices b: kxn
     n_in_i32s = n * word_size_in // 4
-    N_in_i32s = N * word_size_in // 4
-    k_x_N_in_i32s = k * N * word_size_in // 4
-    n_x_n_cols_in_i32s = n_in_i32s * n_cols
 
     # Output Matrix C: MxN
     n_in_i32s_out = n * word_size_out // 4
     N_in_i32s_out = N * word_size_out // 4
-    m_x_n_rows_x_N_in_i32s_out = m * n_rows * N_in_i32s_out
     n_x_n_cols_in_i32s_out = n_in_i32s_out * n_cols
 
+    # A transposed operand is stored as the transpose of the matrix (A: KxM,
+    # B: NxK, C: NxM) and its tiles are moved as rows of the stored layout,
+    # i.e. transposed as well. The memory tiles and cores undo the
+    # transposition. The offsets below are in 32-bit words into the stored
+    # layout of element (row, col) of the untransposed matrix.
+    def A_offset_in_i32s(row, col):
+        if transpose_A:
+            return (col * M + row) * word_size_in // 4
+        return (row * K + col) * word_size_in // 4
+
+    def B_offset_in_i32s(row, col):
+        if transpose_B:
+            return (col * K + row) * word_size_in // 4
+        return (row * N + col) * word_size_in // 4
+
+    def C_offset_in_i32s(row, col):
+        if transpose_C:
+            return (col * M + row) * word_size_out // 4
+        return (row * N + col) * word_size_out // 4
+
+    # Rows and words per row of the tiles in their stored layout, and the
+    # distance between those rows
+    if transpose_A:
+        A_tile_dims = [[k, m_in_i32s] for _ in A_row_groups]
+        A_tile_row_stride_in_i32s = A_offset_in_i32s(0, 1)
+    else:
+        A_tile_dims = [[m * len(group), k_in_i32s] for group in A_row_groups]
+        A_tile_row_stride_in_i32s = A_offset_in_i32s(1, 0)
+    if transpose_B:
+        B_tile_dims = [n, k_in_i32s]
+        B_tile_row_stride_in_i32s = B_offset_in_i32s(0, 1)
+    else:
+        B_tile_dims = [k * K_tiles_per_step, n_in_i32s]
+        B_tile_row_stride_in_i32s = B_offset_in_i32s(1, 0)
+    if transpose_C:
+        C_tile_dims = [n, m_x_n_rows * word_size_out // 4]
+        C_tile_row_stride_in_i32s = C_offset_in_i32s(0, 1)
+    else:
+        C_tile_dims = [m_x_n_rows, n_in_i32s_out]
+        C_tile_row_stride_in_i32s = C_offset_in_i32s(1, 0)
+
+    report_ddr_bytes(
+        dataflow,
+        reuse,
+        batch,
+        M,
+        K,
+        N,
+        m,
+        n,
+        C_tile_rows,
+        n_cols,
+        word_size_in,
+        word_size_out,
+        accumulate=accumulate,
+        bias=bias,
+    )
+
     vectorized = True
 
     with mlir_mod_ctx() as ctx:
 
-        @device(AIEDevice.npu1_4col)
+        @device(getattr(AIEDevice, dev.name))
         def device_body():
-            memRef_inA_ty = T.memref(m * k, T.bf16())
-            memRef_inB_ty = T.memref(k * n, T.bf16())
-            memRef_outC_ty = T.memref(m * n * n_rows, T.bf16())
-            memRef_A_ty = T.memref(m, k, T.bf16())
-            memRef_B_ty = T.memref(k, n, T.bf16())
-            memRef_C_ty = T.memref(m, n, T.bf16())
+            in_ty = element_type(dtype)
+            out_ty = element_type(dtype_out)
+            memRef_inB_ty = T.memref(k * n * K_tiles_per_step, in_ty)
+            memRef_outC_ty = T.memref(m * n * C_tile_rows, out_ty)
+            memRef_A_ty = T.memref(m, k, in_ty)
+            memRef_B_ty = T.memref(k, n, in_ty)
+            memRef_C_ty = T.memref(m, n, out_ty)
 
             # AIE Core Function declarations
-            zero_scalar = external_func("zero_scalar_bf16", inputs=[memRef_C_ty])
-            zero = external_func("zero_bf16", inputs=[memRef_C_ty])
+            zero_scalar = external_func(
+                "zero_scalar_{}".format(dtype_out), inputs=[memRef_C_ty]
+            )
+            zero = external_func("zero_{}".format(dtype_out), inputs=[memRef_C_ty])
             matmul_scalar = external_func(
-                "matmul_scalar_bf16_bf16",
+                "matmul_scalar_{}_{}".format(dtype, dtype_out),
                 inputs=[memRef_A_ty, memRef_B_ty, memRef_C_ty],
             )
             matmul = external_func(
-                "matmul_bf16_bf16", inputs=[memRef_A_ty, memRef_B_ty, memRef_C_ty]
+                "matmul_{}_{}".format(dtype, dtype_out),
+                inputs=[memRef_A_ty, memRef_B_ty, memRef_C_ty],
             )
+            if split_k:
+                cascade_put = external_func("cascade_put_bf16", inputs=[memRef_C_ty])
+                cascade_get_add_put = external_func(
+                    "cascade_get_add_put_bf16", inputs=[memRef_C_ty]
+                )
+                cascade_get_add = external_func(
+                    "cascade_get_add_bf16", inputs=[memRef_C_ty]
+                )
+            if accumulate:
+                copy = external_func("copy_bf16", inputs=[memRef_C_ty, memRef_C_ty])
+            if bias:
+                memRef_bias_ty = T.memref(n, out_ty)
+                add_bias = external_func(
+                    "add_bias_{}_{}".format(dtype, dtype_out),
+                    inputs=[memRef_bias_ty, memRef_C_ty],
+                )
+            if activation != "none":
+                activate = external_func(
+                    "{}_{}".format(activation, dtype_out), inputs=[memRef_C_ty]
+                )
+            if transpose_A:
+                transpose_a = external_func(
+                    "transpose_a_{}".format(dtype), inputs=[memRef_A_ty]
+                )
+            if transpose_B:
+                transpose_b = external_func(
+                    "transpose_b_{}".format(dtype), inputs=[memRef_B_ty]
+                )
+            if transpose_C:
+                transpose_c = external_func(
+                    "transpose_c_{}_{}".format(dtype, dtype_out), inputs=[memRef_C_ty]
+                )
+            if perf_counters:
+                memRef_perf_ty = T.memref(n_perf_counters, T.i32())
+                perf_reset = external_func("perf_reset", inputs=[memRef_perf_ty])
+                perf_start = external_func("perf_start", inputs=[memRef_perf_ty])
+                perf_stop = external_func("perf_stop", inputs=[memRef_perf_ty])
+                perf_store = external_func(
+                    "perf_store_{}".format(dtype_out),
+                    inputs=[memRef_perf_ty, memRef_C_ty],
+                )
 
             # Tile declarations
-            _0_ShimTile = tile(0, 0)
-            _0_MemTile = tile(0, 1)
-            _0_ComputeTile2 = tile(0, 2)
-            _0_ComputeTile3 = tile(0, 3)
-            _0_ComputeTile4 = tile(0, 4)
-            _0_ComputeTile5 = tile(0, 5)
-            _0_cores = [
-                _0_ComputeTile2,
-                _0_ComputeTile3,
-                _0_ComputeTile4,
-                _0_ComputeTile5,
-            ]
-            _1_ShimTile = tile(1, 0)
-            _1_MemTile = tile(1, 1)
-            _1_ComputeTile2 = tile(1, 2)
-            _1_ComputeTile3 = tile(1, 3)
-            _1_ComputeTile4 = tile(1, 4)
-            _1_ComputeTile5 = tile(1, 5)
-            _1_cores = [
-                _1_ComputeTile2,
-                _1_ComputeTile3,
-                _1_ComputeTile4,
-                _1_ComputeTile5,
-            ]
-            _2_ShimTile = tile(2, 0)
-            _2_MemTile = tile(2, 1)
-            _2_ComputeTile2 = tile(2, 2)
-            _2_ComputeTile3 = tile(2, 3)
-            _2_ComputeTile4 = tile(2, 4)
-            _2_ComputeTile5 = tile(2, 5)
-            _2_cores = [
-                _2_ComputeTile2,
-                _2_ComputeTile3,
-                _2_ComputeTile4,
-                _2_ComputeTile5,
-            ]
-            _3_ShimTile = tile(3, 0)
-            _3_MemTile = tile(3, 1)
-            _3_ComputeTile2 = tile(3, 2)
-            _3_ComputeTile3 = tile(3, 3)
-            _3_ComputeTile4 = tile(3, 4)
-            _3_ComputeTile5 = tile(3, 5)
-            _3_cores = [
-                _3_ComputeTile2,
-                _3_ComputeTile3,
-                _3_ComputeTile4,
-                _3_ComputeTile5,
-            ]
-            shims = [_0_ShimTile, _1_ShimTile, _2_ShimTile, _3_ShimTile]
-            mems = [_0_MemTile, _1_MemTile, _2_MemTile, _3_MemTile]
+            shims = [tile(col, dev.shim_row) for col in cols]
+            mems = [tile(col, dev.mem_row) for col in cols]
             cores = [
-                [_0_ComputeTile2, _0_ComputeTile3, _0_ComputeTile4, _0_ComputeTile5],
-                [_1_ComputeTile2, _1_ComputeTile3, _1_ComputeTile4, _1_ComputeTile5],
-                [_2_ComputeTile2, _2_ComputeTile3, _2_ComputeTile4, _2_ComputeTile5],
-                [_3_ComputeTile2, _3_ComputeTile3, _3_ComputeTile4, _3_ComputeTile5],
+                [tile(col, dev.core_row + row) for row in range(n_rows)] for col in cols
             ]
             t_cores = [
                 [cores[j][i] for j in range(len(cores))] for i in range(len(cores[0]))
             ]
-            inA_fifo_names = ["inA0", "inA1", "inA2", "inA3"]
+            inA_fifo_names = ["inA{}".format(j) for j in range(len(A_row_groups))]
             inA_fifos = {}
-            inB_fifo_names = ["inB0", "inB1", "inB2", "inB3"]
+            inB_fifo_names = ["inB{}".format(j) for j in range(n_cols)]
             inB_fifos = {}
-            memA_fifo_names = ["memA0", "memA1", "memA2", "memA3"]
+            memA_fifo_names = ["memA{}".format(i) for i in range(n_rows)]
             memA_fifos = {}
-            memB_fifo_names = ["memB0", "memB1", "memB2", "memB3"]
+            # In split-K mode, every core receives its own B tiles and only the
+            # cores of row 0 send C tiles.
+            if split_k:
+                memB_fifo_names = [
+                    ["memB{}{}".format(i, j) for i in range(n_rows)]
+                    for j in range(n_cols)
+                ]
+            else:
+                memB_fifo_names = [["memB{}".format(j)] * n_rows for j in range(n_cols)]
             memB_fifos = {}
-            _0_outC_fifo_names = ["memC00", "memC10", "memC20", "memC30"]
-            _0_outC_fifos = {}
-            _1_outC_fifo_names = ["memC01", "memC11", "memC21", "memC31"]
-            _1_outC_fifos = {}
-            _2_outC_fifo_names = ["memC02", "memC12", "memC22", "memC32"]
-            _2_outC_fifos = {}
-            _3_outC_fifo_names = ["memC03", "memC13", "memC23", "memC33"]
-            _3_outC_fifos = {}
             memC_fifo_names = [
-                _0_outC_fifo_names,
-                _1_outC_fifo_names,
-                _2_outC_fifo_names,
-                _3_outC_fifo_names,
+                ["memC{}{}".format(i, j) for i in range(C_tile_rows)]
+                for j in range(n_cols)
             ]
-            memC_fifos = [_0_outC_fifos, _1_outC_fifos, _2_outC_fifos, _3_outC_fifos]
-            outC_fifo_names = ["outC0", "outC1", "outC2", "outC3"]
+            memC_fifos = [{} for _ in range(n_cols)]
+            outC_fifo_names = ["outC{}".format(j) for j in range(n_cols)]
             outC_fifos = {}
+            inC_fifo_names = {}
+            memCin_fifos = {}
+            inBias_fifo_names = {}
+            memBias_fifos = {}
+
+            # Tiling transformations from the row-major tiles in the memory
+            # tiles to the r x s, s x t and r x t blocks the cores work on. A
+            # transposed tile yields the transposed blocks instead.
+            if transpose_A:
+                memA_dims = [(m // r, r), (k // s, s * m), (s, m), (r, 1)]
+            else:
+                memA_dims = [(m // r, r * k), (k // s, s), (r, k), (s, 1)]
+            if transpose_B:
+                memB_dims = [(k // s, s), (n // t, t * k), (t, k), (s, 1)]
+            else:
+                memB_dims = [(k // s, s * n), (n // t, t), (s, n), (t, 1)]
+            if transpose_C:
+                outC_dims = [
+                    (n // t, r * t),
+                    (t, r),
+                    (m * C_tile_rows // r, r * n),
+                    (r, 1),
+                ]
+            else:
+                outC_dims = [(m // r, r * n), (r, t), (n // t, r * t), (t, 1)]
 
             # AIE-array data movement with object fifos
             # Input A
-            for i in range(n_cols):
-                inA_fifos[inA_fifo_names[i]] = object_fifo(
-                    inA_fifo_names[i],
-                    shims[i],
-                    mems[i],
-                    2,
-                    memRef_inA_ty,
-                )
-                memA_fifos[memA_fifo_names[i]] = object_fifo(
-                    memA_fifo_names[i],
-                    mems[i],
-                    t_cores[i][0:n_cols],
-                    2,
-                    memRef_A_ty,
-                    [
-                        (m // r, r * k),
-                        (k // s, s),
-                        (r, k),
-                        (s, 1),
-                    ],
+            # Each row of cores receives its A tiles through one column's shim
+            # and memory tile. If there are more rows than columns, a memory
+            # tile splits a block of stacked tiles to a group of rows.
+            for j, row_group in enumerate(A_row_groups):
+                inA_fifos[inA_fifo_names[j]] = object_fifo(
+                    inA_fifo_names[j],
+                    shims[j],
+                    mems[j],
+                    mem_fifo_depth,
+                    T.memref(m * k * len(row_group), in_ty),
                 )
-                object_fifo_link(inA_fifo_names[i], memA_fifo_names[i])
+                for i in row_group:
+                    memA_fifos[memA_fifo_names[i]] = object_fifo(
+                        memA_fifo_names[i],
+                        mems[j],
+                        t_cores[i][0:n_cols],
+                        fifo_depth,
+                        memRef_A_ty,
+                        memA_dims,
+                    )
+                if len(row_group) == 1:
+                    object_fifo_link(inA_fifo_names[j], memA_fifo_names[row_group[0]])
+                else:
+                    object_fifo_link(
+                        inA_fifo_names[j], [memA_fifo_names[i] for i in row_group]
+                    )
 
             # Input B
             for i in range(n_cols):
@@ -211,32 +1075,39 @@ def my_matmul(M=512, K=512, N=512):
                     inB_fifo_names[i],
                     shims[i],
                     mems[i],
-                    2,
+                    mem_fifo_depth,
                     memRef_inB_ty,
                 )
-                memB_fifos[memB_fifo_names[i]] = object_fifo(
-                    memB_fifo_names[i],
-                    mems[i],
-                    cores[i][0:n_rows],
-                    2,
-                    memRef_B_ty,
-                    [
-                        (k // s, s * n),
-                        (n // t, t),
-                        (s, n),
-                        (t, 1),
-                    ],
-                )
-                object_fifo_link(inB_fifo_names[i], memB_fifo_names[i])
+                # Without split-K, all rows of a column share the B tiles;
+                # with it, the memory tile splits a block of stacked B tiles
+                # to the rows.
+                memB_consumers = {}
+                for j in range(n_rows):
+                    memB_consumers.setdefault(memB_fifo_names[i][j], []).append(
+                        cores[i][j]
+                    )
+                for name, consumers in memB_consumers.items():
+                    memB_fifos[name] = object_fifo(
+                        name,
+                        mems[i],
+                        consumers,
+                        fifo_depth,
+                        memRef_B_ty,
+                        memB_dims,
+                    )
+                if split_k:
+                    object_fifo_link(inB_fifo_names[i], memB_fifo_names[i])
+                else:
+                    object_fifo_link(inB_fifo_names[i], memB_fifo_names[i][0])
 
             # Output C
             for i in range(n_cols):
-                for j in range(n_rows):
+                for j in range(C_tile_rows):
                     memC_fifos[i][memC_fifo_names[i][j]] = object_fifo(
                         memC_fifo_names[i][j],
                         cores[i][j],
                         mems[i],
-                        2,
+                        2 * R,
                         memRef_C_ty,
                     )
                 outC_fifos[outC_fifo_names[i]] = object_fifo(
@@ -245,51 +1116,341 @@ def my_matmul(M=512, K=512, N=512):
                     shims[i],
                     2,
                     memRef_outC_ty,
-                    [
-                        (m // r, r * n),
-                        (r, t),
-                        (n // t, r * t),
-                        (t, 1),
-                    ],
+                    outC_dims,
+                )
+                if split_k:
+                    object_fifo_link(memC_fifo_names[i][0], outC_fifo_names[i])
+                else:
+                    object_fifo_link(memC_fifo_names[i], outC_fifo_names[i])
+
+            # Initial C for accumulate mode, in the layout the cores use for C.
+            # A single tile suffices on the cores: it is released as soon as
+            # it has been copied into the output tile.
+            for shim, col_group in zip(C_in_shims, C_in_col_groups):
+                inC_fifo_names[shim] = "inC{}".format(shim)
+                object_fifo(
+                    inC_fifo_names[shim],
+                    shims[shim],
+                    mems[shim],
+                    2,
+                    T.memref(m * n * C_tile_rows * len(col_group), out_ty),
+                )
+                for j in col_group:
+                    for i in range(C_tile_rows):
+                        memCin_fifos[j, i] = object_fifo(
+                            "memCin{}{}".format(i, j),
+                            mems[shim],
+                            cores[j][i],
+                            1,
+                            memRef_C_ty,
+                            [
+                                (m // r, r * n),
+                                (n // t, t),
+                                (r, n),
+                                (t, 1),
+                            ],
+                        )
+                memCin_fifo_names = [
+                    "memCin{}{}".format(i, j)
+                    for j in col_group
+                    for i in range(C_tile_rows)
+                ]
+                if len(memCin_fifo_names) == 1:
+                    object_fifo_link(inC_fifo_names[shim], memCin_fifo_names[0])
+                else:
+                    object_fifo_link(inC_fifo_names[shim], memCin_fifo_names)
+
+            # Bias slices for the epilogue, broadcast to the cores of a column
+            for shim, col_group in zip(bias_shims, bias_col_groups):
+                inBias_fifo_names[shim] = "inBias{}".format(shim)
+                object_fifo(
+                    inBias_fifo_names[shim],
+                    shims[shim],
+                    mems[shim],
+                    2,
+                    T.memref(n * len(col_group), out_ty),
                 )
-                object_fifo_link(memC_fifo_names[i], outC_fifo_names[i])
+                for j in col_group:
+                    memBias_fifos[j] = object_fifo(
+                        "memBias{}".format(j),
+                        mems[shim],
+                        cores[j][0:C_tile_rows],
+                        2,
+                        memRef_bias_ty,
+                    )
+                memBias_fifo_names = ["memBias{}".format(j) for j in col_group]
+                if len(memBias_fifo_names) == 1:
+                    object_fifo_link(inBias_fifo_names[shim], memBias_fifo_names[0])
+                else:
+                    object_fifo_link(inBias_fifo_names[shim], memBias_fifo_names)
+
+            # Cascade connections for the split-K reduction, from the top row
+            # of each column down to row 0
+            if split_k:
+                for j in range(n_cols):
+                    for i in range(n_rows - 1):
+                        cascade_flow(cores[j][i + 1], cores[j][i])
+                # The cores above row 0 keep their partial C tile in a local
+                # buffer.
+                partial_C = {}
+                for j in range(n_cols):
+                    for i in range(1, n_rows):
+                        partial_C[j, i] = buffer(
+                            cores[j][i],
+                            [m, n],
+                            out_ty,
+                            name="partC{}{}".format(i, j),
+                        )
+
+            # Runtime parameters: the number of (groups of) output tiles of a
+            # launch and of K loop iterations per output tile
+            rtp_names = {}
+            rtps = {}
+            rtp_locks = {}
+            if runtime_shape:
+                for j in range(n_cols):
+                    for i in range(n_rows):
+                        rtp_names[j, i] = "rtp{}{}".format(i, j)
+                        rtps[j, i] = buffer(
+                            cores[j][i], [2], T.i32(), name=rtp_names[j, i]
+                        )
+                        rtp_locks[j, i] = lock(
+                            cores[j][i],
+                            lock_id=rtp_lock_id,
+                            init=0,
+                            sym_name="rtp_lock{}{}".format(i, j),
+                        )
+
+            # Performance counters of each core
+            perf_bufs = {}
+            if perf_counters:
+                for j in range(n_cols):
+                    for i in range(n_rows):
+                        perf_bufs[j, i] = buffer(
+                            cores[j][i],
+                            [n_perf_counters],
+                            T.i32(),
+                            name="perf{}{}".format(i, j),
+                        )
 
             # Set up compute tiles
             for j in range(n_cols):
                 for i in range(n_rows):
                     # Compute tile i
-                    @core(cores[j][i], "mm.o")
+                    @core(
+                        cores[j][i],
+                        kernel_object(
+                            m,
+                            k,
+                            n,
+                            split_k
+                            or accumulate
+                            or epilogue
+                            or transpose
+                            or perf_counters,
+                        ),
+                    )
                     def core_body():
+                        memA_fifo = memA_fifos[memA_fifo_names[i]]
+                        memB_fifo = memB_fifos[memB_fifo_names[j][i]]
+                        writes_C = i < C_tile_rows
+                        if perf_counters:
+                            call(perf_reset, [perf_bufs[j, i]])
                         for _ in for_(0xFFFFFFFF):
-                            for _ in for_(tiles):
-                                elem_out = memC_fifos[j][memC_fifo_names[j][i]].acquire(
-                                    ObjectFifoPort.Produce,
-                                    1,
+                            if runtime_shape:
+                                use_lock(
+                                    rtp_locks[j, i],
+                                    LockAction.AcquireGreaterEqual,
+                                    value=1,
+                                )
+                                tile_iters = arith.index_cast(
+                                    memref.load(rtps[j, i], [0]), to=T.index()
                                 )
-                                call(zero, [elem_out])
+                                K_iters = arith.index_cast(
+                                    memref.load(rtps[j, i], [1]), to=T.index()
+                                )
+                            else:
+                                # The counters are stored once per launch, so
+                                # the cores then count the output tiles of
+                                # the whole launch.
+                                tile_iters = launch_iters * tiles // R
+                                K_iters = K_div_k_per_core // acquire_size
 
-                                for _ in for_(K_div_k):
-                                    elem_in_a = memA_fifos[memA_fifo_names[i]].acquire(
-                                        ObjectFifoPort.Consume,
-                                        1,
+                            def timed_matmul(operands):
+                                if perf_counters:
+                                    call(perf_start, [perf_bufs[j, i]])
+                                call(matmul, operands)
+                                if perf_counters:
+                                    call(perf_stop, [perf_bufs[j, i]])
+
+                            def output_tile(K_iters):
+                                if writes_C:
+                                    memC_fifo = memC_fifos[j][memC_fifo_names[j][i]]
+                                    elems_out = memC_fifo.acquire(
+                                        ObjectFifoPort.Produce,
+                                        R,
                                     )
-                                    elem_in_b = memB_fifos[memB_fifo_names[j]].acquire(
+                                    if R == 1:
+                                        elems_out = [elems_out]
+                                else:
+                                    elems_out = [partial_C[j, i]]
+                                for elem_out in elems_out:
+                                    if accumulate and writes_C:
+                                        elem_in_c = memCin_fifos[j, i].acquire(
+                                            ObjectFifoPort.Consume,
+                                            1,
+                                        )
+                                        call(copy, [elem_in_c, elem_out])
+                                        memCin_fifos[j, i].release(
+                                            ObjectFifoPort.Consume, 1
+                                        )
+                                    else:
+                                        call(zero, [elem_out])
+
+                                if dataflow == "output":
+                                    elem_out = elems_out[0]
+                                    for _ in for_(K_iters):
+                                        elems_in_a = memA_fifo.acquire(
+                                            ObjectFifoPort.Consume,
+                                            acquire_size,
+                                        )
+                                        elems_in_b = memB_fifo.acquire(
+                                            ObjectFifoPort.Consume,
+                                            acquire_size,
+                                        )
+                                        if acquire_size == 1:
+                                            elems_in_a = [elems_in_a]
+                                            elems_in_b = [elems_in_b]
+                                        for elem_in_a, elem_in_b in zip(
+                                            elems_in_a, elems_in_b
+                                        ):
+                                            if transpose_A:
+                                                call(transpose_a, [elem_in_a])
+                                            if transpose_B:
+                                                call(transpose_b, [elem_in_b])
+                                            timed_matmul(
+                                                [elem_in_a, elem_in_b, elem_out]
+                                            )
+                                        memA_fifo.release(
+                                            ObjectFifoPort.Consume, acquire_size
+                                        )
+                                        memB_fifo.release(
+                                            ObjectFifoPort.Consume, acquire_size
+                                        )
+                                        yield_([])
+                                else:
+                                    # The stationary tile is applied to all R
+                                    # output tiles; the other operand streams
+                                    # in one tile per output tile.
+                                    if dataflow == "A":
+                                        held_fifo, streamed_fifo = memA_fifo, memB_fifo
+                                        transpose_held = (
+                                            transpose_a if transpose_A else None
+                                        )
+                                        transpose_streamed = (
+                                            transpose_b if transpose_B else None
+                                        )
+                                    else:
+                                        held_fifo, streamed_fifo = memB_fifo, memA_fifo
+                                        transpose_held = (
+                                            transpose_b if transpose_B else None
+                                        )
+                                        transpose_streamed = (
+                                            transpose_a if transpose_A else None
+                                        )
+                                    for _ in for_(K_iters):
+                                        elems_held = held_fifo.acquire(
+                                            ObjectFifoPort.Consume,
+                                            acquire_size,
+                                        )
+                                        if acquire_size == 1:
+                                            elems_held = [elems_held]
+                                        for elem_held in elems_held:
+                                            if transpose_held is not None:
+                                                call(transpose_held, [elem_held])
+                                            for elem_out in elems_out:
+                                                elem_streamed = streamed_fifo.acquire(
+                                                    ObjectFifoPort.Consume,
+                                                    1,
+                                                )
+                                                if transpose_streamed is not None:
+                                                    call(
+                                                        transpose_streamed,
+                                                        [elem_streamed],
+                                                    )
+                                                if dataflow == "A":
+                                                    operands = [
+                                                        elem_held,
+                                                        elem_streamed,
+                                                    ]
+                                                else:
+                                                    operands = [
+                                                        elem_streamed,
+                                                        elem_held,
+                                                    ]
+                                                timed_matmul(operands + [elem_out])
+                                                streamed_fifo.release(
+                                                    ObjectFifoPort.Consume, 1
+                                                )
+                                        held_fifo.release(
+                                            ObjectFifoPort.Consume, acquire_size
+                                        )
+                                        yield_([])
+
+                                if split_k:
+                                    elem_out = elems_out[0]
+                                    if i == n_rows - 1:
+                                        call(cascade_put, [elem_out])
+                                    elif i > 0:
+                                        call(cascade_get_add_put, [elem_out])
+                                    else:
+                                        call(cascade_get_add, [elem_out])
+                                # Epilogue on the finished C tiles. In the
+                                # B-stationary dataflow, they all lie in the
+                                # same tile column and share one bias slice.
+                                if bias and writes_C and dataflow == "B":
+                                    elem_bias = memBias_fifos[j].acquire(
                                         ObjectFifoPort.Consume,
                                         1,
                                     )
-                                    call(matmul, [elem_in_a, elem_in_b, elem_out])
-                                    memA_fifos[memA_fifo_names[i]].release(
-                                        ObjectFifoPort.Consume, 1
-                                    )
-                                    memB_fifos[memB_fifo_names[j]].release(
-                                        ObjectFifoPort.Consume, 1
-                                    )
-                                    yield_([])
+                                    for elem_out in elems_out:
+                                        call(add_bias, [elem_bias, elem_out])
+                                    memBias_fifos[j].release(ObjectFifoPort.Consume, 1)
+                                elif bias and writes_C:
+                                    for elem_out in elems_out:
+                                        elem_bias = memBias_fifos[j].acquire(
+                                            ObjectFifoPort.Consume,
+                                            1,
+                                        )
+                                        call(add_bias, [elem_bias, elem_out])
+                                        memBias_fifos[j].release(
+                                            ObjectFifoPort.Consume, 1
+                                        )
+                                if activation != "none" and writes_C:
+                                    for elem_out in elems_out:
+                                        call(activate, [elem_out])
+                                if transpose_C and writes_C:
+                                    for elem_out in elems_out:
+                                        call(transpose_c, [elem_out])
+                                if writes_C:
+                                    memC_fifo.release(ObjectFifoPort.Produce, R)
 
-                                memC_fifos[j][memC_fifo_names[j][i]].release(
-                                    ObjectFifoPort.Produce, 1
-                                )
-                                yield_([])
+                            if block_mask is None:
+                                for _ in for_(tile_iters):
+                                    output_tile(K_iters)
+                                    yield_([])
+                            else:
+                                # The tile columns of a row of tiles differ in
+                                # their number of K steps.
+                                for _ in for_(launch_iters * M_div_m_div_n_rows):
+                                    for K_tiles in group_K_tiles:
+                                        output_tile(len(K_tiles) // acquire_size)
+                                    yield_([])
+                            if perf_counters:
+                                memC_fifo = memC_fifos[j][memC_fifo_names[j][i]]
+                                elem_perf = memC_fifo.acquire(ObjectFifoPort.Produce, 1)
+                                call(perf_store, [perf_bufs[j, i], elem_perf])
+                                memC_fifo.release(ObjectFifoPort.Produce, 1)
                             yield_([])
 
             # To/from AIE-array data movement
@@ -300,74 +1461,662 @@ def my_matmul(M=512, K=512, N=512):
                 T.memref(C_sz_in_i32s, T.i32()),
             )
             def sequence(A, B, C):
-                # only do 5 tile rows at a time before synchronizing, so we can reuse BDs
-                rows_per_block = 5
-                for tile_row_block in range(
-                    (M_div_m_div_n_rows + rows_per_block - 1) // rows_per_block
-                ):
-                    num_tile_rows = min(
-                        [
-                            rows_per_block,
-                            M_div_m_div_n_rows - tile_row_block * rows_per_block,
+                if runtime_shape:
+                    for j in range(n_cols):
+                        for i in range(n_rows):
+                            # The cores see the repeated batch as one long
+                            # stream of output tiles.
+                            npu_rtp_write(
+                                rtp_names[j, i], 0, repeat * batch * tiles // R
+                            )
+                            npu_rtp_write(
+                                rtp_names[j, i], 1, K_div_k_per_core // acquire_size
+                            )
+                            npu_write32(
+                                column=cols[j],
+                                row=dev.core_row + i,
+                                address=lock_value_address + 0x10 * rtp_lock_id,
+                                value=1,
+                            )
+                if perf_counters:
+                    for j in range(n_cols):
+                        for i in range(n_rows):
+                            npu_write32(
+                                column=cols[j],
+                                row=dev.core_row + i,
+                                address=timer_control_address,
+                                value=timer_reset,
+                            )
+
+                # Each block of tile rows needs one BD for C and, per tile
+                # row, one for A and one for B (one per group of R tile
+                # columns in the A-stationary dataflow, one per transfer in
+                # the block-sparse mode). Size the blocks so that
+                # blocks_in_flight of them fit into a shim's BDs at once. In
+                # the block-sparse and A-stationary modes, a tile row whose
+                # transfers do not fit is split into rounds of tile columns,
+                # each a block of its own.
+                if block_mask is not None:
+                    row_rounds = block_rounds
+                    A_bds_per_row = max(1, len(row_rounds[0][2]))
+                    B_bds_per_row = len(row_rounds[0][3])
+                else:
+                    row_rounds = [(0, N_div_n_div_n_cols, None, None)]
+                    A_bds_per_row = 1
+                    B_bds_per_row = N_div_n_div_n_cols // R_A if dataflow == "A" else 1
+                    if 1 + A_bds_per_row + B_bds_per_row > n_bds // blocks_in_flight:
+                        cols_per_round = R_A * max(1, n_bds // blocks_in_flight - 2)
+                        row_rounds = [
+                            (
+                                first_group,
+                                min(cols_per_round, N_div_n_div_n_cols - first_group),
+                                None,
+                                None,
+                            )
+                            for first_group in range(
+                                0, N_div_n_div_n_cols, cols_per_round
+                            )
                         ]
-                    )
-                    C_row_offset = (
-                        tile_row_block * rows_per_block * m * n_rows * N * word_size_out
-                    )
-                    for i in range(n_cols):
-                        C_col_offset = i * n * word_size_out
-                        C_offset_in_i32s = (C_col_offset + C_row_offset) // 4
-                        npu_dma_memcpy_nd(
-                            metadata=outC_fifo_names[i],
-                            bd_id=0,
-                            mem=C,
-                            offsets=[0, 0, 0, C_offset_in_i32s],
-                            sizes=[
-                                num_tile_rows,
-                                N_div_n_div_n_cols,
-                                m_x_n_rows,
-                                n_in_i32s_out,
-                            ],
-                            strides=[
-                                m_x_n_rows_x_N_in_i32s_out,
-                                n_x_n_cols_in_i32s_out,
-                                N_in_i32s_out,
-                            ],
+                rows_per_block = max(
+                    1,
+                    (n_bds // blocks_in_flight - 1) // (A_bds_per_row + B_bds_per_row),
+                )
+                if len(row_rounds) > 1:
+                    rows_per_block = 1
+                bd_pools = [BDPool(col, n_bds) for col in cols]
+
+                # In the B-stationary dataflow, the sequence walks groups of R
+                # tile rows. The cores compute the R output tiles of a tile
+                # column together, so per K step, they need the A tiles of all
+                # R tile rows. This takes one A BD per tile column, so a group
+                # whose tile columns do not fit into a block is split into
+                # chunks of tile columns, each a block of its own.
+                if 2 + N_div_n_div_n_cols > n_bds // blocks_in_flight:
+                    cols_per_chunk = max(1, n_bds // blocks_in_flight - 2)
+                else:
+                    cols_per_chunk = N_div_n_div_n_cols
+
+                def B_stationary_sequence(
+                    A,
+                    B,
+                    C,
+                    bd_pools,
+                    A_batch_offset_in_i32s,
+                    B_batch_offset_in_i32s,
+                    C_batch_offset_in_i32s,
+                ):
+                    for tile_row_group, first_tile_col in itertools.product(
+                        range(M_div_m_div_n_rows // R_B),
+                        range(0, N_div_n_div_n_cols, cols_per_chunk),
+                    ):
+                        row_offset = tile_row_group * R_B * m_x_n_rows
+                        num_tile_cols = min(
+                            cols_per_chunk, N_div_n_div_n_cols - first_tile_col
                         )
-                        for tile_row in range(num_tile_rows):
-                            A_row_offset_in_i32s = (
-                                ((tile_row_block * rows_per_block) + tile_row)
-                                * n_rows
-                                * m
-                                * K
-                                * word_size_in
-                                // 4
-                            )
-                            A_col_offset_in_i32s = i * m * K * word_size_in // 4
-                            B_col_offset_in_i32s = i * n * word_size_in // 4
+                        for i in range(n_cols):
+                            if i < len(A_row_groups):
+                                bds = bd_pools[i].acquire(2 + num_tile_cols)
+                            elif i in inBias_fifo_names:
+                                bds = bd_pools[i].acquire(3)
+                            else:
+                                bds = bd_pools[i].acquire(2)
                             npu_dma_memcpy_nd(
-                                metadata=inA_fifo_names[i],
-                                bd_id=2 * tile_row + 1,
-                                mem=A,
+                                metadata=outC_fifo_names[i],
+                                bd_id=bds[0],
+                                mem=C,
                                 offsets=[
                                     0,
                                     0,
                                     0,
-                                    A_col_offset_in_i32s + A_row_offset_in_i32s,
+                                    C_batch_offset_in_i32s
+                                    + C_offset_in_i32s(
+                                        row_offset, (i + first_tile_col * n_cols) * n
+                                    ),
+                                ],
+                                sizes=[num_tile_cols, R_B] + C_tile_dims,
+                                strides=[
+                                    C_offset_in_i32s(0, n * n_cols),
+                                    C_offset_in_i32s(m_x_n_rows, 0),
+                                    C_tile_row_stride_in_i32s,
                                 ],
-                                sizes=[N_div_n_div_n_cols, K_div_k, m, k_in_i32s],
-                                strides=[0, k_in_i32s, K_in_i32s],
                             )
                             npu_dma_memcpy_nd(
                                 metadata=inB_fifo_names[i],
-                                bd_id=2 * tile_row + 2,
+                                bd_id=bds[1],
                                 mem=B,
-                                offsets=[0, 0, 0, B_col_offset_in_i32s],
-                                sizes=[N_div_n_div_n_cols, K_div_k, k, n_in_i32s],
-                                strides=[n_x_n_cols_in_i32s, k_x_N_in_i32s, N_in_i32s],
+                                offsets=[
+                                    0,
+                                    0,
+                                    0,
+                                    B_batch_offset_in_i32s
+                                    + B_offset_in_i32s(
+                                        0, (i + first_tile_col * n_cols) * n
+                                    ),
+                                ],
+                                sizes=[num_tile_cols, K_div_k_per_core] + B_tile_dims,
+                                strides=[
+                                    B_offset_in_i32s(0, n * n_cols),
+                                    B_offset_in_i32s(k, 0),
+                                    B_tile_row_stride_in_i32s,
+                                ],
                             )
+                            # One bias slice per output tile column
+                            if i in inBias_fifo_names:
+                                col_group = bias_col_groups[bias_shims.index(i)]
+                                npu_dma_memcpy_nd(
+                                    metadata=inBias_fifo_names[i],
+                                    bd_id=bds[2],
+                                    mem=B,
+                                    offsets=[
+                                        0,
+                                        0,
+                                        0,
+                                        bias_offset_in_i32s
+                                        + (first_tile_col * n_cols + col_group[0])
+                                        * n_in_i32s_out,
+                                    ],
+                                    sizes=[
+                                        1,
+                                        num_tile_cols,
+                                        len(col_group),
+                                        n_in_i32s_out,
+                                    ],
+                                    strides=[
+                                        0,
+                                        n_x_n_cols_in_i32s_out,
+                                        n_in_i32s_out,
+                                    ],
+                                )
+                            if i < len(A_row_groups):
+                                for tile_col in range(num_tile_cols):
+                                    npu_dma_memcpy_nd(
+                                        metadata=inA_fifo_names[i],
+                                        bd_id=bds[2 + tile_col],
+                                        mem=A,
+                                        offsets=[
+                                            0,
+                                            0,
+                                            0,
+                                            A_batch_offset_in_i32s
+                                            + A_offset_in_i32s(
+                                                row_offset + A_row_groups[i][0] * m, 0
+                                            ),
+                                        ],
+                                        sizes=[K_div_k_per_core, R_B] + A_tile_dims[i],
+                                        strides=[
+                                            A_offset_in_i32s(0, k),
+                                            A_offset_in_i32s(m_x_n_rows, 0),
+                                            A_tile_row_stride_in_i32s,
+                                        ],
+                                    )
+
+                # The compact sequence walks the output tiles column by column
+                # instead of row by row. Then each of the A, B, initial C and
+                # bias streams of a tile column takes one BD for all tile rows
+                # (up to the repeat limit of a BD), so the sequence and its
+                # syncs grow with N, but no longer with M. The cores do not
+                # depend on the order of the output tiles. Each block of tile
+                # columns needs one BD for C and, per tile column, one for A
+                # and one for B.
+                cols_per_block = max(1, (n_bds // blocks_in_flight - 1) // 2)
+                rows_per_chunk = min(M_div_m_div_n_rows, dma_max_repeat)
+
+                def column_major_sequence(
+                    A,
+                    B,
+                    C,
+                    bd_pools,
+                    A_batch_offset_in_i32s,
+                    B_batch_offset_in_i32s,
+                    C_batch_offset_in_i32s,
+                ):
+                    for row_chunk in range(
+                        (M_div_m_div_n_rows + rows_per_chunk - 1) // rows_per_chunk
+                    ):
+                        num_tile_rows = min(
+                            rows_per_chunk,
+                            M_div_m_div_n_rows - row_chunk * rows_per_chunk,
+                        )
+                        C_row = row_chunk * rows_per_chunk * m_x_n_rows
+                        for tile_col_block in range(
+                            (N_div_n_div_n_cols + cols_per_block - 1) // cols_per_block
+                        ):
+                            first_tile_col = tile_col_block * cols_per_block
+                            num_tile_cols = min(
+                                cols_per_block, N_div_n_div_n_cols - first_tile_col
+                            )
+                            for i in range(n_cols):
+                                bds = bd_pools[i].acquire(1 + 2 * num_tile_cols)
+                                npu_dma_memcpy_nd(
+                                    metadata=outC_fifo_names[i],
+                                    bd_id=bds[0],
+                                    mem=C,
+                                    offsets=[
+                                        0,
+                                        0,
+                                        0,
+                                        C_batch_offset_in_i32s
+                                        + C_offset_in_i32s(
+                                            C_row, (i + first_tile_col * n_cols) * n
+                                        ),
+                                    ],
+                                    sizes=[num_tile_cols, num_tile_rows] + C_tile_dims,
+                                    strides=[
+                                        C_offset_in_i32s(0, n * n_cols),
+                                        C_offset_in_i32s(m_x_n_rows, 0),
+                                        C_tile_row_stride_in_i32s,
+                                    ],
+                                )
+                                for tile_col in range(num_tile_cols):
+                                    col_bds = bds[1 + 2 * tile_col : 3 + 2 * tile_col]
+                                    first_col = (first_tile_col + tile_col) * n_cols
+                                    if i in inC_fifo_names:
+                                        col_group = C_in_col_groups[C_in_shims.index(i)]
+                                        npu_dma_memcpy_nd(
+                                            metadata=inC_fifo_names[i],
+                                            bd_id=col_bds[0],
+                                            mem=C,
+                                            offsets=[
+                                                0,
+                                                0,
+                                                0,
+                                                C_batch_offset_in_i32s
+                                                + C_offset_in_i32s(
+                                                    C_row,
+                                                    (first_col + col_group[0]) * n,
+                                                ),
+                                            ],
+                                            sizes=[
+                                                num_tile_rows,
+                                                len(col_group),
+                                                m_x_n_rows,
+                                                n_in_i32s_out,
+                                            ],
+                                            strides=[
+                                                C_offset_in_i32s(m_x_n_rows, 0),
+                                                n_in_i32s_out,
+                                                N_in_i32s_out,
+                                            ],
+                                        )
+                                    if i in inBias_fifo_names:
+                                        col_group = bias_col_groups[bias_shims.index(i)]
+                                        npu_dma_memcpy_nd(
+                                            metadata=inBias_fifo_names[i],
+                                            bd_id=col_bds[0],
+                                            mem=B,
+                                            offsets=[
+                                                0,
+                                                0,
+                                                0,
+                                                bias_offset_in_i32s
+                                                + (first_col + col_group[0])
+                                                * n_in_i32s_out,
+                                            ],
+                                            sizes=[
+                                                num_tile_rows,
+                                                1,
+                                                len(col_group),
+                                                n_in_i32s_out,
+                                            ],
+                                            strides=[0, 0, n_in_i32s_out],
+                                        )
+                                    if i < len(A_row_groups):
+                                        # In split-K mode, row i starts at K
+                                        # tile i.
+                                        if split_k:
+                                            A_row = C_row
+                                            A_col = i * k
+                                        else:
+                                            A_row = C_row + A_row_groups[i][0] * m
+                                            A_col = 0
+                                        npu_dma_memcpy_nd(
+                                            metadata=inA_fifo_names[i],
+                                            bd_id=col_bds[0],
+                                            mem=A,
+                                            offsets=[
+                                                0,
+                                                0,
+                                                0,
+                                                A_batch_offset_in_i32s
+                                                + A_offset_in_i32s(A_row, A_col),
+                                            ],
+                                            sizes=[num_tile_rows, K_div_k_per_core]
+                                            + A_tile_dims[i],
+                                            strides=[
+                                                A_offset_in_i32s(m_x_n_rows, 0),
+                                                A_offset_in_i32s(
+                                                    0, k * K_tiles_per_step
+                                                ),
+                                                A_tile_row_stride_in_i32s,
+                                            ],
+                                        )
+                                    npu_dma_memcpy_nd(
+                                        metadata=inB_fifo_names[i],
+                                        bd_id=col_bds[1],
+                                        mem=B,
+                                        offsets=[
+                                            0,
+                                            0,
+                                            0,
+                                            B_batch_offset_in_i32s
+                                            + B_offset_in_i32s(0, (first_col + i) * n),
+                                        ],
+                                        sizes=[num_tile_rows, K_div_k_per_core]
+                                        + B_tile_dims,
+                                        strides=[
+                                            0,
+                                            B_offset_in_i32s(k * K_tiles_per_step, 0),
+                                            B_tile_row_stride_in_i32s,
+                                        ],
+                                    )
+
+                # The batch elements are walked one after the other, and the
+                # whole batch `repeat` times; the cores see one long stream of
+                # output tiles.
+                for b in list(range(batch)) * repeat:
+                    A_batch_offset_in_i32s = b * stride_A * word_size_in // 4
+                    B_batch_offset_in_i32s = b * stride_B * word_size_in // 4
+                    C_batch_offset_in_i32s = b * stride_C * word_size_out // 4
+                    if dataflow == "B":
+                        B_stationary_sequence(
+                            A,
+                            B,
+                            C,
+                            bd_pools,
+                            A_batch_offset_in_i32s,
+                            B_batch_offset_in_i32s,
+                            C_batch_offset_in_i32s,
+                        )
+                        continue
+                    if compact_sequence:
+                        column_major_sequence(
+                            A,
+                            B,
+                            C,
+                            bd_pools,
+                            A_batch_offset_in_i32s,
+                            B_batch_offset_in_i32s,
+                            C_batch_offset_in_i32s,
+                        )
+                        continue
+                    for tile_row_block, (
+                        first_group,
+                        groups,
+                        A_transfers,
+                        B_transfers,
+                    ) in itertools.product(
+                        range(
+                            (M_div_m_div_n_rows + rows_per_block - 1) // rows_per_block
+                        ),
+                        row_rounds,
+                    ):
+                        num_tile_rows = min(
+                            [
+                                rows_per_block,
+                                M_div_m_div_n_rows - tile_row_block * rows_per_block,
+                            ]
+                        )
+                        C_row = tile_row_block * rows_per_block * m_x_n_rows
+                        round_col = first_group * n * n_cols
+                        if block_mask is not None:
+                            A_bds_per_row = max(1, len(A_transfers))
+                            B_bds_per_row = len(B_transfers)
+                        elif dataflow == "A":
+                            B_bds_per_row = groups // R_A
+                        for i in range(n_cols):
+                            bds = bd_pools[i].acquire(
+                                1 + (A_bds_per_row + B_bds_per_row) * num_tile_rows
+                            )
+                            npu_dma_memcpy_nd(
+                                metadata=outC_fifo_names[i],
+                                bd_id=bds[0],
+                                mem=C,
+                                offsets=[
+                                    0,
+                                    0,
+                                    0,
+                                    C_batch_offset_in_i32s
+                                    + C_offset_in_i32s(C_row, round_col + i * n),
+                                ],
+                                sizes=[num_tile_rows, groups] + C_tile_dims,
+                                strides=[
+                                    C_offset_in_i32s(m_x_n_rows, 0),
+                                    C_offset_in_i32s(0, n * n_cols),
+                                    C_tile_row_stride_in_i32s,
+                                ],
+                            )
+                            for tile_row in range(num_tile_rows):
+                                row_bds = bds[
+                                    1
+                                    + (A_bds_per_row + B_bds_per_row) * tile_row : 1
+                                    + (A_bds_per_row + B_bds_per_row) * (tile_row + 1)
+                                ]
+                                # Columns beyond the number of A row groups carry
+                                # B and, in accumulate mode, the initial C of a
+                                # group of columns, or with a bias, its bias
+                                # slices for every output tile of the row.
+                                if i in inC_fifo_names:
+                                    col_group = C_in_col_groups[C_in_shims.index(i)]
+                                    C_in_row_offset = (
+                                        (tile_row_block * rows_per_block + tile_row)
+                                        * m_x_n_rows
+                                        * N
+                                        * word_size_out
+                                    )
+                                    C_in_col_offset = (
+                                        round_col + col_group[0] * n
+                                    ) * word_size_out
+                                    npu_dma_memcpy_nd(
+                                        metadata=inC_fifo_names[i],
+                                        bd_id=row_bds[0],
+                                        mem=C,
+                                        offsets=[
+                                            0,
+                                            0,
+                                            0,
+                                            C_batch_offset_in_i32s
+                                            + (C_in_row_offset + C_in_col_offset) // 4,
+                                        ],
+                                        sizes=[
+                                            groups,
+                                            len(col_group),
+                                            m_x_n_rows,
+                                            n_in_i32s_out,
+                                        ],
+                                        strides=[
+                                            n_x_n_cols_in_i32s_out,
+                                            n_in_i32s_out,
+                                            N_in_i32s_out,
+                                        ],
+                                    )
+                                if i in inBias_fifo_names:
+                                    col_group = bias_col_groups[bias_shims.index(i)]
+                                    npu_dma_memcpy_nd(
+                                        metadata=inBias_fifo_names[i],
+                                        bd_id=row_bds[0],
+                                        mem=B,
+                                        offsets=[
+                                            0,
+                                            0,
+                                            0,
+                                            bias_offset_in_i32s
+                                            + (round_col + col_group[0] * n)
+                                            * word_size_out
+                                            // 4,
+                                        ],
+                                        sizes=[
+                                            1,
+                                            groups,
+                                            len(col_group),
+                                            n_in_i32s_out,
+                                        ],
+                                        strides=[
+                                            0,
+                                            n_x_n_cols_in_i32s_out,
+                                            n_in_i32s_out,
+                                        ],
+                                    )
+                                if i < len(A_row_groups):
+                                    A_row = (
+                                        tile_row_block * rows_per_block + tile_row
+                                    ) * m_x_n_rows
+                                    # In split-K mode, row i starts at K tile i.
+                                    if split_k:
+                                        A_col = i * k
+                                    else:
+                                        A_row += A_row_groups[i][0] * m
+                                        A_col = 0
+                                    if block_mask is not None:
+                                        # Only the A tiles that meet nonzero
+                                        # blocks of B
+                                        for transfer, (
+                                            first_K_tile,
+                                            K_tiles,
+                                            repeats,
+                                        ) in enumerate(A_transfers):
+                                            npu_dma_memcpy_nd(
+                                                metadata=inA_fifo_names[i],
+                                                bd_id=row_bds[transfer],
+                                                mem=A,
+                                                offsets=[
+                                                    0,
+                                                    0,
+                                                    0,
+                                                    A_offset_in_i32s(
+                                                        A_row, first_K_tile * k
+                                                    ),
+                                                ],
+                                                sizes=[repeats, K_tiles]
+                                                + A_tile_dims[i],
+                                                strides=[
+                                                    0,
+                                                    A_offset_in_i32s(0, k),
+                                                    A_tile_row_stride_in_i32s,
+                                                ],
+                                            )
+                                    else:
+                                        npu_dma_memcpy_nd(
+                                            metadata=inA_fifo_names[i],
+                                            bd_id=row_bds[0],
+                                            mem=A,
+                                            offsets=[
+                                                0,
+                                                0,
+                                                0,
+                                                A_batch_offset_in_i32s
+                                                + A_offset_in_i32s(A_row, A_col),
+                                            ],
+                                            sizes=[
+                                                groups // R_A,
+                                                K_div_k_per_core,
+                                            ]
+                                            + A_tile_dims[i],
+                                            strides=[
+                                                0,
+                                                A_offset_in_i32s(
+                                                    0, k * K_tiles_per_step
+                                                ),
+                                                A_tile_row_stride_in_i32s,
+                                            ],
+                                        )
+                                if dataflow == "A":
+                                    # Per K step, the B tiles of a group of
+                                    # R tile columns
+                                    for group in range(B_bds_per_row):
+                                        npu_dma_memcpy_nd(
+                                            metadata=inB_fifo_names[i],
+                                            bd_id=row_bds[A_bds_per_row + group],
+                                            mem=B,
+                                            offsets=[
+                                                0,
+                                                0,
+                                                0,
+                                                B_batch_offset_in_i32s
+                                                + B_offset_in_i32s(
+                                                    0,
+                                                    round_col
+                                                    + (i + group * R_A * n_cols) * n,
+                                                ),
+                                            ],
+                                            sizes=[K_div_k_per_core, R_A] + B_tile_dims,
+                                            strides=[
+                                                B_offset_in_i32s(k, 0),
+                                                B_offset_in_i32s(0, n * n_cols),
+                                                B_tile_row_stride_in_i32s,
+                                            ],
+                                        )
+                                elif block_mask is not None:
+                                    # The compressed blocks of tile column
+                                    # i + group * n_cols follow those of all
+                                    # tile columns to its left.
+                                    for transfer, (
+                                        B_group,
+                                        B_groups,
+                                        K_tiles,
+                                    ) in enumerate(B_transfers):
+                                        first_block = (
+                                            n_cols
+                                            * sum(
+                                                len(K_tiles)
+                                                for K_tiles in group_K_tiles[:B_group]
+                                            )
+                                            + i * K_tiles
+                                        )
+                                        npu_dma_memcpy_nd(
+                                            metadata=inB_fifo_names[i],
+                                            bd_id=row_bds[A_bds_per_row + transfer],
+                                            mem=B,
+                                            offsets=[
+                                                0,
+                                                0,
+                                                0,
+                                                first_block * k * n_in_i32s,
+                                            ],
+                                            sizes=[B_groups, K_tiles, k, n_in_i32s],
+                                            strides=[
+                                                n_cols * K_tiles * k * n_in_i32s,
+                                                k * n_in_i32s,
+                                                n_in_i32s,
+                                            ],
+                                        )
+                                else:
+                                    npu_dma_memcpy_nd(
+                                        metadata=inB_fifo_names[i],
+                                        bd_id=row_bds[A_bds_per_row],
+                                        mem=B,
+                                        offsets=[
+                                            0,
+                                            0,
+                                            0,
+                                            B_batch_offset_in_i32s
+                                            + B_offset_in_i32s(0, round_col + i * n),
+                                        ],
+                                        sizes=[groups, K_div_k_per_core] + B_tile_dims,
+                                        strides=[
+                                            B_offset_in_i32s(0, n * n_cols),
+                                            B_offset_in_i32s(k * K_tiles_per_step, 0),
+                                            B_tile_row_stride_in_i32s,
+                                        ],
+                                    )
+                # The counter tiles of the cores of each column follow the
+                # last C tiles through the memory tile.
+                if perf_counters:
                     for i in range(n_cols):
-                        npu_sync(column=i, row=0, direction=0, channel=0)
+                        npu_dma_memcpy_nd(
+                            metadata=outC_fifo_names[i],
+                            bd_id=bd_pools[i].acquire(1)[0],
+                            mem=C,
+                            offsets=[
+                                0,
+                                0,
+                                0,
+                                perf_offset_in_i32s + i * m * n_in_i32s_out,
+                            ],
+                            sizes=[1, C_tile_rows, m, n_in_i32s_out],
+                            strides=[0, n_cols * m * n_in_i32s_out, n_in_i32s_out],
+                        )
+                for i in range(n_cols):
+                    bd_pools[i].drain()
 
     # print(ctx.module.operation.verify())
     print(ctx.module)
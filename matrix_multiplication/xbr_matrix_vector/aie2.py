@@ -5,33 +5,170 @@
 #
 # (c) Copyright 2023 AMD Inc.
 import argparse
+import os
+import sys
 from aie.extras.context import mlir_mod_ctx
 
 from aie.dialects.aie import *
 from aie.dialects.aiex import *
 from aie.dialects.scf import *
+from aie.extras.dialects.ext import arith
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from devices import devices, placement
 
-def my_matmul(M = 288, K = 288):
+# Data memory of a compute tile (which also holds the core's stack) and of a
+# memory tile.
+l1_bytes = 64 * 1024
+l1_stack_bytes = 1024
+l2_bytes = 512 * 1024
+
+# Supported datapaths: input element type -> output element type of the mv.cc
+# kernels. The integer datapaths accumulate into i32.
+datapaths = {"bf16": "f32", "i8": "i32", "i16": "i32"}
+word_sizes = {"bf16": 2, "i8": 1, "i16": 2, "f32": 4, "i32": 4}
+
+
+def element_type(dtype):
+    return {
+        "bf16": T.bf16,
+        "i8": T.i8,
+        "i16": T.i16,
+        "f32": T.f32,
+        "i32": T.i32,
+    }[dtype]()
+
+
+def my_matmul(
+    M = 4096,
+    K = 4096,
+    fifo_depth = 2,
+    mem_fifo_depth = 2,
+    acquire_size = 1,
+    dtype = "bf16",
+    transpose_A = False,
+    device_name = "npu1_4col",
+    col_offset = 0,
+    num_cols = None,
+    b_broadcast = "single",
+    n_rows = 4,
+    split_k = False,
+    resident_B = False,
+):
     #M = 288
     #K = 288
     m = 64
     k = 64
-    word_size_in = 2
-    word_size_out = 4
+    dtype_out = datapaths[dtype]
+    word_size_in = word_sizes[dtype]
+    word_size_out = word_sizes[dtype_out]
+    # Elements per 32-bit word of A, the granularity of its transposition
+    elems_per_word = 4 // word_size_in
+
+    # Every column of the design gets its own slice of the rows of A; by
+    # default, the design takes all columns of the device from col_offset on.
+    dev = devices[device_name]
+    n_cols = dev.n_cols - col_offset if num_cols is None else num_cols
+    cols = placement(dev, col_offset, n_cols)
+    if not 1 <= n_rows <= dev.n_core_rows:
+        raise ValueError(
+            "{} has 1 to {} rows of cores".format(dev.name, dev.n_core_rows)
+        )
+    cores_div_col = n_rows
+
+    # In split-K mode, all cores of a column work on the same m rows of A
+    # instead, which suits a small M with a long K. Core row j takes the K
+    # tiles j, j + n_rows, j + 2 * n_rows, ..., so that the memory tile can
+    # split a run of n_rows consecutive K tiles among the cores; of the B
+    # slices broadcast to all cores, each core uses every n_rows-th. The
+    # partial results are summed up the column over the cascade interface,
+    # from the top row down to row 0, which writes the result. The memory
+    # tile cannot add, so the reduction takes place on the cores.
+    if split_k and n_rows < 2:
+        raise ValueError("split-K needs at least two rows of cores")
+    C_rows = 1 if split_k else cores_div_col
+    K_tiles_per_step = cores_div_col if split_k else 1
 
-    n_cores = 8
-    n_cols = 4
-    cores_div_col = n_cores//n_cols
+    if not 1 <= acquire_size <= fifo_depth or mem_fifo_depth < 1:
+        raise ValueError("FIFO depths must be at least 1 and at least the acquire size")
+    if K % (k * acquire_size * K_tiles_per_step) != 0:
+        raise ValueError(
+            "K must be a multiple of k * acquire_size{}".format(
+                " * n_rows" if split_k else ""
+            )
+        )
+
+    # The memory tile of a column splits each block of m * C_rows rows of A
+    # among the column's cores, so the columns take whole blocks. M is
+    # zero-padded to whole blocks by the host (--pad_M), and the blocks are
+    # spread over the columns as evenly as they go: the first columns take
+    # one block more than the others, and columns left without a block are
+    # not used at all. The cores loop forever, so only the runtime sequence
+    # depends on this split.
+    M_pad = -(-M // (m * C_rows)) * m * C_rows
+    if M_pad != M:
+        sys.stderr.write(
+            "Padding M from {} to {} ({:.1f}% extra MACs)\n".format(
+                M, M_pad, (M_pad / M - 1) * 100
+            )
+        )
+    M = M_pad
+    M_div_m_x_rows = M // (m * C_rows)
+    n_cols = min(n_cols, M_div_m_x_rows)
+    cols = cols[:n_cols]
+    n_cores = n_cols * cores_div_col
+    col_blocks = [
+        M_div_m_x_rows // n_cols + (1 if i < M_div_m_x_rows % n_cols else 0)
+        for i in range(n_cols)
+    ]
+    col_first_block = [sum(col_blocks[:i]) for i in range(n_cols)]
+    if len(set(col_blocks)) > 1:
+        sys.stderr.write(
+            "Blocks of {} rows of A per column: {}\n".format(m * C_rows, col_blocks)
+        )
+        # The cores of a broadcast all consume every B slice it carries, so
+        # unless B is resident, each column needs a broadcast of its own.
+        if b_broadcast == "single" and not resident_B:
+            sys.stderr.write(
+                "Broadcasting B per column, as the columns take different "
+                "numbers of blocks\n"
+            )
+            b_broadcast = "per-column"
+    # With resident_B, B is sent to the cores once per launch instead of once
+    # per block of rows. Each core then keeps all of B in its data memory
+    # while the blocks of A stream through, and the kernel multiplies each A
+    # tile with the matching slice of B, selected by the index of its K tile.
+    # A core holds fifo_depth A tiles, the B slices that go with them (or all
+    # of B) and two C tiles. A memory tile holds the stacked A tiles and C
+    # results of its column's cores; linked FIFOs share their buffers there,
+    # sized for the deeper of the two.
+    B_footprint = K if resident_B else fifo_depth * K_tiles_per_step * k
+    l1_footprint = (
+        (fifo_depth * m * k + B_footprint) * word_size_in + 2 * m * word_size_out
+    )
+    l2_footprint = (
+        max(fifo_depth, mem_fifo_depth) * m * k * cores_div_col * word_size_in
+        + 2 * m * C_rows * word_size_out
+    )
+    if l1_footprint > l1_bytes - l1_stack_bytes:
+        raise ValueError(
+            "the core buffers need {} bytes, but a compute tile only has {}".format(
+                l1_footprint, l1_bytes - l1_stack_bytes
+            )
+        )
+    if l2_footprint > l2_bytes:
+        raise ValueError(
+            "the memory tile buffers need {} bytes, but a memory tile only has {}".format(
+                l2_footprint, l2_bytes
+            )
+        )
 
     A_sz_in_i32s = M * K * word_size_in // 4
     B_sz_in_i32s = K * word_size_in // 4
     C_sz_in_bytes = M * word_size_out
     C_sz_in_i32s = C_sz_in_bytes // 4
-    C_sz_div_n_cores_in_i32s = C_sz_in_i32s // n_cores
+    m_x_rows_out_in_i32s = m * C_rows * word_size_out // 4
 
-    M_div_m = M // m
-    M_div_m_div_n_cores = M // (m * n_cores)
     K_div_k = K // k
 
     K_in_i32s = K * word_size_in // 4
@@ -39,86 +176,124 @@ def my_matmul(M = 288, K = 288):
     m_in_i32s = m * word_size_in // 4
     m_x_k_in_i32s = m * k * word_size_in // 4
     m_x_K_in_i32s = m * K * word_size_in // 4
+    M_in_i32s = M * word_size_in // 4
+    k_x_M_in_i32s = k * M * word_size_in // 4
+
+    # With A stored transposed (K x M), the shims stream each core's A tile
+    # column by column, one BD per block of M; the core then uses the
+    # column-major matvec kernel. In split-K mode, a block is a single core's
+    # m rows, so a column takes n_rows times as many of these BDs.
+    A_first_bd = 3
+    A_bds = A_first_bd + max(col_blocks)
+    if transpose_A and A_bds > dev.n_shim_bds:
+        raise ValueError(
+            "a transposed A needs {} buffer descriptors per shim, but a shim only has {}".format(
+                A_bds, dev.n_shim_bds
+            )
+        )
+
+    # B goes to every core. A single shim broadcasts it to the whole array by
+    # default; with b_broadcast "per-column", each column's shim broadcasts it
+    # to the cores of its own column on its second MM2S channel. This reads B
+    # from DDR once per column, but no longer funnels it through one shim
+    # channel and the switches of its neighbours.
+    B_shims = n_cols if b_broadcast == "per-column" else 1
+    # Times each broadcast sends B per launch
+    if resident_B:
+        B_repeats = [1] * B_shims
+    elif b_broadcast == "per-column":
+        B_repeats = col_blocks
+    else:
+        B_repeats = [max(col_blocks)]
+    B_sends = sum(B_repeats)
+    sys.stderr.write(
+        "B read from DDR per launch: {} bytes through {} shim(s); "
+        "{} bytes through a single shim\n".format(
+            B_sends * K * word_size_in,
+            B_shims,
+            max(col_blocks) * K * word_size_in,
+        )
+    )
 
     vectorized = True
 
     with mlir_mod_ctx() as ctx:
 
-        @device(AIEDevice.npu1_4col)
+        @device(getattr(AIEDevice, dev.name))
         def device_body():
-            memRef_inA_ty = T.memref(m * k * cores_div_col, T.bf16()) #4 compute tile in one col
-            memRef_inB_ty = T.memref(k, T.bf16())
-            memRef_C_ty = T.memref(m, T.f32())
-            memRef_outC_ty = T.memref(m*cores_div_col, T.f32())
-            memRef_A_ty = T.memref(m, k, T.bf16())
+            in_ty = element_type(dtype)
+            out_ty = element_type(dtype_out)
+            memRef_inA_ty = T.memref(m * k * cores_div_col, in_ty) #4 compute tile in one col
+            memRef_inB_ty = T.memref(K if resident_B else k, in_ty)
+            memRef_C_ty = T.memref(m, out_ty)
+            memRef_outC_ty = T.memref(m*C_rows, out_ty)
+            memRef_A_ty = T.memref(m, k, in_ty)
+            # A transposed tile arrives column by column already
+            memA_dims = None if transpose_A else [
+                (k//elems_per_word , elems_per_word),
+                (m, k),
+                (elems_per_word, 1),
+            ]  # transpose at 4-byte granularity
 
             # AIE Core Function declarations
-            zero_scalar = external_func("zero_scalar_f32", inputs=[memRef_C_ty])
-            zero = external_func("zero_vectorized_f32", inputs=[memRef_C_ty])
+            zero_scalar = external_func(
+                "zero_scalar_{}".format(dtype_out), inputs=[memRef_C_ty]
+            )
+            zero = external_func(
+                "zero_vectorized_{}".format(dtype_out), inputs=[memRef_C_ty]
+            )
             matvec_scalar = external_func(
-                "matvec_scalar_bf16_f32",
+                "matvec_scalar_{}_{}".format(dtype, dtype_out),
                 inputs=[memRef_A_ty, memRef_inB_ty, memRef_C_ty],
             )
             matvec = external_func(
-                "matvec_vectorized_bf16_f32",
-                inputs=[memRef_A_ty, memRef_inB_ty, memRef_C_ty],
+                "matvec_vectorized_{}{}{}_{}".format(
+                    "col_major_" if transpose_A else "",
+                    "resident_" if resident_B else "",
+                    dtype,
+                    dtype_out,
+                ),
+                inputs=[memRef_A_ty, memRef_inB_ty, memRef_C_ty]
+                + ([T.i32()] if resident_B else []),
             )
+            if split_k:
+                cascade_put = external_func(
+                    "cascade_put_{}".format(dtype_out), inputs=[memRef_C_ty]
+                )
+                cascade_get_add_put = external_func(
+                    "cascade_get_add_put_{}".format(dtype_out), inputs=[memRef_C_ty]
+                )
+                cascade_get_add = external_func(
+                    "cascade_get_add_{}".format(dtype_out), inputs=[memRef_C_ty]
+                )
+
+            # Tile declarations; core i * cores_div_col + j is the j-th core of
+            # the design's column i
+            ShimTiles = [tile(col, dev.shim_row) for col in cols]
+            MemTiles = [tile(col, dev.mem_row) for col in cols]
+            cores = [
+                tile(col, dev.core_row + j)
+                for col in cols
+                for j in range(cores_div_col)
+            ]
+            core_names = [
+                "{}{}".format(col, dev.core_row + j)
+                for col in cols
+                for j in range(cores_div_col)
+            ]
 
-            # Tile declarations
-            ShimTile0 = tile(0, 0)
-            ShimTile1 = tile(1, 0)
-            ShimTile2 = tile(2, 0)
-            ShimTile3 = tile(3, 0)
-            ShimTiles = [ShimTile0, ShimTile1, ShimTile2, ShimTile3]
-            MemTile0 = tile(0, 1)
-            MemTile1 = tile(1, 1)
-            MemTile2 = tile(2, 1)
-            MemTile3 = tile(3, 1)
-            MemTiles = [MemTile0, MemTile1, MemTile2, MemTile3]
-            
-            ComputeTile0_2 = tile(0, 2)
-            ComputeTile0_3 = tile(0, 3)
-            ComputeTile0_4 = tile(0, 4)
-            ComputeTile0_5 = tile(0, 5)
-            
-            ComputeTile1_2 = tile(1, 2)
-            ComputeTile1_3 = tile(1, 3)
-            ComputeTile1_4 = tile(1, 4)
-            ComputeTile1_5 = tile(1, 5)
-            
-            ComputeTile2_2 = tile(2, 2)
-            ComputeTile2_3 = tile(2, 3)
-            ComputeTile2_4 = tile(2, 4)
-            ComputeTile2_5 = tile(2, 5)
-            
-            ComputeTile3_2 = tile(3, 2)
-            ComputeTile3_3 = tile(3, 3)
-            ComputeTile3_4 = tile(3, 4)
-            ComputeTile3_5 = tile(3, 5)
-            
-
-            #memA0 for computetile0_2 ~ computetile0_5
-            cores = [ComputeTile0_2, ComputeTile0_3, ComputeTile0_4, ComputeTile0_5,
-                     ComputeTile1_2, ComputeTile1_3, ComputeTile1_4, ComputeTile1_5,
-                     ComputeTile2_2, ComputeTile2_3, ComputeTile2_4, ComputeTile2_5,
-                     ComputeTile3_2, ComputeTile3_3, ComputeTile3_4, ComputeTile3_5]
-            
-
-            memA_fifo_names = ["memA0", "memA1", "memA2", "memA3"]
+            memA_fifo_names = ["memA{}".format(i) for i in range(n_cols)]
             memA_fifos = {}
-            inA_fifo_names = ["inA02", "inA03", "inA04", "inA05",
-                              "inA12", "inA13", "inA14", "inA15", 
-                              "inA22", "inA23", "inA24", "inA25",
-                              "inA32", "inA33", "inA34", "inA35"]
+            inA_fifo_names = ["inA" + name for name in core_names]
             inA_fifos = {}
-            inB_fifo_names = ["inB"]
+            if b_broadcast == "per-column":
+                inB_fifo_names = ["inB{}".format(i) for i in range(n_cols)]
+            else:
+                inB_fifo_names = ["inB"]
             inB_fifos = {}
-            memC_fifo_names = ["memC0", "memC1", "memC2", "memC3"]
+            memC_fifo_names = ["memC{}".format(i) for i in range(n_cols)]
             memC_fifos = {}
-            outC_fifo_names = ["outC02", "outC03", "outC04", "outC05",
-                               "outC12", "outC13", "outC14", "outC15", 
-                               "outC22", "outC23", "outC24", "outC25",
-                               "outC32", "outC33", "outC34", "outC35"]
+            outC_fifo_names = ["outC" + name for name in core_names]
             outC_fifos = {}
 
             # AIE-array data movement with object fifos
@@ -128,7 +303,7 @@ def my_matmul(M = 288, K = 288):
                     memA_fifo_names[i],
                     ShimTiles[i],
                     MemTiles[i],
-                    2,
+                    mem_fifo_depth,
                     memRef_inA_ty,
                 )
 
@@ -137,12 +312,8 @@ def my_matmul(M = 288, K = 288):
                 for j in range(cores_div_col):
                     inA_fifos[inA_fifo_names[i*cores_div_col+j]] = object_fifo( inA_fifo_names[i*cores_div_col+j], 
                                                                     MemTiles[i], cores[i*cores_div_col+j], 
-                                                                    2, memRef_A_ty,
-                                                                    [
-                                                                        (k//2 , 2),
-                                                                        (m, k),
-                                                                        (2, 1),
-                                                                    ],  # transpose at 4-byte (2xbf16) granularity
+                                                                    fifo_depth, memRef_A_ty,
+                                                                    memA_dims,
                                                                 )
                     tmp_list.append(inA_fifos[inA_fifo_names[i*cores_div_col+j]])
                 
@@ -151,18 +322,28 @@ def my_matmul(M = 288, K = 288):
                 object_fifo_link(memA_fifos[memA_fifo_names[i]], tmp_list)
 
             # Input B
-            inB_fifos[inB_fifo_names[0]] = object_fifo(
-                inB_fifo_names[0],
-                ShimTiles[1 % n_cores],
-                cores[0:n_cores],
-                2,
-                memRef_inB_ty,
-            )
+            if b_broadcast == "per-column":
+                for i in range(n_cols):
+                    inB_fifos[inB_fifo_names[i]] = object_fifo(
+                        inB_fifo_names[i],
+                        ShimTiles[i],
+                        cores[i*cores_div_col:(i+1)*cores_div_col],
+                        1 if resident_B else fifo_depth * K_tiles_per_step,
+                        memRef_inB_ty,
+                    )
+            else:
+                inB_fifos[inB_fifo_names[0]] = object_fifo(
+                    inB_fifo_names[0],
+                    ShimTiles[1 % n_cols],
+                    cores[0:n_cores],
+                    1 if resident_B else fifo_depth * K_tiles_per_step,
+                    memRef_inB_ty,
+                )
 
             # Output C
             for i in range(n_cols):
                 tmp_list = []
-                for j in range(cores_div_col):
+                for j in range(C_rows):
                     outC_fifos[outC_fifo_names[i*cores_div_col+j]] = object_fifo(outC_fifo_names[i*cores_div_col+j],
                                                                      cores[i*cores_div_col+j],MemTiles[i],
                                                                      2,memRef_C_ty,
@@ -177,7 +358,29 @@ def my_matmul(M = 288, K = 288):
                     memRef_outC_ty,
                 )
                 #join
-                object_fifo_link(tmp_list,memC_fifos[memC_fifo_names[i]])
+                object_fifo_link(
+                    tmp_list[0] if split_k else tmp_list,
+                    memC_fifos[memC_fifo_names[i]],
+                )
+
+            # Cascade connections for the split-K reduction, from the top row
+            # of each column down to row 0, and the local buffers in which
+            # the cores above row 0 compute their partial results
+            partial_C = {}
+            if split_k:
+                for i in range(n_cols):
+                    for j in range(cores_div_col - 1):
+                        cascade_flow(
+                            cores[i * cores_div_col + j + 1],
+                            cores[i * cores_div_col + j],
+                        )
+                    for j in range(1, cores_div_col):
+                        partial_C[i * cores_div_col + j] = buffer(
+                            cores[i * cores_div_col + j],
+                            [m],
+                            out_ty,
+                            name="partialC" + core_names[i * cores_div_col + j],
+                        )
 
 
             # Set up compute tiles
@@ -185,37 +388,88 @@ def my_matmul(M = 288, K = 288):
                 # Compute tile i
                 @core(cores[i], "mv.o")
                 def core_body():
-                    for _ in for_(0xFFFFFFFF):
-                        elem_out = outC_fifos[outC_fifo_names[i]].acquire(
-                            ObjectFifoPort.Produce,
-                            1,
-                        )
-                        call(zero, [elem_out])
+                    if b_broadcast == "per-column":
+                        inB_fifo = inB_fifos[inB_fifo_names[i // cores_div_col]]
+                    else:
+                        inB_fifo = inB_fifos[inB_fifo_names[0]]
+                    row = i % cores_div_col
+                    writes_C = row < C_rows
 
-                        for _ in for_(K_div_k):
-                            elem_in_a = inA_fifos[inA_fifo_names[i]].acquire(
-                                ObjectFifoPort.Consume,
+                    # One block of rows of A; elem_b holds all of B if it is
+                    # resident
+                    def output_block(elem_b):
+                        if writes_C:
+                            elem_out = outC_fifos[outC_fifo_names[i]].acquire(
+                                ObjectFifoPort.Produce,
                                 1,
                             )
-                            elem_in_b = inB_fifos[inB_fifo_names[0]].acquire(
+                        else:
+                            elem_out = partial_C[i]
+                        call(zero, [elem_out])
+
+                        for k_step in for_(K_div_k // (acquire_size * K_tiles_per_step)):
+                            elems_in_a = inA_fifos[inA_fifo_names[i]].acquire(
                                 ObjectFifoPort.Consume,
-                                1,
+                                acquire_size,
                             )
-                            call(matvec, [elem_in_a, elem_in_b, elem_out])
+                            if acquire_size == 1:
+                                elems_in_a = [elems_in_a]
+                            if resident_B:
+                                # K tile of each A tile
+                                first_K_tile = arith.index_cast(k_step, to=T.i32()) * (
+                                    acquire_size * K_tiles_per_step
+                                )
+                                for a, elem_in_a in enumerate(elems_in_a):
+                                    K_tile = first_K_tile + (
+                                        a * K_tiles_per_step + row % K_tiles_per_step
+                                    )
+                                    call(matvec, [elem_in_a, elem_b, elem_out, K_tile])
+                            else:
+                                elems_in_b = inB_fifo.acquire(
+                                    ObjectFifoPort.Consume,
+                                    acquire_size * K_tiles_per_step,
+                                )
+                                if acquire_size * K_tiles_per_step == 1:
+                                    elems_in_b = [elems_in_b]
+                                # In split-K mode, the core's B slice of each
+                                # run of K tiles
+                                elems_in_b = elems_in_b[row % K_tiles_per_step::K_tiles_per_step]
+                                for elem_in_a, elem_in_b in zip(elems_in_a, elems_in_b):
+                                    call(matvec, [elem_in_a, elem_in_b, elem_out])
                             inA_fifos[inA_fifo_names[i]].release(
                                 ObjectFifoPort.Consume,
-                                1,
+                                acquire_size,
                             )
-                            inB_fifos[inB_fifo_names[0]].release(
-                                ObjectFifoPort.Consume,
+                            if not resident_B:
+                                inB_fifo.release(
+                                    ObjectFifoPort.Consume,
+                                    acquire_size * K_tiles_per_step,
+                                )
+                            yield_([])
+
+                        if split_k:
+                            if row == cores_div_col - 1:
+                                call(cascade_put, [elem_out])
+                            elif row > 0:
+                                call(cascade_get_add_put, [elem_out])
+                            else:
+                                call(cascade_get_add, [elem_out])
+                        if writes_C:
+                            outC_fifos[outC_fifo_names[i]].release(
+                                ObjectFifoPort.Produce,
                                 1,
                             )
-                            yield_([])
 
-                        outC_fifos[outC_fifo_names[i]].release(
-                            ObjectFifoPort.Produce,
-                            1,
-                        )
+                    for _ in for_(0xFFFFFFFF):
+                        if resident_B:
+                            # B stays in the core for all blocks of the launch
+                            elem_b = inB_fifo.acquire(ObjectFifoPort.Consume, 1)
+                            for _ in for_(col_blocks[i // cores_div_col]):
+                                output_block(elem_b)
+                                yield_([])
+                            inB_fifo.release(ObjectFifoPort.Consume, 1)
+                        else:
+                            output_block(None)
                         yield_([])
 
             # To/from AIE-array data movement
@@ -226,35 +480,64 @@ def my_matmul(M = 288, K = 288):
                 T.memref(C_sz_in_i32s, T.i32()),
             )
             def sequence(A, B, C):
-                npu_dma_memcpy_nd(
-                    metadata=inB_fifo_names[0],
-                    bd_id=2,
-                    mem=B,
-                    sizes=[M_div_m_div_n_cores, 1, 1, K_in_i32s],
-                    strides=[0, 0, 0],
-                )
-                for i in range(n_cols):
-                    A_offset = cores_div_col * i * M_div_m_div_n_cores * m * K * word_size_in // 4
-                    C_offset = cores_div_col * i * M_div_m_div_n_cores * m * word_size_out // 4
+                # Each column's cores take B once per block of rows, or once
+                # if it is resident
+                for i, name in enumerate(inB_fifo_names):
                     npu_dma_memcpy_nd(
-                        metadata=memA_fifo_names[i],
-                        bd_id=1,
-                        mem=A,
-                        offsets=[0, 0, 0, A_offset],
-                        sizes=[M_div_m_div_n_cores, K_div_k, cores_div_col*m, k_in_i32s],
-                        strides=[cores_div_col*m_x_K_in_i32s, k_in_i32s, K_in_i32s],
+                        metadata=name,
+                        bd_id=2,
+                        mem=B,
+                        sizes=[B_repeats[i], 1, 1, K_in_i32s],
+                        strides=[0, 0, 0],
                     )
+                for i in range(n_cols):
+                    A_offset = col_first_block[i] * C_rows * m_x_K_in_i32s
+                    C_offset = col_first_block[i] * m_x_rows_out_in_i32s
+                    if transpose_A:
+                        # A^T is K x M: for each block of M, walk K in
+                        # steps of k, handing each core its m x k tile as
+                        # k columns of m elements.
+                        for blk in range(col_blocks[i]):
+                            A_offset = C_rows * (col_first_block[i] + blk) * m_in_i32s
+                            npu_dma_memcpy_nd(
+                                metadata=memA_fifo_names[i],
+                                bd_id=A_first_bd + blk,
+                                mem=A,
+                                offsets=[0, 0, 0, A_offset],
+                                # In split-K mode, the K tiles of the block
+                                # follow each other, more than the repeat
+                                # dimension takes for a long K.
+                                sizes=(
+                                    [1, K_div_k, k, m_in_i32s]
+                                    if split_k
+                                    else [K_div_k, C_rows, k, m_in_i32s]
+                                ),
+                                strides=(
+                                    [0, k_x_M_in_i32s, M_in_i32s]
+                                    if split_k
+                                    else [k_x_M_in_i32s, m_in_i32s, M_in_i32s]
+                                ),
+                            )
+                    else:
+                        npu_dma_memcpy_nd(
+                            metadata=memA_fifo_names[i],
+                            bd_id=1,
+                            mem=A,
+                            offsets=[0, 0, 0, A_offset],
+                            sizes=[col_blocks[i], K_div_k, C_rows*m, k_in_i32s],
+                            strides=[C_rows*m_x_K_in_i32s, k_in_i32s, K_in_i32s],
+                        )
                     npu_dma_memcpy_nd(
                         metadata=memC_fifo_names[i],
                         bd_id=0,
                         mem=C,
                         offsets=[0, 0, 0, C_offset],
-                        sizes=[1, 1, 1, cores_div_col*C_sz_div_n_cores_in_i32s],
+                        sizes=[1, 1, 1, col_blocks[i] * m_x_rows_out_in_i32s],
                         strides=[0, 0, 0],
                     )
 
-                for i in range(n_cores):
-                    npu_sync(column=i, row=0, direction=0, channel=0)
+                for col in cols:
+                    npu_sync(column=col, row=dev.shim_row, direction=0, channel=0)
 
     print(ctx.module)
 
@@ -263,8 +546,54 @@ argparser = argparse.ArgumentParser(
     prog="AIE Matrix Multiplication MLIR Design (Whole Array)",
     description="Emits MLIR code for a matrix multiplication design of the given input size",
 )
-argparser.add_argument("-M", type=int, default=288)
-argparser.add_argument("-K", type=int, default=288)
+argparser.add_argument("-M", type=int, default=4096)
+argparser.add_argument("-K", type=int, default=4096)
 argparser.add_argument("-N", type=int, default=288)
+argparser.add_argument("--fifo-depth", type=int, default=2,
+                       help="depth of the A and B FIFOs into the cores")
+argparser.add_argument("--mem-fifo-depth", type=int, default=2,
+                       help="depth of the A FIFOs from the shims to the memory tiles")
+argparser.add_argument("--acquire-size", type=int, default=1,
+                       help="A tiles and B slices acquired per iteration of the K loop")
+argparser.add_argument("--dtype", choices=datapaths.keys(), default="bf16",
+                       help="input element type; the integer types accumulate into i32")
+argparser.add_argument("--transpose-A", action="store_true",
+                       help="A is stored transposed, i.e. as a K x M matrix")
+argparser.add_argument("--device", choices=devices, default="npu1_4col",
+                       help="device to generate the design for")
+argparser.add_argument("--col-offset", type=int, default=0,
+                       help="first column of the device to use, leaving the others to designs "
+                            "running concurrently")
+argparser.add_argument("--num-cols", type=int, default=None,
+                       help="columns to use; defaults to all columns from --col-offset on")
+argparser.add_argument("--n-rows", type=int, default=4,
+                       help="cores per column, among which the memory tile splits the column's "
+                            "rows of A")
+argparser.add_argument("--split-k", action="store_true",
+                       help="split K across the cores of a column and reduce over the cascade")
+argparser.add_argument("--resident-b", action="store_true",
+                       help="send B to the cores once per launch and keep it there, instead of "
+                            "once per block of rows")
+argparser.add_argument("--b-broadcast", choices=["single", "per-column"], default="single",
+                       help="broadcast B from a single shim to all cores, or from each column's "
+                            "shim to its own cores")
 args = argparser.parse_args()
-my_matmul(args.M, args.K)
+try:
+    my_matmul(
+        args.M,
+        args.K,
+        args.fifo_depth,
+        args.mem_fifo_depth,
+        args.acquire_size,
+        args.dtype,
+        args.transpose_A,
+        args.device,
+        args.col_offset,
+        args.num_cols,
+        args.b_broadcast,
+        args.n_rows,
+        args.split_k,
+        args.resident_b,
+    )
+except ValueError as e:
+    argparser.error(str(e))
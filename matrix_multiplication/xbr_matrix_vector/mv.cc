@@ -38,23 +38,30 @@ void matvec_scalar(T_in *a, T_in *b, T_out *c) {
 }
 
 template <typename T_in, typename T_out, typename T_acc, unsigned m, unsigned k,
-          unsigned r, unsigned s>
+          unsigned r, unsigned s, bool col_major = false>
 void matvec_vectorized(T_in *__restrict a, T_in *__restrict b,
                        T_out *__restrict c) {
-  static_assert(m % r == 0 && k % 2 == 0);
+  // Elements per 32-bit word of A
+  constexpr unsigned w = 4 / sizeof(T_in);
+  static_assert(w == 2 || w == 4);
+  // Columns of A interleaved in its layout
+  constexpr unsigned interleave = col_major ? 1 : w;
+  static_assert(m % r == 0 && k % w == 0);
   static_assert(s == 8); // s is fixed to 8 because that is the number of
                          // column vectors (a_vec_0_0..a_vec_3_1) we create
   static_assert(k % s == 0);
-  static_assert(std::is_same<T_in, bfloat16>::value);
 
   // This kernel expects a "32-bit word transposed matrix", i.e. the result
   // of transposing the row-major representation of the matrix at a
-  // granularity of 4 bytes. For the bf16 data type of the inputs, this
-  // corresponds to a memory layout like this:
+  // granularity of 4 bytes. For the bf16 and int16 data types of the
+  // inputs, this corresponds to a memory layout like this:
   //  1  2  9 10 17 18
   //  3  4 11 12 19 ..
   //  5  6 13 14
   //  7  8 15 16
+  // For int8, each word holds four consecutive columns of a row instead.
+  // With col_major, the matrix is fully transposed instead (a tile of a
+  // matrix stored transposed, i.e. K-major), and each column is contiguous.
 
   // In the outer loop, we iterate through the b matrix once, in steps of
   // 8*1-sized blocks.
@@ -80,28 +87,62 @@ void matvec_vectorized(T_in *__restrict a, T_in *__restrict b,
         aie::accum<T_acc, r> c_acc_in;
         c_acc_in.from_vector(aie::load_v<r>(c_ptr));
 
-        const aie::vector<T_in, 2 * r> a_vec_0 = aie::load_v<2 * r>(a_ptr);
-        const aie::vector<T_in, 2 * r> a_vec_1 =
-            aie::load_v<2 * r>(a_ptr + 2 * m);
-        const aie::vector<T_in, 2 * r> a_vec_2 =
-            aie::load_v<2 * r>(a_ptr + 4 * m);
-        const aie::vector<T_in, 2 * r> a_vec_3 =
-            aie::load_v<2 * r>(a_ptr + 6 * m);
-
-        // The even/odd calls below extract the interleaved columns of A.
-        // We need to do this since A is only transposed (column-major) at
-        // a granularity of 4 bytes, but bf16 are two bytes; therefore, we
-        // end up with two interleaved columns at each 2*m interval.
-        // After this, each of a_vec_0_0 contains rows row..row+r of some
-        // column of A. The columns are col..col+8.
-        const aie::vector<T_in, r> a_vec_0_0 = aie::filter_even(a_vec_0);
-        const aie::vector<T_in, r> a_vec_0_1 = aie::filter_odd(a_vec_0);
-        const aie::vector<T_in, r> a_vec_1_0 = aie::filter_even(a_vec_1);
-        const aie::vector<T_in, r> a_vec_1_1 = aie::filter_odd(a_vec_1);
-        const aie::vector<T_in, r> a_vec_2_0 = aie::filter_even(a_vec_2);
-        const aie::vector<T_in, r> a_vec_2_1 = aie::filter_odd(a_vec_2);
-        const aie::vector<T_in, r> a_vec_3_0 = aie::filter_even(a_vec_3);
-        const aie::vector<T_in, r> a_vec_3_1 = aie::filter_odd(a_vec_3);
+        // After this, each of a_vec_0_0 .. a_vec_3_1 contains rows
+        // row..row+r of some column of A. The columns are col..col+8.
+        aie::vector<T_in, r> a_vec_0_0, a_vec_0_1, a_vec_1_0, a_vec_1_1,
+            a_vec_2_0, a_vec_2_1, a_vec_3_0, a_vec_3_1;
+        if constexpr (col_major) {
+          a_vec_0_0 = aie::load_v<r>(a_ptr);
+          a_vec_0_1 = aie::load_v<r>(a_ptr + m);
+          a_vec_1_0 = aie::load_v<r>(a_ptr + 2 * m);
+          a_vec_1_1 = aie::load_v<r>(a_ptr + 3 * m);
+          a_vec_2_0 = aie::load_v<r>(a_ptr + 4 * m);
+          a_vec_2_1 = aie::load_v<r>(a_ptr + 5 * m);
+          a_vec_3_0 = aie::load_v<r>(a_ptr + 6 * m);
+          a_vec_3_1 = aie::load_v<r>(a_ptr + 7 * m);
+        } else if constexpr (w == 2) {
+          const aie::vector<T_in, 2 * r> a_vec_0 = aie::load_v<2 * r>(a_ptr);
+          const aie::vector<T_in, 2 * r> a_vec_1 =
+              aie::load_v<2 * r>(a_ptr + 2 * m);
+          const aie::vector<T_in, 2 * r> a_vec_2 =
+              aie::load_v<2 * r>(a_ptr + 4 * m);
+          const aie::vector<T_in, 2 * r> a_vec_3 =
+              aie::load_v<2 * r>(a_ptr + 6 * m);
+
+          // The even/odd calls below extract the interleaved columns of A.
+          // We need to do this since A is only transposed (column-major) at
+          // a granularity of 4 bytes, but the inputs are two bytes;
+          // therefore, we end up with two interleaved columns at each 2*m
+          // interval.
+          a_vec_0_0 = aie::filter_even(a_vec_0);
+          a_vec_0_1 = aie::filter_odd(a_vec_0);
+          a_vec_1_0 = aie::filter_even(a_vec_1);
+          a_vec_1_1 = aie::filter_odd(a_vec_1);
+          a_vec_2_0 = aie::filter_even(a_vec_2);
+          a_vec_2_1 = aie::filter_odd(a_vec_2);
+          a_vec_3_0 = aie::filter_even(a_vec_3);
+          a_vec_3_1 = aie::filter_odd(a_vec_3);
+        } else {
+          // With one-byte inputs, four columns are interleaved at each 4*m
+          // interval; filtering twice separates them.
+          const aie::vector<T_in, 4 * r> a_vec_0 = aie::load_v<4 * r>(a_ptr);
+          const aie::vector<T_in, 4 * r> a_vec_1 =
+              aie::load_v<4 * r>(a_ptr + 4 * m);
+          const aie::vector<T_in, 2 * r> a_vec_0_even =
+              aie::filter_even(a_vec_0);
+          const aie::vector<T_in, 2 * r> a_vec_0_odd = aie::filter_odd(a_vec_0);
+          const aie::vector<T_in, 2 * r> a_vec_1_even =
+              aie::filter_even(a_vec_1);
+          const aie::vector<T_in, 2 * r> a_vec_1_odd = aie::filter_odd(a_vec_1);
+          a_vec_0_0 = aie::filter_even(a_vec_0_even);
+          a_vec_0_1 = aie::filter_even(a_vec_0_odd);
+          a_vec_1_0 = aie::filter_odd(a_vec_0_even);
+          a_vec_1_1 = aie::filter_odd(a_vec_0_odd);
+          a_vec_2_0 = aie::filter_even(a_vec_1_even);
+          a_vec_2_1 = aie::filter_even(a_vec_1_odd);
+          a_vec_3_0 = aie::filter_odd(a_vec_1_even);
+          a_vec_3_1 = aie::filter_odd(a_vec_1_odd);
+        }
 
         // The accumulate call below produces the following output:
         // c_acc_out[i] = c_acc_in + b_vec[0]*a_vec_0_0[i]
@@ -119,23 +160,69 @@ void matvec_vectorized(T_in *__restrict a, T_in *__restrict b,
             a_vec_2_0, a_vec_2_1, a_vec_3_0, a_vec_3_1);
 
         aie::store_v(c_ptr, c_acc_out.template to_vector<T_out>());
-        a_ptr += 2 * r; // On last iteration, this advances to next column.
-                        // This is why we only iterate by 6*m in the outer
-                        // loop, for a total of 8*m, i.e. 8 columns.
-        c_ptr += r;     // Move to next r rows of the same columns in A.
+        a_ptr += interleave * r; // On last iteration, this advances to next
+                                 // column. This is why we only iterate by
+                                 // (8-interleave)*m in the outer loop, for a
+                                 // total of 8*m, i.e. 8 columns.
+        c_ptr += r; // Move to next r rows of the same columns in A.
       }
 
-    a_ptr += 6 * m; // Move to next 8 columns of A.
-    b_ptr += s;     // Move to next s (==8) rows of b.
+    a_ptr += (8 - interleave) * m; // Move to next 8 columns of A.
+    b_ptr += s;                    // Move to next s (==8) rows of b.
   }
   event1();
 }
 
+// Split-K mode: each core of a column computes a partial result over its
+// share of K. The partial results are summed up over the cascade interface:
+// the top core of the column puts its result, the cores in between add the
+// incoming result to their own and pass the sum on, and the bottom core adds
+// the incoming result to its own, which then holds the full result.
+
+// Lanes of a 32-bit output type in one 512-bit cascade word
+constexpr unsigned cascade_lanes = 16;
+
+template <typename T, unsigned M> void cascade_put(T *__restrict c) {
+  static_assert(sizeof(T) == 4 && M % cascade_lanes == 0);
+  event0();
+  for (unsigned i = 0; i < M; i += cascade_lanes)
+    chess_prepare_for_pipelining {
+      aie::vector<T, cascade_lanes> v = aie::load_v<cascade_lanes>(c + i);
+      put_mcd(v.template cast_to<int32>());
+    }
+  event1();
+}
+
+template <typename T, unsigned M, bool put>
+void cascade_get_add(T *__restrict c) {
+  static_assert(sizeof(T) == 4 && M % cascade_lanes == 0);
+  event0();
+  for (unsigned i = 0; i < M; i += cascade_lanes)
+    chess_prepare_for_pipelining {
+      aie::vector<T, cascade_lanes> in =
+          aie::vector<int32, cascade_lanes>(get_scd_v16int32())
+              .template cast_to<T>();
+      aie::vector<T, cascade_lanes> sum =
+          aie::add(aie::load_v<cascade_lanes>(c + i), in);
+      aie::store_v(c + i, sum);
+      if constexpr (put) {
+        put_mcd(sum.template cast_to<int32>());
+      }
+    }
+  event1();
+}
+
 extern "C" {
 
 #define combos(X)                                                              \
   X(bfloat16, bf16, float, f32, accfloat)                                      \
-//    X(int16,         i16, int16,    i16, acc32)                                  \
+  X(int8, i8, int32, i32, acc32)                                               \
+  X(int16, i16, int32, i32, acc64)
+
+// The kernels on the output only, once per output type
+#define out_combos(X)                                                          \
+  X(float, f32)                                                                \
+  X(int32, i32)
 
 #define matvec_scalar_c_func(ctype_in, mlir_type_in, ctype_out, mlir_type_out, \
                              ctype_acc)                                        \
@@ -152,19 +239,58 @@ extern "C" {
         a_in, b_in, c_out);                                                    \
   }
 
-#define zero_vectorized_c_func(ctype_in, mlir_type_in, ctype_out,              \
-                               mlir_type_out, ctype_acc)                       \
+#define matvec_vectorized_col_major_c_func(ctype_in, mlir_type_in, ctype_out,  \
+                                           mlir_type_out, ctype_acc)           \
+  void matvec_vectorized_col_major_##mlir_type_in##_##mlir_type_out(           \
+      ctype_in *a_in, ctype_in *b_in, ctype_out *c_out) {                      \
+    matvec_vectorized<ctype_in, ctype_out, ctype_acc, 64, 64, 16, 8, true>(    \
+        a_in, b_in, c_out);                                                    \
+  }
+
+// Resident-B mode: b_in holds all of B, and k_tile is the index of the K
+// tile that a_in belongs to.
+#define matvec_vectorized_resident_c_func(ctype_in, mlir_type_in, ctype_out,   \
+                                          mlir_type_out, ctype_acc)            \
+  void matvec_vectorized_resident_##mlir_type_in##_##mlir_type_out(            \
+      ctype_in *a_in, ctype_in *b_in, ctype_out *c_out, int32_t k_tile) {      \
+    matvec_vectorized<ctype_in, ctype_out, ctype_acc, 64, 64, 16, 8>(          \
+        a_in, b_in + 64 * k_tile, c_out);                                      \
+  }
+
+#define matvec_vectorized_col_major_resident_c_func(                           \
+    ctype_in, mlir_type_in, ctype_out, mlir_type_out, ctype_acc)               \
+  void matvec_vectorized_col_major_resident_##mlir_type_in##_##mlir_type_out(  \
+      ctype_in *a_in, ctype_in *b_in, ctype_out *c_out, int32_t k_tile) {      \
+    matvec_vectorized<ctype_in, ctype_out, ctype_acc, 64, 64, 16, 8, true>(    \
+        a_in, b_in + 64 * k_tile, c_out);                                      \
+  }
+
+#define zero_vectorized_c_func(ctype_out, mlir_type_out)                       \
   void zero_vectorized_##mlir_type_out(ctype_out *c_out) {                     \
     zero_vectorized<ctype_out, 64, 1, 32>(c_out);                              \
   }
 
-#define zero_scalar_c_func(ctype_in, mlir_type_in, ctype_out, mlir_type_out,   \
-                           ctype_acc)                                          \
+#define zero_scalar_c_func(ctype_out, mlir_type_out)                           \
   void zero_scalar_##mlir_type_out(ctype_out *c_out) {                         \
     zero_scalar<ctype_out, 32, 1>(c_out);                                      \
   }
 
+#define cascade_c_func(ctype_out, mlir_type_out)                               \
+  void cascade_put_##mlir_type_out(ctype_out *c) {                             \
+    cascade_put<ctype_out, 64>(c);                                             \
+  }                                                                            \
+  void cascade_get_add_put_##mlir_type_out(ctype_out *c) {                     \
+    cascade_get_add<ctype_out, 64, true>(c);                                   \
+  }                                                                            \
+  void cascade_get_add_##mlir_type_out(ctype_out *c) {                         \
+    cascade_get_add<ctype_out, 64, false>(c);                                  \
+  }
+
 combos(matvec_scalar_c_func) combos(matvec_vectorized_c_func)
-    combos(zero_vectorized_c_func) combos(zero_scalar_c_func)
+    combos(matvec_vectorized_col_major_c_func)
+        combos(matvec_vectorized_resident_c_func)
+            combos(matvec_vectorized_col_major_resident_c_func)
+                out_combos(zero_vectorized_c_func)
+                    out_combos(zero_scalar_c_func) out_combos(cascade_c_func)
 
 } // extern "C"
@@ -8,11 +8,22 @@
 //
 //===----------------------------------------------------------------------===//
 
+#include <cstdint>
 #include <stdfloat>
 
 #define DATATYPES_USING_DEFINED
+#if defined(DTYPE_I8)
+using A_DATATYPE = std::int8_t;
+using B_DATATYPE = std::int8_t;
+using C_DATATYPE = std::int32_t;
+#elif defined(DTYPE_I16)
+using A_DATATYPE = std::int16_t;
+using B_DATATYPE = std::int16_t;
+using C_DATATYPE = std::int32_t;
+#else
 using A_DATATYPE = std::bfloat16_t;
 using B_DATATYPE = std::bfloat16_t;
 using C_DATATYPE = float;
+#endif
 
 #include "../test.cpp"
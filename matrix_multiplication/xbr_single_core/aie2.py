@@ -5,14 +5,19 @@
 #
 # (c) Copyright 2023 AMD Inc.
 import argparse
+import os
+import sys
 from aie.dialects.aie import *
 from aie.dialects.aiex import *
 from aie.dialects.scf import *
 from aie.extras.context import mlir_mod_ctx
 import aie.utils.trace as trace_utils
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from devices import devices, placement
 
-def my_matmul(M = 256, K = 256, N = 256):
+
+def my_matmul(M = 256, K = 256, N = 256, device_name = "npu1_1col", col_offset = 0):
     #M = 256
     #K = 256
     #N = 256
@@ -24,6 +29,8 @@ def my_matmul(M = 256, K = 256, N = 256):
     t = 4
     word_size_in = 2
     word_size_out = 2
+    dev = devices[device_name]
+    col = placement(dev, col_offset, 1)[0]
 
     vectorized = True
     enable_tracing = False
@@ -55,7 +62,7 @@ def my_matmul(M = 256, K = 256, N = 256):
 
     with mlir_mod_ctx() as ctx:
 
-        @device(AIEDevice.npu1_1col)
+        @device(getattr(AIEDevice, dev.name))
         def device_body():
             memref_a_ty = T.memref(m, k, T.bf16())
             memref_b_ty = T.memref(k, n, T.bf16())
@@ -77,9 +84,9 @@ def my_matmul(M = 256, K = 256, N = 256):
             )
 
             # Tile declarations
-            shim_tile = tile(0, 0)
-            mem_tile = tile(0, 1)
-            compute_tile2_col, compute_tile2_row = 0, 2
+            shim_tile = tile(col, dev.shim_row)
+            mem_tile = tile(col, dev.mem_row)
+            compute_tile2_col, compute_tile2_row = col, dev.core_row
             compute_tile2 = tile(compute_tile2_col, compute_tile2_row)
 
             # AIE-array data movement with object fifos
@@ -227,7 +234,7 @@ def my_matmul(M = 256, K = 256, N = 256):
                             strides=[n_in_i32s, k_x_N_in_i32s, N_in_i32s],
                         )
 
-                    npu_sync(column=0, row=0, direction=0, channel=0)
+                    npu_sync(column=col, row=dev.shim_row, direction=0, channel=0)
 
     print(ctx.module)
 
@@ -239,5 +246,9 @@ argparser = argparse.ArgumentParser(
 argparser.add_argument("-M", type=int, default=256)
 argparser.add_argument("-K", type=int, default=256)
 argparser.add_argument("-N", type=int, default=256)
+argparser.add_argument("--device", choices=devices, default="npu1_1col",
+                       help="device to generate the design for")
+argparser.add_argument("--col-offset", type=int, default=0,
+                       help="column of the device to use, leaving the others to designs running concurrently")
 args = argparser.parse_args()
-my_matmul(args.M, args.K, args.N)
+my_matmul(args.M, args.K, args.N, args.device, args.col_offset)
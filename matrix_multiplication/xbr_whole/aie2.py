@@ -5,6 +5,7 @@
 #
 # (c) Copyright 2023 AMD Inc.
 
+import os
 import sys
 import argparse
 
@@ -14,6 +15,9 @@ from aie.dialects.aie import *
 from aie.dialects.aiex import *
 from aie.dialects.scf import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from devices import devices, placement
+
 
 def main():
     argparser = argparse.ArgumentParser(
@@ -23,11 +27,27 @@ def main():
     argparser.add_argument("-M", type=int, default=512)
     argparser.add_argument("-K", type=int, default=512)
     argparser.add_argument("-N", type=int, default=512)
+    argparser.add_argument(
+        "--device",
+        choices=devices,
+        default="npu1_4col",
+        help="device to generate the design for; the design uses 4 of its columns",
+    )
+    argparser.add_argument(
+        "--col-offset",
+        type=int,
+        default=0,
+        help="first of the 4 columns of the device to use, leaving the others to "
+        "designs running concurrently",
+    )
     args = argparser.parse_args()
-    my_matmul(args.M, args.K, args.N)
+    try:
+        my_matmul(args.M, args.K, args.N, args.device, args.col_offset)
+    except ValueError as e:
+        argparser.error(str(e))
 
 
-def my_matmul(M=512, K=512, N=512):
+def my_matmul(M=512, K=512, N=512, device_name="npu1_4col", col_offset=0):
     m = 64
     k = 64
     n = 64
@@ -41,6 +61,15 @@ def my_matmul(M=512, K=512, N=512):
     n_cols = 4
     n_cores = n_rows * n_cols
 
+    dev = devices[device_name]
+    if n_rows > dev.n_core_rows:
+        raise ValueError(
+            "the design needs {} rows of cores, but {} only has {}".format(
+                n_rows, dev.name, dev.n_core_rows
+            )
+        )
+    cols = placement(dev, col_offset, n_cols)
+
     A_sz_in_i32s = M * K * word_size_in // 4
     B_sz_in_i32s = K * N * word_size_in // 4
     C_sz_in_bytes = M * N * word_size_out
@@ -74,7 +103,7 @@ def my_matmul(M=512, K=512, N=512):
 
     with mlir_mod_ctx() as ctx:
 
-        @device(AIEDevice.npu1_4col)
+        @device(getattr(AIEDevice, dev.name))
         def device_body():
             memRef_inA_ty = T.memref(m * k, T.bf16())
             memRef_inB_ty = T.memref(k * n, T.bf16())
@@ -95,89 +124,27 @@ def my_matmul(M=512, K=512, N=512):
             )
 
             # Tile declarations
-            _0_ShimTile = tile(0, 0)
-            _0_MemTile = tile(0, 1)
-            _0_ComputeTile2 = tile(0, 2)
-            _0_ComputeTile3 = tile(0, 3)
-            _0_ComputeTile4 = tile(0, 4)
-            _0_ComputeTile5 = tile(0, 5)
-            _0_cores = [
-                _0_ComputeTile2,
-                _0_ComputeTile3,
-                _0_ComputeTile4,
-                _0_ComputeTile5,
-            ]
-            _1_ShimTile = tile(1, 0)
-            _1_MemTile = tile(1, 1)
-            _1_ComputeTile2 = tile(1, 2)
-            _1_ComputeTile3 = tile(1, 3)
-            _1_ComputeTile4 = tile(1, 4)
-            _1_ComputeTile5 = tile(1, 5)
-            _1_cores = [
-                _1_ComputeTile2,
-                _1_ComputeTile3,
-                _1_ComputeTile4,
-                _1_ComputeTile5,
-            ]
-            _2_ShimTile = tile(2, 0)
-            _2_MemTile = tile(2, 1)
-            _2_ComputeTile2 = tile(2, 2)
-            _2_ComputeTile3 = tile(2, 3)
-            _2_ComputeTile4 = tile(2, 4)
-            _2_ComputeTile5 = tile(2, 5)
-            _2_cores = [
-                _2_ComputeTile2,
-                _2_ComputeTile3,
-                _2_ComputeTile4,
-                _2_ComputeTile5,
-            ]
-            _3_ShimTile = tile(3, 0)
-            _3_MemTile = tile(3, 1)
-            _3_ComputeTile2 = tile(3, 2)
-            _3_ComputeTile3 = tile(3, 3)
-            _3_ComputeTile4 = tile(3, 4)
-            _3_ComputeTile5 = tile(3, 5)
-            _3_cores = [
-                _3_ComputeTile2,
-                _3_ComputeTile3,
-                _3_ComputeTile4,
-                _3_ComputeTile5,
-            ]
-            shims = [_0_ShimTile, _1_ShimTile, _2_ShimTile, _3_ShimTile]
-            mems = [_0_MemTile, _1_MemTile, _2_MemTile, _3_MemTile]
+            shims = [tile(col, dev.shim_row) for col in cols]
+            mems = [tile(col, dev.mem_row) for col in cols]
             cores = [
-                [_0_ComputeTile2, _0_ComputeTile3, _0_ComputeTile4, _0_ComputeTile5],
-                [_1_ComputeTile2, _1_ComputeTile3, _1_ComputeTile4, _1_ComputeTile5],
-                [_2_ComputeTile2, _2_ComputeTile3, _2_ComputeTile4, _2_ComputeTile5],
-                [_3_ComputeTile2, _3_ComputeTile3, _3_ComputeTile4, _3_ComputeTile5],
+                [tile(col, dev.core_row + row) for row in range(n_rows)] for col in cols
             ]
             t_cores = [
                 [cores[j][i] for j in range(len(cores))] for i in range(len(cores[0]))
             ]
-            inA_fifo_names = ["inA0", "inA1", "inA2", "inA3"]
+            inA_fifo_names = ["inA{}".format(i) for i in range(n_cols)]
             inA_fifos = {}
-            inB_fifo_names = ["inB0", "inB1", "inB2", "inB3"]
+            inB_fifo_names = ["inB{}".format(i) for i in range(n_cols)]
             inB_fifos = {}
-            memA_fifo_names = ["memA0", "memA1", "memA2", "memA3"]
+            memA_fifo_names = ["memA{}".format(i) for i in range(n_cols)]
             memA_fifos = {}
-            memB_fifo_names = ["memB0", "memB1", "memB2", "memB3"]
+            memB_fifo_names = ["memB{}".format(i) for i in range(n_cols)]
             memB_fifos = {}
-            _0_outC_fifo_names = ["memC00", "memC10", "memC20", "memC30"]
-            _0_outC_fifos = {}
-            _1_outC_fifo_names = ["memC01", "memC11", "memC21", "memC31"]
-            _1_outC_fifos = {}
-            _2_outC_fifo_names = ["memC02", "memC12", "memC22", "memC32"]
-            _2_outC_fifos = {}
-            _3_outC_fifo_names = ["memC03", "memC13", "memC23", "memC33"]
-            _3_outC_fifos = {}
             memC_fifo_names = [
-                _0_outC_fifo_names,
-                _1_outC_fifo_names,
-                _2_outC_fifo_names,
-                _3_outC_fifo_names,
+                ["memC{}{}".format(j, i) for j in range(n_rows)] for i in range(n_cols)
             ]
-            memC_fifos = [_0_outC_fifos, _1_outC_fifos, _2_outC_fifos, _3_outC_fifos]
-            outC_fifo_names = ["outC0", "outC1", "outC2", "outC3"]
+            memC_fifos = [{} for i in range(n_cols)]
+            outC_fifo_names = ["outC{}".format(i) for i in range(n_cols)]
             outC_fifos = {}
 
             # AIE-array data movement with object fifos
@@ -366,8 +333,8 @@ def my_matmul(M=512, K=512, N=512):
                                 sizes=[N_div_n_div_n_cols, K_div_k, k, n_in_i32s],
                                 strides=[n_x_n_cols_in_i32s, k_x_N_in_i32s, N_in_i32s],
                             )
-                    for i in range(n_cols):
-                        npu_sync(column=i, row=0, direction=0, channel=0)
+                    for col in cols:
+                        npu_sync(column=col, row=dev.shim_row, direction=0, channel=0)
 
     # print(ctx.module.operation.verify())
     print(ctx.module)
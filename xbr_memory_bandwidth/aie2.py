@@ -6,6 +6,8 @@
 #
 # (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
 
+import argparse
+import os
 import sys
 
 from aie.dialects.aie import *
@@ -15,13 +17,46 @@ from aie.extras.context import mlir_mod_ctx
 
 import aie.utils.trace as trace_utils
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "matrix_multiplication"))
+from devices import devices, placement
 
-def passthroughKernel(vector_size, trace_size):
+
+# Data memory of a compute tile (which also holds the core's stack) and of a
+# memory tile
+l1_bytes = 64 * 1024
+l1_stack_bytes = 1024
+l2_bytes = 512 * 1024
+
+
+def passthroughKernel(vector_size, trace_size, fifo_depth=2, mem_fifo_depth=2, acquire_size=1,
+                      device_name="npu1_4col", col_offset=0, num_cols=None):
     N =(int) (vector_size/4)
     lineWidthInBytes =(int)( N //(1000000/4))   # each chunk 1000 elements
     lineWidthInInt32s = lineWidthInBytes // 4
 
-    @device(AIEDevice.npu1_4col)
+    if not 1 <= acquire_size <= fifo_depth or mem_fifo_depth < 1:
+        raise ValueError("FIFO depths must be at least 1 and at least the acquire size")
+    # fifo_depth input and output lines per core; the memory tile holds the
+    # double-width lines of both cores in each direction, shared with the
+    # linked core FIFOs and sized for the deeper of the two.
+    l1_footprint = 2 * fifo_depth * lineWidthInBytes
+    l2_footprint = 2 * max(fifo_depth, mem_fifo_depth) * 2 * lineWidthInBytes
+    if l1_footprint > l1_bytes - l1_stack_bytes:
+        raise ValueError("the core buffers need {} bytes, but a compute tile only has {}".format(
+            l1_footprint, l1_bytes - l1_stack_bytes))
+    if l2_footprint > l2_bytes:
+        raise ValueError("the memory tile buffers need {} bytes, but a memory tile only has {}".format(
+            l2_footprint, l2_bytes))
+    # The input is chopped into one sub-tensor per column of the design, each
+    # split between the first two cores of its column by the memory tile.
+    dev = devices[device_name]
+    n_cols = dev.n_cols - col_offset if num_cols is None else num_cols
+    cols = placement(dev, col_offset, n_cols)
+    if vector_size % (4 * n_cols) != 0:
+        raise ValueError("the vector does not split into whole 32-bit words across the {} columns of {}".format(
+            n_cols, dev.name))
+
+    @device(getattr(AIEDevice, dev.name))
     def device_body():
         # define types
         memRef_ty = T.memref(lineWidthInBytes, T.ui8())
@@ -33,28 +68,11 @@ def passthroughKernel(vector_size, trace_size):
         )
 
         # Tile declarations
-        ShimTile0 = tile(0, 0)
-        MemTile0_1 = tile(0,1)
-        ComputeTile0_2 = tile(0, 2)
-        ComputeTile0_3 = tile(0, 3)
-
-        ShimTile1 = tile(1, 0)
-        MemTile1_1 = tile(1,1)
-        ComputeTile1_2 = tile(1, 2)
-        ComputeTile1_3 = tile(1, 3)
-
-        ShimTile2 = tile(2, 0)
-        MemTile2_1 = tile(2,1)
-        ComputeTile2_2 = tile(2, 2)
-        ComputeTile2_3 = tile(2, 3)
-        
-        ShimTile3 = tile(3, 0)
-        MemTile3_1 = tile(3,1)
-        ComputeTile3_2 = tile(3, 2)
-        ComputeTile3_3 = tile(3, 3)
+        interface_list = [tile(col, dev.shim_row) for col in cols]
+        memory_list = [tile(col, dev.mem_row) for col in cols]
+        compute_list = [tile(col, dev.core_row) for col in cols]
+        compute2_list = [tile(col, dev.core_row + 1) for col in cols]
 
-
-        
         buffer_in_dic = {}
         buffer_out_dic = {}
         buffer_in_name = []
@@ -70,14 +88,10 @@ def passthroughKernel(vector_size, trace_size):
         buffer_compute2_in_name = []
         buffer_compute2_out_name = []
         
-        interface_list = [ShimTile0,ShimTile1,ShimTile2,ShimTile3]
-        memory_list = [MemTile0_1,MemTile1_1,MemTile2_1,MemTile3_1]
-        compute_list = [ComputeTile0_2,ComputeTile1_2,ComputeTile2_2,ComputeTile3_2]
-        compute2_list = [ComputeTile0_3,ComputeTile1_3,ComputeTile2_3,ComputeTile3_3]
         
 
 
-        for i in range(4):
+        for i in range(n_cols):
             #interface to memory tile
             in_name = "in"+str(i)
             buffer_in_name.append(in_name)
@@ -85,8 +99,8 @@ def passthroughKernel(vector_size, trace_size):
             out_name = "out"+str(i)
             buffer_out_name.append(out_name)
 
-            buffer_in_dic[in_name] = object_fifo(in_name, interface_list[i], memory_list[i], 2, inerface_memRef_ty)
-            buffer_out_dic[out_name] = object_fifo(out_name, memory_list[i], interface_list[i], 2, inerface_memRef_ty)
+            buffer_in_dic[in_name] = object_fifo(in_name, interface_list[i], memory_list[i], mem_fifo_depth, inerface_memRef_ty)
+            buffer_out_dic[out_name] = object_fifo(out_name, memory_list[i], interface_list[i], mem_fifo_depth, inerface_memRef_ty)
 
             #memory tile and compute1 tile
             to_compute1 = "to_compute1_"+str(i)
@@ -95,8 +109,8 @@ def passthroughKernel(vector_size, trace_size):
             from_compute1 = "from_compute1_"+str(i)
             buffer_compute_out_name.append(from_compute1)
 
-            buffer_compute_in_dic[to_compute1] = object_fifo(to_compute1, memory_list[i], compute_list[i], 2, memRef_ty)
-            buffer_compute_out_dic[from_compute1] = object_fifo(from_compute1, compute_list[i], memory_list[i], 2, memRef_ty)
+            buffer_compute_in_dic[to_compute1] = object_fifo(to_compute1, memory_list[i], compute_list[i], fifo_depth, memRef_ty)
+            buffer_compute_out_dic[from_compute1] = object_fifo(from_compute1, compute_list[i], memory_list[i], fifo_depth, memRef_ty)
 
             #memory tile and compute2 tile
             to_compute2 = "to_compute2_"+str(i)
@@ -105,8 +119,8 @@ def passthroughKernel(vector_size, trace_size):
             from_compute2 = "from_compute2_"+str(i)
             buffer_compute2_out_name.append(from_compute2)
 
-            buffer_compute2_in_dic[to_compute2] = object_fifo(to_compute2, memory_list[i], compute2_list[i], 2, memRef_ty)
-            buffer_compute2_out_dic[from_compute2] = object_fifo(from_compute2, compute2_list[i], memory_list[i], 2, memRef_ty)
+            buffer_compute2_in_dic[to_compute2] = object_fifo(to_compute2, memory_list[i], compute2_list[i], fifo_depth, memRef_ty)
+            buffer_compute2_out_dic[from_compute2] = object_fifo(from_compute2, compute2_list[i], memory_list[i], fifo_depth, memRef_ty)
 
             #link
             object_fifo_link(buffer_in_dic[in_name], [ buffer_compute_in_dic[to_compute1], buffer_compute2_in_dic[to_compute2]])
@@ -115,40 +129,45 @@ def passthroughKernel(vector_size, trace_size):
 
 
         # Set up compute1 tiles
-        for i in range(4):
+        for i in range(n_cols):
             @core(compute_list[i], "passThrough.cc.o")
             def core_body():
                 for _ in for_(sys.maxsize):
-                    elemOut = buffer_compute_out_dic[buffer_compute_out_name[i]].acquire(ObjectFifoPort.Produce, 1)
-                    elemIn = buffer_compute_in_dic[buffer_compute_in_name[i]].acquire(ObjectFifoPort.Consume, 1)
-                    call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
-                    buffer_compute_in_dic[buffer_compute_in_name[i]].release(ObjectFifoPort.Consume, 1)
-                    buffer_compute_out_dic[buffer_compute_out_name[i]].release(ObjectFifoPort.Produce, 1)
+                    elemsOut = buffer_compute_out_dic[buffer_compute_out_name[i]].acquire(ObjectFifoPort.Produce, acquire_size)
+                    elemsIn = buffer_compute_in_dic[buffer_compute_in_name[i]].acquire(ObjectFifoPort.Consume, acquire_size)
+                    if acquire_size == 1:
+                        elemsOut, elemsIn = [elemsOut], [elemsIn]
+                    for elemIn, elemOut in zip(elemsIn, elemsOut):
+                        call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
+                    buffer_compute_in_dic[buffer_compute_in_name[i]].release(ObjectFifoPort.Consume, acquire_size)
+                    buffer_compute_out_dic[buffer_compute_out_name[i]].release(ObjectFifoPort.Produce, acquire_size)
                     yield_([])
 
         # Set up compute2 tiles
-        for i in range(4):
+        for i in range(n_cols):
             @core(compute2_list[i], "passThrough.cc.o")
             def core_body():
                 for _ in for_(sys.maxsize):
-                    elemOut = buffer_compute2_out_dic[buffer_compute2_out_name[i]].acquire(ObjectFifoPort.Produce, 1)
-                    elemIn = buffer_compute2_in_dic[buffer_compute2_in_name[i]].acquire(ObjectFifoPort.Consume, 1)
-                    call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
-                    buffer_compute2_in_dic[buffer_compute2_in_name[i]].release(ObjectFifoPort.Consume, 1)
-                    buffer_compute2_out_dic[buffer_compute2_out_name[i]].release(ObjectFifoPort.Produce, 1)
+                    elemsOut = buffer_compute2_out_dic[buffer_compute2_out_name[i]].acquire(ObjectFifoPort.Produce, acquire_size)
+                    elemsIn = buffer_compute2_in_dic[buffer_compute2_in_name[i]].acquire(ObjectFifoPort.Consume, acquire_size)
+                    if acquire_size == 1:
+                        elemsOut, elemsIn = [elemsOut], [elemsIn]
+                    for elemIn, elemOut in zip(elemsIn, elemsOut):
+                        call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
+                    buffer_compute2_in_dic[buffer_compute2_in_name[i]].release(ObjectFifoPort.Consume, acquire_size)
+                    buffer_compute2_out_dic[buffer_compute2_out_name[i]].release(ObjectFifoPort.Produce, acquire_size)
                     yield_([])
 
 
         #    print(ctx.module.operation.verify())
 
-        tensorSize = N
-        tensorSizeInInt32s = tensorSize // 4
-        tensor_ty = T.memref(tensorSizeInInt32s*4, T.i32()) #4 col
+        tensorSizeInInt32s = vector_size // 4 // n_cols
+        tensor_ty = T.memref(vector_size // 4, T.i32())
 
         @FuncOp.from_py_func(tensor_ty, tensor_ty, tensor_ty)
         def sequence(inTensor, outTensor, notUsed):
 
-            for i in range(4):
+            for i in range(n_cols):
                 npu_dma_memcpy_nd(
                     metadata=buffer_in_name[i],
                     bd_id=2*i,
@@ -164,20 +183,32 @@ def passthroughKernel(vector_size, trace_size):
                     sizes=[1, 1, 1, tensorSizeInInt32s],
                 )
 
-            npu_sync(column=0, row=0, direction=0, channel=0)
-            npu_sync(column=1, row=0, direction=0, channel=0)
-            npu_sync(column=2, row=0, direction=0, channel=0)
-            npu_sync(column=3, row=0, direction=0, channel=0)
-
-
-try:
-    vector_size = int(sys.argv[1])
-    if vector_size % 64 != 0 or vector_size < 512:
-        print("Vector size must be a multiple of 64 and greater than or equal to 512")
-        raise ValueError
-    trace_size = 0 if (len(sys.argv) != 3) else int(sys.argv[2])
-except ValueError:
-    print("Argument has inappropriate value")
+            for col in cols:
+                npu_sync(column=col, row=dev.shim_row, direction=0, channel=0)
+
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("vector_size", type=int)
+argparser.add_argument("trace_size", type=int, nargs="?", default=0)
+argparser.add_argument("--fifo-depth", type=int, default=2,
+                       help="depth of the FIFOs between the memory tiles and the cores")
+argparser.add_argument("--mem-fifo-depth", type=int, default=2,
+                       help="depth of the FIFOs between the shims and the memory tiles")
+argparser.add_argument("--acquire-size", type=int, default=1,
+                       help="lines acquired per iteration of the core loop")
+argparser.add_argument("--device", choices=devices, default="npu1_4col",
+                       help="device to generate the design for; two cores per column are used")
+argparser.add_argument("--col-offset", type=int, default=0,
+                       help="first column of the device to use, leaving the others to designs running concurrently")
+argparser.add_argument("--num-cols", type=int, default=None,
+                       help="columns to use; defaults to all columns from --col-offset on")
+args = argparser.parse_args()
+if args.vector_size % 64 != 0 or args.vector_size < 512:
+    argparser.error("Vector size must be a multiple of 64 and greater than or equal to 512")
 with mlir_mod_ctx() as ctx:
-    passthroughKernel(vector_size, trace_size)
+    try:
+        passthroughKernel(args.vector_size, args.trace_size, args.fifo_depth, args.mem_fifo_depth, args.acquire_size,
+                          args.device, args.col_offset, args.num_cols)
+    except ValueError as e:
+        argparser.error(str(e))
     print(ctx.module)
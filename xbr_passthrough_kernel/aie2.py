@@ -6,6 +6,8 @@
 #
 # (c) Copyright 2024 Advanced Micro Devices, Inc. or its affiliates
 
+import argparse
+import os
 import sys
 
 from aie.dialects.aie import *
@@ -15,13 +17,38 @@ from aie.extras.context import mlir_mod_ctx
 
 import aie.utils.trace as trace_utils
 
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "matrix_multiplication"))
+from devices import devices, placement
 
-def passthroughKernel(vector_size, trace_size):
+
+# Data memory of a compute tile, which also holds the core's stack
+l1_bytes = 64 * 1024
+l1_stack_bytes = 1024
+
+
+def passthroughKernel(vector_size, trace_size, fifo_depth=2, acquire_size=1, device_name="npu1_4col", col_offset=0, num_cols=None):
     N =(int) (vector_size/4)
-    lineWidthInBytes =(int)( N //(1000000/4))   # chop input in 4 sub-tensors
+    lineWidthInBytes =(int)( N //(1000000/4))
     lineWidthInInt32s = lineWidthInBytes // 4
 
-    @device(AIEDevice.npu1_4col)
+    # The input is chopped into one sub-tensor per column of the design, each
+    # streamed through the first core of its column.
+    dev = devices[device_name]
+    n_cols = dev.n_cols - col_offset if num_cols is None else num_cols
+    cols = placement(dev, col_offset, n_cols)
+    if vector_size % (4 * n_cols) != 0:
+        raise ValueError("the vector does not split into whole 32-bit words across the {} columns of {}".format(
+            n_cols, dev.name))
+
+    if not 1 <= acquire_size <= fifo_depth:
+        raise ValueError("the FIFO depth must be at least the acquire size")
+    # fifo_depth input and output lines per core
+    l1_footprint = 2 * fifo_depth * lineWidthInBytes
+    if l1_footprint > l1_bytes - l1_stack_bytes:
+        raise ValueError("the core buffers need {} bytes, but a compute tile only has {}".format(
+            l1_footprint, l1_bytes - l1_stack_bytes))
+
+    @device(getattr(AIEDevice, dev.name))
     def device_body():
         # define types
         memRef_ty = T.memref(lineWidthInBytes, T.ui8())
@@ -32,159 +59,77 @@ def passthroughKernel(vector_size, trace_size):
         )
 
         # Tile declarations
-        ShimTile0 = tile(0, 0)
-        ComputeTile0_2 = tile(0, 2)
-
-        ShimTile1 = tile(1, 0)
-        ComputeTile1_2 = tile(1, 2)
-
-        ShimTile2 = tile(2, 0)
-        ComputeTile2_2 = tile(2, 2)
-        
-        ShimTile3 = tile(3, 0)
-        ComputeTile3_2 = tile(3, 2)
-
+        ShimTiles = [tile(col, dev.shim_row) for col in cols]
+        ComputeTiles = [tile(col, dev.core_row) for col in cols]
 
         # AIE-array data movement with object fifos
-        of_in0 = object_fifo("in0", ShimTile0, ComputeTile0_2, 2, memRef_ty)
-        of_out0 = object_fifo("out0", ComputeTile0_2, ShimTile0, 2, memRef_ty)
+        in_names = ["in" + str(i) for i in range(n_cols)]
+        out_names = ["out" + str(i) for i in range(n_cols)]
+        of_ins = [object_fifo(in_names[i], ShimTiles[i], ComputeTiles[i], fifo_depth, memRef_ty)
+                  for i in range(n_cols)]
+        of_outs = [object_fifo(out_names[i], ComputeTiles[i], ShimTiles[i], fifo_depth, memRef_ty)
+                   for i in range(n_cols)]
 
-        of_in1 = object_fifo("in1", ShimTile1, ComputeTile1_2, 2, memRef_ty)
-        of_out1 = object_fifo("out1", ComputeTile1_2, ShimTile1, 2, memRef_ty)
-        
-        of_in2 = object_fifo("in2", ShimTile2, ComputeTile2_2, 2, memRef_ty)
-        of_out2 = object_fifo("out2", ComputeTile2_2, ShimTile2, 2, memRef_ty)
-        
-        of_in3 = object_fifo("in3", ShimTile3, ComputeTile3_2, 2, memRef_ty)
-        of_out3 = object_fifo("out3", ComputeTile3_2, ShimTile3, 2, memRef_ty)
         # Set up compute tiles
-
-        # Compute tile 2
-        @core(ComputeTile0_2, "passThrough.cc.o")
-        def core_body():
-            for _ in for_(sys.maxsize):
-                elemOut = of_out0.acquire(ObjectFifoPort.Produce, 1)
-                elemIn = of_in0.acquire(ObjectFifoPort.Consume, 1)
-                call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
-                of_in0.release(ObjectFifoPort.Consume, 1)
-                of_out0.release(ObjectFifoPort.Produce, 1)
-                yield_([])
-
-        # Compute tile 1 2
-        @core(ComputeTile1_2, "passThrough.cc.o")
-        def core_body():
-            for _ in for_(sys.maxsize):
-                elemOut = of_out1.acquire(ObjectFifoPort.Produce, 1)
-                elemIn = of_in1.acquire(ObjectFifoPort.Consume, 1)
-                call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
-                of_in1.release(ObjectFifoPort.Consume, 1)
-                of_out1.release(ObjectFifoPort.Produce, 1)
-                yield_([])
-
-        # Compute tile 2 2
-        @core(ComputeTile2_2, "passThrough.cc.o")
-        def core_body():
-            for _ in for_(sys.maxsize):
-                elemOut = of_out2.acquire(ObjectFifoPort.Produce, 1)
-                elemIn = of_in2.acquire(ObjectFifoPort.Consume, 1)
-                call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
-                of_in2.release(ObjectFifoPort.Consume, 1)
-                of_out2.release(ObjectFifoPort.Produce, 1)
-                yield_([])
-
-        # Compute tile 3 2
-        @core(ComputeTile3_2, "passThrough.cc.o")
-        def core_body():
-            for _ in for_(sys.maxsize):
-                elemOut = of_out3.acquire(ObjectFifoPort.Produce, 1)
-                elemIn = of_in3.acquire(ObjectFifoPort.Consume, 1)
-                call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
-                of_in3.release(ObjectFifoPort.Consume, 1)
-                of_out3.release(ObjectFifoPort.Produce, 1)
-                yield_([])
-
-
+        for i in range(n_cols):
+            @core(ComputeTiles[i], "passThrough.cc.o")
+            def core_body():
+                for _ in for_(sys.maxsize):
+                    elemsOut = of_outs[i].acquire(ObjectFifoPort.Produce, acquire_size)
+                    elemsIn = of_ins[i].acquire(ObjectFifoPort.Consume, acquire_size)
+                    if acquire_size == 1:
+                        elemsOut, elemsIn = [elemsOut], [elemsIn]
+                    for elemIn, elemOut in zip(elemsIn, elemsOut):
+                        call(passThroughLine, [elemIn, elemOut, lineWidthInBytes])
+                    of_ins[i].release(ObjectFifoPort.Consume, acquire_size)
+                    of_outs[i].release(ObjectFifoPort.Produce, acquire_size)
+                    yield_([])
 
         #    print(ctx.module.operation.verify())
 
-        tensorSize = N
-        tensorSizeInInt32s = tensorSize // 4
-        tensor_ty = T.memref(tensorSizeInInt32s*4, T.i32()) #4 col
+        tensorSizeInInt32s = vector_size // 4 // n_cols
+        tensor_ty = T.memref(vector_size // 4, T.i32())
 
         @FuncOp.from_py_func(tensor_ty, tensor_ty, tensor_ty)
         def sequence(inTensor, outTensor, notUsed):
-
-            npu_dma_memcpy_nd(
-                metadata="in0",
-                bd_id=0,
-                mem=inTensor,
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-            npu_dma_memcpy_nd(
-                metadata="out0",
-                bd_id=1,
-                mem=outTensor,
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-
-            npu_dma_memcpy_nd(
-                metadata="in1",
-                bd_id=2,
-                mem=inTensor,
-                offsets=[0, 0, 0, tensorSizeInInt32s],
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-            npu_dma_memcpy_nd(
-                metadata="out1",
-                bd_id=3,
-                mem=outTensor,
-                offsets=[0, 0, 0, tensorSizeInInt32s],
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-
-            npu_dma_memcpy_nd(
-                metadata="in2",
-                bd_id=4,
-                mem=inTensor,
-                offsets=[0, 0, 0, 2*tensorSizeInInt32s],
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-            npu_dma_memcpy_nd(
-                metadata="out2",
-                bd_id=5,
-                mem=outTensor,
-                offsets=[0, 0, 0, 2*tensorSizeInInt32s],
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-
-            npu_dma_memcpy_nd(
-                metadata="in3",
-                bd_id=6,
-                mem=inTensor,
-                offsets=[0, 0, 0, 3*tensorSizeInInt32s],
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-            npu_dma_memcpy_nd(
-                metadata="out3",
-                bd_id=7,
-                mem=outTensor,
-                offsets=[0, 0, 0, 3*tensorSizeInInt32s],
-                sizes=[1, 1, 1, tensorSizeInInt32s],
-            )
-            npu_sync(column=0, row=0, direction=0, channel=0)
-            npu_sync(column=1, row=0, direction=0, channel=0)
-            npu_sync(column=2, row=0, direction=0, channel=0)
-            npu_sync(column=3, row=0, direction=0, channel=0)
-
-
-try:
-    vector_size = int(sys.argv[1])
-    if vector_size % 64 != 0 or vector_size < 512:
-        print("Vector size must be a multiple of 64 and greater than or equal to 512")
-        raise ValueError
-    trace_size = 0 if (len(sys.argv) != 3) else int(sys.argv[2])
-except ValueError:
-    print("Argument has inappropriate value")
+            for i in range(n_cols):
+                npu_dma_memcpy_nd(
+                    metadata=in_names[i],
+                    bd_id=2*i,
+                    mem=inTensor,
+                    offsets=[0, 0, 0, i*tensorSizeInInt32s],
+                    sizes=[1, 1, 1, tensorSizeInInt32s],
+                )
+                npu_dma_memcpy_nd(
+                    metadata=out_names[i],
+                    bd_id=2*i+1,
+                    mem=outTensor,
+                    offsets=[0, 0, 0, i*tensorSizeInInt32s],
+                    sizes=[1, 1, 1, tensorSizeInInt32s],
+                )
+            for col in cols:
+                npu_sync(column=col, row=dev.shim_row, direction=0, channel=0)
+
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument("vector_size", type=int)
+argparser.add_argument("trace_size", type=int, nargs="?", default=0)
+argparser.add_argument("--fifo-depth", type=int, default=2,
+                       help="depth of the FIFOs between the shims and the cores")
+argparser.add_argument("--acquire-size", type=int, default=1,
+                       help="lines acquired per iteration of the core loop")
+argparser.add_argument("--device", choices=devices, default="npu1_4col",
+                       help="device to generate the design for; one core per column is used")
+argparser.add_argument("--col-offset", type=int, default=0,
+                       help="first column of the device to use, leaving the others to designs running concurrently")
+argparser.add_argument("--num-cols", type=int, default=None,
+                       help="columns to use; defaults to all columns from --col-offset on")
+args = argparser.parse_args()
+if args.vector_size % 64 != 0 or args.vector_size < 512:
+    argparser.error("Vector size must be a multiple of 64 and greater than or equal to 512")
 with mlir_mod_ctx() as ctx:
-    passthroughKernel(vector_size, trace_size)
+    try:
+        passthroughKernel(args.vector_size, args.trace_size, args.fifo_depth, args.acquire_size, args.device, args.col_offset, args.num_cols)
+    except ValueError as e:
+        argparser.error(str(e))
     print(ctx.module)